@@ -4,8 +4,46 @@ def create_app():
     app = Flask(__name__)
     app.config.from_object('config.Config')
 
+    from . import transport
+    transport.configure(app.config)
+
+    from .services import departures_cache
+    departures_cache.ttl = app.config["DEPARTURES_CACHE_TTL"]
+
     # Import and register the Blueprint
     from .routes import main
     app.register_blueprint(main)
 
+    from .response_cache import ResponseCache
+    app.extensions["nearby_cache"] = ResponseCache(app.config["NEARBY_CACHE_MAX_BYTES"])
+
+    if app.config["POI_CACHE_TTL"] > 0:
+        from .poi_cache import PoiCache
+        app.extensions["poi_cache"] = PoiCache(
+            app.config["POI_CACHE_PATH"], app.config["POI_CACHE_TTL"],
+            app.config["POI_CACHE_STALE_SECONDS"], app.config["POI_CACHE_MAX_BYTES"],
+        )
+
+    from .vehicles import VehicleHub
+    app.extensions["vehicle_hub"] = VehicleHub(app.config["VEHICLE_POLL_INTERVAL"])
+
+    from .walking import WalkingDistances
+    app.extensions["walking_distances"] = WalkingDistances(
+        app.config["OSRM_URL"], app.config["OSRM_PROFILE"], app.config["WALKING_CACHE_PATH"],
+        app.config["OSRM_TIMEOUT"], app.config["WALKING_DETOUR_FACTOR"], app.config["OSRM_MAX_TABLE_SIZE"],
+    )
+
+    # Keep the GTFS database fresh outside the request path. Started by the
+    # first request or the ASGI server's startup rather than here, so CLI
+    # commands, which build the app too, never run it
+    from .gtfs_feed import start_refresher
+
+    @app.before_request
+    def start_gtfs_refresher():
+        if "gtfs_refresher" not in app.extensions:
+            start_refresher(app)
+
+    from .cli import register_commands
+    register_commands(app)
+
     return app
@@ -0,0 +1,212 @@
+from urllib.parse import parse_qs
+import asyncio
+import json
+
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+from . import transport
+from .gtfs_feed import current_feed, start_refresher
+from .poi_store import poi_store_imported
+from .routes import (
+    GTFS_LOADING_ERROR, filter_pois_for_stop, local_route_pois, nearby_stops_with_routes, poi_stop_box,
+    pois_in_riding_order, streamed_stop_line, subsequent_route_stops, summarize_route_departures,
+    with_walking_distances,
+)
+from .services import fetch_all_departures, fetch_departures_async, fetch_osm_amenities_async
+
+
+class AsyncApp:
+    """
+    ASGI application that answers the upstream fan-out endpoints
+    (/api/routes, /departures and /api/pois_along_route) as coroutines on
+    the server's event loop, so one process can hold hundreds of them open
+    without a thread each. Every other request goes to fallback, an ASGI
+    wrapper of the Flask app such as asgiref's WsgiToAsgi.
+
+    The server's loop becomes the transport's shared loop, so the Flask
+    views' async upstream calls and their aiohttp sessions run on it too.
+    """
+
+    def __init__(self, flask_app, fallback):
+        self.flask_app = flask_app
+        self.fallback = fallback
+        self.handlers = {
+            "/api/routes": self.routes,
+            "/departures": self.departures,
+            "/api/pois_along_route": self.pois_along_route,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+
+        handler = self.handlers.get(scope["path"]) if scope["type"] == "http" and scope["method"] == "GET" else None
+        if handler is None:
+            await self.fallback(scope, receive, send)
+            return
+
+        args = {key: values[-1] for key, values in parse_qs(scope["query_string"].decode("latin-1")).items()}
+        headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+        try:
+            status, body = await handler(args, headers)
+        except (KeyError, ValueError):
+            status, body = 400, {"error": "Missing or invalid parameters"}
+        if hasattr(body, "__aiter__"):
+            await self.send_ndjson(send, status, body)
+        else:
+            await self.send_json(send, status, body)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                transport.attach_loop(asyncio.get_running_loop())
+                start_refresher(self.flask_app)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await transport.close_async_sessions()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    @staticmethod
+    async def send_json(send, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())],
+        })
+        await send({"type": "http.response.body", "body": payload})
+
+    @staticmethod
+    async def send_ndjson(send, status, lines):
+        """Send each line as soon as the async iterator yields it."""
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/x-ndjson"), (b"x-accel-buffering", b"no")],
+        })
+        try:
+            async for line in lines:
+                await send({"type": "http.response.body", "body": line.encode("utf-8"), "more_body": True})
+        finally:
+            await lines.aclose()
+        await send({"type": "http.response.body", "body": b""})
+
+    async def routes(self, args, headers):
+        """Async /api/routes; same parameters and response as the Flask view."""
+        user_lat = float(args["lat"])
+        user_lon = float(args["lon"])
+        radius = float(args["radius"])
+        frequency_limit = float(args["frequency"])
+
+        feed = current_feed(self.flask_app.config["GTFS_CACHE_DIR"])
+        if feed is None:
+            return 503, {"error": GTFS_LOADING_ERROR}
+        try:
+            # The stop index may need building for a new feed; keep that off the loop
+            stops_info = await asyncio.to_thread(nearby_stops_with_routes, feed, user_lat, user_lon, radius)
+            departure_data = await fetch_all_departures([stop["stop_id"] for stop in stops_info])
+            return 200, summarize_route_departures(user_lat, user_lon, frequency_limit, stops_info, departure_data)
+        except Exception as e:
+            print(f"Error fetching routes and stops: {e}")
+            return 500, {"error": str(e)}
+
+    async def departures(self, args, headers):
+        """Async /departures."""
+        try:
+            return 200, await fetch_departures_async(args["stop_id"])
+        except Exception as e:
+            return 500, {"error": str(e)}
+
+    async def pois_along_route(self, args, headers):
+        """
+        Async /api/pois_along_route; same parameters and responses as the
+        Flask view. The per-stop Overpass lookups are coroutines here too,
+        while the GTFS reads, the local POI sources and walking distances,
+        which block, run on worker threads.
+        """
+        config = self.flask_app.config
+        route_id = args.get("route_id")
+        branch_letter = args.get("branch_letter")
+        user_lat = float(args["lat"])
+        user_lon = float(args["lon"])
+        walking_distance = float(args["distance"])
+        if not route_id or not user_lat or not user_lon or not walking_distance:
+            return 400, {"error": "Missing required parameters"}
+        walking = self.flask_app.extensions["walking_distances"] if args.get("metric") == "walking" else None
+        dedupe = args.get("dedupe", "").lower() in ("1", "true", "yes")
+        accept = parse_accept_header(headers.get("accept"), MIMEAccept)
+        streaming = args.get("stream", "").lower() in ("1", "true", "yes") or \
+            accept.best_match(["application/json", "application/x-ndjson"]) == "application/x-ndjson"
+
+        feed = current_feed(config["GTFS_CACHE_DIR"])
+        if feed is None:
+            return 503, {"error": GTFS_LOADING_ERROR}
+        try:
+            subsequent_stops, error = await asyncio.to_thread(
+                subsequent_route_stops, feed, route_id, branch_letter, user_lat, user_lon
+            )
+            if error:
+                return 404, {"error": error}
+            if not poi_store_imported(config["POI_DB_PATH"]) and not config["POI_OVERPASS_FALLBACK"]:
+                return 503, {"error": "No local POI store has been imported"}
+
+            unique_stops = list(dict.fromkeys(subsequent_stops))
+            local_results = await asyncio.to_thread(local_route_pois, self.flask_app, unique_stops, walking_distance)
+        except Exception as e:
+            print(f"Error: {e}")
+            return 500, {"error": str(e)}
+
+        async def stop_results():
+            """Yield (stop, pois) for every stop as soon as its POIs are known."""
+            if local_results is not None:
+                for result in local_results:
+                    yield result
+                return
+
+            async def lookup(stop):
+                return stop, await fetch_osm_amenities_async(*poi_stop_box(stop))
+
+            tasks = [asyncio.ensure_future(lookup(stop)) for stop in unique_stops]
+            try:
+                for finished in asyncio.as_completed(tasks):
+                    try:
+                        stop, pois = await finished
+                    except Exception as e:
+                        print(f"Error fetching POIs for stop: {e}")
+                        continue
+                    yield stop, filter_pois_for_stop(stop, pois, walking_distance)
+            finally:
+                # A client that hangs up mid-stream leaves no lookups behind
+                for task in tasks:
+                    task.cancel()
+
+        if streaming:
+            stop_positions = {stop: index for index, stop in enumerate(unique_stops)}
+
+            async def generate():
+                seen = set()
+                results = stop_results()
+                try:
+                    async for stop, pois in results:
+                        if walking is not None:
+                            [(_, pois)] = await asyncio.to_thread(
+                                with_walking_distances, walking, walking_distance, [(stop, pois)]
+                            )
+                        yield streamed_stop_line(stop_positions, stop, pois, seen, dedupe)
+                finally:
+                    await results.aclose()
+
+            return 200, generate()
+
+        try:
+            results = [result async for result in stop_results()]
+            if walking is not None:
+                results = await asyncio.to_thread(with_walking_distances, walking, walking_distance, results)
+            return 200, pois_in_riding_order(subsequent_stops, dict(results), dedupe)
+        except Exception as e:
+            print(f"Error: {e}")
+            return 500, {"error": str(e)}
@@ -0,0 +1,40 @@
+import click
+from flask import current_app
+
+from .gtfs_feed import current_feed, refresh_feed
+from .poi_store import import_pois
+from .tiles import MAX_TILE_ZOOM, seed_tiles
+
+
+def register_commands(app):
+    """Attach the maintenance commands to the Flask CLI."""
+
+    @app.cli.command("refresh-gtfs")
+    @click.option("--force", is_flag=True, help="Rebuild even if the feed has not changed.")
+    def refresh_gtfs_command(force):
+        """Download the GTFS feed and swap in a freshly built database."""
+        feed = refresh_feed(
+            current_app.config["GTFS_URL"], current_app.config["GTFS_CACHE_DIR"], force=force, wait=True
+        )
+        if feed:
+            click.echo(f"Current GTFS version: {feed['version']}")
+
+    @app.cli.command("seed-tiles")
+    @click.option("--min-zoom", default=10, show_default=True, help="Lowest zoom level to render.")
+    @click.option("--max-zoom", default=14, show_default=True, help="Highest zoom level to render.")
+    def seed_tiles_command(min_zoom, max_zoom):
+        """Pre-render the route and stop tiles of the current feed."""
+        if not 0 <= min_zoom <= max_zoom <= MAX_TILE_ZOOM:
+            raise click.BadParameter(f"zoom levels must satisfy 0 <= min-zoom <= max-zoom <= {MAX_TILE_ZOOM}")
+        feed = current_feed(current_app.config["GTFS_CACHE_DIR"])
+        if feed is None:
+            raise click.ClickException("No GTFS feed has been built yet; run refresh-gtfs first.")
+        count = seed_tiles(feed, min_zoom, max_zoom)
+        click.echo(f"Seeded {count} tiles for GTFS version {feed['version']}")
+
+    @app.cli.command("import-pois")
+    @click.argument("extract", type=click.Path(exists=True, dir_okay=False))
+    def import_pois_command(extract):
+        """Load amenities from an OSM extract (.osm, .osm.pbf or Overpass JSON) into the local POI store."""
+        count = import_pois(extract, current_app.config["POI_DB_PATH"])
+        click.echo(f"Imported {count} POIs into {current_app.config['POI_DB_PATH']}")
@@ -0,0 +1,534 @@
+from array import array
+from itertools import groupby
+import json
+
+import numpy as np
+
+from .timetable import SCHEDULE_TYPES, get_timetable
+
+SUMMARY_FETCH_SIZE = 100000
+HOUR_SECONDS = 3600
+DAY_SECONDS = 24 * HOUR_SECONDS
+
+# Result columns, in the order the schedule page expects them
+SCHEDULE_TYPE_COLUMNS = ["Reduced", "Holiday", "Saturday", "Sunday", "Weekday"]
+
+FREQUENCY_QUERY = """
+WITH nearby_stops AS (
+    SELECT value AS stop_id FROM json_each(:nearby_stop_ids)
+),
+trip_times AS (
+    SELECT
+        t.route_id,
+        t.branch_letter,
+        st.trip_id,
+        st.stop_id,
+        st.departure_time,
+        st.departure_seconds + CASE WHEN st.departure_seconds < :early_end THEN 86400 ELSE 0 END
+            AS departure_time_seconds,
+        t.schedule_type
+    FROM stop_times st
+    JOIN trips t ON st.trip_id = t.trip_id
+    JOIN nearby_stops ns ON st.stop_id = ns.stop_id
+    WHERE st.departure_seconds IS NOT NULL
+      AND (:service_ids IS NULL OR t.service_id IN (SELECT value FROM json_each(:service_ids)))
+      AND (
+          :window_start IS NULL
+          OR (st.departure_seconds >= :window_start AND st.departure_seconds < :window_end)
+          OR st.departure_seconds < :early_end
+      )
+),
+lagged_times AS (
+    SELECT
+        route_id,
+        branch_letter,
+        schedule_type,
+        departure_time_seconds,
+        departure_time_seconds - LAG(departure_time_seconds) OVER (
+            PARTITION BY route_id, branch_letter, schedule_type ORDER BY departure_time_seconds
+        ) AS frequency_gap
+    FROM trip_times
+),
+frequency_analysis AS (
+    SELECT
+        route_id,
+        branch_letter,
+        schedule_type,
+        COUNT(*) AS total_trips,
+        MIN(departure_time_seconds) AS first_trip,
+        MAX(departure_time_seconds) AS last_trip,
+        AVG(frequency_gap) / 60 AS average_frequency,
+        MIN(frequency_gap) / 60 AS min_frequency_minutes,
+        MAX(frequency_gap) / 60 AS max_frequency_minutes
+    FROM lagged_times
+    GROUP BY route_id, branch_letter, schedule_type
+),
+frequency_flags AS (
+    SELECT
+        route_id,
+        branch_letter,
+        schedule_type,
+        total_trips,
+        first_trip,
+        last_trip,
+        average_frequency,
+        min_frequency_minutes,
+        max_frequency_minutes,
+        CASE
+            WHEN total_trips = 0 THEN 0
+            WHEN total_trips = 1 THEN 1  -- Single trip always red
+            WHEN average_frequency > :frequency_limit THEN 1
+            ELSE 2
+        END AS frequency_flag
+    FROM frequency_analysis
+)
+SELECT
+    route_id,
+    branch_letter,
+    MAX(CASE WHEN schedule_type = 'Reduced' THEN frequency_flag ELSE 0 END) AS reduced,
+    MAX(CASE WHEN schedule_type = 'Holiday' THEN frequency_flag ELSE 0 END) AS holiday,
+    MAX(CASE WHEN schedule_type = 'Saturday' THEN frequency_flag ELSE 0 END) AS saturday,
+    MAX(CASE WHEN schedule_type = 'Sunday' THEN frequency_flag ELSE 0 END) AS sunday,
+    MAX(CASE WHEN schedule_type = 'Weekday' THEN frequency_flag ELSE 0 END) AS weekday,
+    MIN(first_trip) AS first_run_seconds,
+    MAX(last_trip) AS last_run_seconds,
+    MAX(total_trips) AS total_trips,
+    MIN(min_frequency_minutes) AS most_frequent_minutes,
+    MAX(max_frequency_minutes) AS least_frequent_minutes
+FROM frequency_flags
+GROUP BY route_id, branch_letter
+ORDER BY route_id, branch_letter;
+"""
+
+
+def early_end(window):
+    """
+    Where the early-morning part of a window running past midnight ends.
+
+    A (start, end) window of service-day seconds with end past 24:00:00
+    also covers the departures a feed lists on the service day itself
+    before end - 24 hours (00:30:00 rather than 24:30:00). Those count as
+    if a day later, so the night stays one continuous stretch. Returns 0
+    when the window does not run past midnight.
+    """
+    if window is None:
+        return None
+    return max(window[1] - DAY_SECONDS, 0)
+
+
+def sql_frequency_rows(conn, stop_ids, frequency_limit, service_ids=None, window=None):
+    """
+    Run the frequency analysis for the given stops as a single SQL window
+    query, optionally limited to the trips of a set of services and to
+    departures inside a (start, end) window of service-day seconds.
+    """
+    window_start, window_end = window or (None, None)
+    cursor = conn.execute(FREQUENCY_QUERY, {
+        "nearby_stop_ids": json.dumps(list(stop_ids)),
+        "frequency_limit": frequency_limit,
+        "service_ids": json.dumps(sorted(service_ids)) if service_ids is not None else None,
+        "window_start": window_start,
+        "window_end": window_end,
+        "early_end": early_end(window),
+    })
+    return [list(row) for row in cursor.fetchall()]
+
+
+def pack_departures(seconds):
+    """Encode sorted departure seconds as a compact uint32 blob."""
+    return array("I", seconds).tobytes()
+
+
+def unpack_departures(blob):
+    values = array("I")
+    values.frombytes(blob)
+    return values
+
+
+def headway_stats(departures):
+    """Return (min, avg, max) gap in seconds between sorted departures, or Nones."""
+    if len(departures) < 2:
+        return None, None, None
+    gaps = [later - earlier for earlier, later in zip(departures, departures[1:])]
+    return min(gaps), sum(gaps) / len(gaps), max(gaps)
+
+
+def _departures_by_stop(conn):
+    """
+    Yield (stop_id, {(route_id, branch_letter, schedule_type): [departure
+    seconds]}) one stop at a time, so only one stop is held in memory.
+    """
+    cursor = conn.execute("""
+        SELECT st.stop_id, t.route_id, t.branch_letter, t.schedule_type, st.departure_seconds
+        FROM stop_times st
+        JOIN trips t ON st.trip_id = t.trip_id
+        WHERE st.departure_seconds IS NOT NULL
+        ORDER BY st.stop_id
+    """)
+
+    def stop_rows():
+        while True:
+            rows = cursor.fetchmany(SUMMARY_FETCH_SIZE)
+            if not rows:
+                return
+            yield from rows
+
+    for stop_id, rows in groupby(stop_rows(), key=lambda row: row[0]):
+        groups = {}
+        for _, route_id, branch_letter, schedule_type, seconds in rows:
+            groups.setdefault((route_id, branch_letter, schedule_type), []).append(seconds)
+        for departures in groups.values():
+            departures.sort()
+        yield stop_id, groups
+
+
+def build_stop_route_summary(conn, context):
+    """
+    Precompute the departures and headways of every route/branch/schedule
+    type at every stop. Returns the number of summary rows.
+    """
+    conn.execute("DROP TABLE IF EXISTS stop_route_summary")
+    conn.execute("""
+        CREATE TABLE stop_route_summary (
+            stop_id TEXT,
+            route_id TEXT,
+            branch_letter TEXT,
+            schedule_type TEXT,
+            departures BLOB,
+            trip_count INTEGER,
+            first_departure INTEGER,
+            last_departure INTEGER,
+            min_headway INTEGER,
+            avg_headway REAL,
+            max_headway INTEGER
+        )
+    """)
+
+    row_count = 0
+    for stop_id, groups in _departures_by_stop(conn):
+        summary_rows = []
+        for (route_id, branch_letter, schedule_type), departures in groups.items():
+            min_headway, avg_headway, max_headway = headway_stats(departures)
+            summary_rows.append((
+                stop_id, route_id, branch_letter, schedule_type, pack_departures(departures),
+                len(departures), departures[0], departures[-1], min_headway, avg_headway, max_headway,
+            ))
+        conn.executemany("INSERT INTO stop_route_summary VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", summary_rows)
+        row_count += len(summary_rows)
+
+    conn.execute("CREATE INDEX idx_stop_route_summary_stop_id ON stop_route_summary (stop_id)")
+    return row_count
+
+
+def build_headway_cube(conn, context):
+    """
+    Precompute trip counts and headways of every stop/route/branch/schedule
+    type per hour of the service day, so a time window is answered from a
+    handful of buckets. Returns the number of cube rows.
+    """
+    conn.execute("DROP TABLE IF EXISTS headway_cube")
+    conn.execute("""
+        CREATE TABLE headway_cube (
+            stop_id TEXT,
+            route_id TEXT,
+            branch_letter TEXT,
+            schedule_type TEXT,
+            hour INTEGER,
+            departures BLOB,
+            trip_count INTEGER,
+            first_departure INTEGER,
+            last_departure INTEGER,
+            min_headway INTEGER,
+            max_headway INTEGER
+        )
+    """)
+
+    row_count = 0
+    for stop_id, groups in _departures_by_stop(conn):
+        cube_rows = []
+        for (route_id, branch_letter, schedule_type), departures in groups.items():
+            for hour, bucket in groupby(departures, key=lambda seconds: seconds // HOUR_SECONDS):
+                bucket = list(bucket)
+                min_headway, _, max_headway = headway_stats(bucket)
+                cube_rows.append((
+                    stop_id, route_id, branch_letter, schedule_type, hour, pack_departures(bucket),
+                    len(bucket), bucket[0], bucket[-1], min_headway, max_headway,
+                ))
+        conn.executemany("INSERT INTO headway_cube VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", cube_rows)
+        row_count += len(cube_rows)
+
+    conn.execute("CREATE INDEX idx_headway_cube_stop_id_hour ON headway_cube (stop_id, hour)")
+    return row_count
+
+
+def _flag(total_trips, average_frequency, frequency_limit):
+    if total_trips == 0:
+        return 0
+    if total_trips == 1:
+        return 1  # Single trip always red
+    if average_frequency > frequency_limit:
+        return 1
+    return 2
+
+
+def frequency_rows_from_groups(groups, frequency_limit):
+    """
+    Turn {(route_id, branch_letter, schedule_type): (trip count, first, last,
+    min gap, avg gap, max gap)} into the rows the schedule page expects,
+    matching the SQL frequency query column for column.
+    """
+    by_route = {}
+    for (route_id, branch_letter, schedule_type), stats in groups.items():
+        total_trips, first_trip, last_trip, min_gap, avg_gap, max_gap = stats
+        average_frequency = avg_gap / 60 if avg_gap is not None else None
+        by_route.setdefault((route_id, branch_letter), []).append((
+            schedule_type,
+            total_trips,
+            first_trip,
+            last_trip,
+            # Whole minutes, like the integer division in SQL
+            min_gap // 60 if min_gap is not None else None,
+            max_gap // 60 if max_gap is not None else None,
+            _flag(total_trips, average_frequency, frequency_limit),
+        ))
+
+    results = []
+    for (route_id, branch_letter), entries in by_route.items():
+        flags = {schedule_type: 0 for schedule_type in SCHEDULE_TYPE_COLUMNS}
+        for schedule_type, *_, flag in entries:
+            flags[schedule_type] = max(flags.get(schedule_type, 0), flag)
+        min_minutes = [entry[4] for entry in entries if entry[4] is not None]
+        max_minutes = [entry[5] for entry in entries if entry[5] is not None]
+        results.append([
+            route_id,
+            branch_letter,
+            *(flags[schedule_type] for schedule_type in SCHEDULE_TYPE_COLUMNS),
+            min(entry[2] for entry in entries),
+            max(entry[3] for entry in entries),
+            max(entry[1] for entry in entries),
+            min(min_minutes) if min_minutes else None,
+            max(max_minutes) if max_minutes else None,
+        ])
+
+    # SQLite sorts NULL before any text
+    results.sort(key=lambda row: (row[0] is not None, row[0] or "", row[1] is not None, row[1] or ""))
+    return results
+
+
+def summary_frequency_rows(conn, stop_ids, frequency_limit, service_ids=None, window=None):
+    """
+    Answer the frequency analysis from the precomputed stop_route_summary
+    rows of the given stops, merging their departures per route/branch/
+    schedule type. Time windows are answered from the hourly headway cube.
+    The summaries cover every service, so a set of services is answered by
+    the SQL window query.
+    """
+    if service_ids is not None:
+        return sql_frequency_rows(conn, stop_ids, frequency_limit, service_ids, window)
+    if window is not None:
+        return cube_frequency_rows(conn, stop_ids, frequency_limit, service_ids, window)
+
+    cursor = conn.execute("""
+        SELECT route_id, branch_letter, schedule_type, departures,
+               trip_count, first_departure, last_departure, min_headway, avg_headway, max_headway
+        FROM stop_route_summary
+        WHERE stop_id IN (SELECT value FROM json_each(:stop_ids))
+    """, {"stop_ids": json.dumps(list(stop_ids))})
+
+    summaries = {}
+    for route_id, branch_letter, schedule_type, departures, *stats in cursor:
+        summaries.setdefault((route_id, branch_letter, schedule_type), []).append((departures, stats))
+
+    groups = {}
+    for key, entries in summaries.items():
+        if len(entries) == 1:
+            # Only one stop serves this group, its stored stats are the answer
+            groups[key] = tuple(entries[0][1])
+            continue
+        departures = sorted(value for blob, _ in entries for value in unpack_departures(blob))
+        groups[key] = (len(departures), departures[0], departures[-1], *headway_stats(departures))
+    return frequency_rows_from_groups(groups, frequency_limit)
+
+
+def combine_buckets(buckets):
+    """
+    Combine the (trip count, first, last, min gap, max gap) hour buckets of
+    one stop, in hour order, into (trip count, first, last, min gap, avg gap,
+    max gap). The gap between two buckets is the first departure of the later
+    one minus the last of the earlier one, and the gaps always add up to last
+    minus first.
+    """
+    trip_count = sum(bucket[0] for bucket in buckets)
+    first, last = buckets[0][1], buckets[-1][2]
+    if trip_count < 2:
+        return trip_count, first, last, None, None, None
+    gaps = [later[1] - earlier[2] for earlier, later in zip(buckets, buckets[1:])]
+    gaps += [bucket[3] for bucket in buckets if bucket[3] is not None]
+    gaps += [bucket[4] for bucket in buckets if bucket[4] is not None]
+    return trip_count, first, last, min(gaps), (last - first) / (trip_count - 1), max(gaps)
+
+
+def cube_frequency_rows(conn, stop_ids, frequency_limit, service_ids=None, window=None):
+    """
+    Answer the frequency analysis for departures inside a (start, end) window
+    of service-day seconds from the hourly headway cube. Buckets of a single
+    stop combine from their stored stats; when several stops serve the same
+    route/branch/schedule type, the departures of the buckets are merged.
+    Like the summary, the cube covers every service.
+    """
+    if service_ids is not None:
+        return sql_frequency_rows(conn, stop_ids, frequency_limit, service_ids, window)
+    window_start, window_end = window
+    rows = conn.execute("""
+        SELECT stop_id, route_id, branch_letter, schedule_type, hour, departures,
+               trip_count, first_departure, last_departure, min_headway, max_headway
+        FROM headway_cube
+        WHERE stop_id IN (SELECT value FROM json_each(:stop_ids))
+          AND (hour BETWEEN :first_hour AND :last_hour OR hour * 3600 < :early_end)
+    """, {
+        "stop_ids": json.dumps(list(stop_ids)),
+        "first_hour": window_start // HOUR_SECONDS,
+        "last_hour": (window_end - 1) // HOUR_SECONDS,
+        "early_end": early_end(window),
+    }).fetchall()
+
+    shifted = []
+    for stop_id, route_id, branch_letter, schedule_type, hour, departures, *stats in rows:
+        if hour * HOUR_SECONDS < window_start:
+            # Early-morning bucket of a window running past midnight
+            hour += 24
+            departures = pack_departures([value + DAY_SECONDS for value in unpack_departures(departures)])
+            stats[1] += DAY_SECONDS
+            stats[2] += DAY_SECONDS
+        shifted.append((stop_id, route_id, branch_letter, schedule_type, hour, departures, *stats))
+    shifted.sort(key=lambda row: row[4])
+
+    cubes = {}
+    for stop_id, route_id, branch_letter, schedule_type, hour, departures, *stats in shifted:
+        if hour * HOUR_SECONDS < window_start or (hour + 1) * HOUR_SECONDS > window_end:
+            # The window cuts through this bucket, keep only its departures inside
+            departures = [value for value in unpack_departures(departures) if window_start <= value < window_end]
+            if not departures:
+                continue
+            min_headway, _, max_headway = headway_stats(departures)
+            stats = [len(departures), departures[0], departures[-1], min_headway, max_headway]
+            departures = pack_departures(departures)
+        stops = cubes.setdefault((route_id, branch_letter, schedule_type), {})
+        stops.setdefault(stop_id, []).append((departures, stats))
+
+    groups = {}
+    for key, stops in cubes.items():
+        if len(stops) == 1:
+            buckets = [stats for _, stats in next(iter(stops.values()))]
+            # An early-morning bucket moved past midnight can overlap the
+            # stop's own after-midnight one; those are merged below
+            if all(later[1] >= earlier[2] for earlier, later in zip(buckets, buckets[1:])):
+                groups[key] = combine_buckets(buckets)
+                continue
+        departures = sorted(
+            value for buckets in stops.values() for blob, _ in buckets for value in unpack_departures(blob)
+        )
+        groups[key] = (len(departures), departures[0], departures[-1], *headway_stats(departures))
+    return frequency_rows_from_groups(groups, frequency_limit)
+
+
+def numpy_frequency_rows(conn, stop_ids, frequency_limit, service_ids=None, window=None):
+    """
+    Answer the frequency analysis from the memory-mapped timetable: sort the
+    departures once by group and time, take np.diff, and reduce each group
+    with reduceat.
+    """
+    timetable = get_timetable(database_path(conn))
+    if timetable is None:
+        raise LookupError("No timetable snapshot for this feed")
+
+    seconds, trips = timetable.departures_at(stop_ids)
+    routes = timetable.trip_route[trips]
+    branches = timetable.trip_branch[trips]
+    schedules = timetable.trip_schedule[trips]
+    if service_ids is not None:
+        codes = [code for code, service_id in enumerate(timetable.service_ids.tolist()) if service_id in service_ids]
+        keep = np.isin(timetable.trip_service[trips], codes)
+        seconds, routes, branches, schedules = seconds[keep], routes[keep], branches[keep], schedules[keep]
+    if window is not None:
+        seconds = seconds.astype(np.int64)
+        seconds = np.where(seconds < early_end(window), seconds + DAY_SECONDS, seconds)
+        keep = (seconds >= window[0]) & (seconds < window[1])
+        seconds, routes, branches, schedules = seconds[keep], routes[keep], branches[keep], schedules[keep]
+    if not len(seconds):
+        return []
+
+    # One integer key per (route, branch, schedule type)
+    n_branches = len(timetable.branch_letters)
+    n_schedules = len(SCHEDULE_TYPES)
+    keys = (routes.astype(np.int64) * n_branches + branches) * n_schedules + schedules
+    order = np.lexsort((seconds, keys))
+    keys = keys[order]
+    seconds = seconds[order].astype(np.int64)
+
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = np.diff(np.r_[starts, len(keys)])
+    lasts = starts + counts - 1
+
+    # gaps[i] is the gap before departure i; the first departure of each
+    # group has no gap, so it gets the neutral value of each reduction
+    gaps = np.r_[0, np.diff(seconds)]
+    group_start = np.zeros(len(keys), dtype=bool)
+    group_start[starts] = True
+    gap_sums = np.add.reduceat(np.where(group_start, 0, gaps), starts)
+    gap_mins = np.minimum.reduceat(np.where(group_start, np.iinfo(np.int64).max, gaps), starts)
+    gap_maxes = np.maximum.reduceat(np.where(group_start, -1, gaps), starts)
+
+    groups = {}
+    group_keys = keys[starts]
+    for i, key in enumerate(group_keys.tolist()):
+        route_branch, schedule = divmod(key, n_schedules)
+        route, branch = divmod(route_branch, n_branches)
+        count = int(counts[i])
+        if count > 1:
+            stats = (int(gap_mins[i]), int(gap_sums[i]) / (count - 1), int(gap_maxes[i]))
+        else:
+            stats = (None, None, None)
+        groups[(
+            str(timetable.route_ids[route]),
+            str(timetable.branch_letters[branch]) or None,
+            SCHEDULE_TYPES[schedule],
+        )] = (count, int(seconds[starts[i]]), int(seconds[lasts[i]]), *stats)
+    return frequency_rows_from_groups(groups, frequency_limit)
+
+
+def database_path(conn):
+    """File path of the main database behind a connection."""
+    return conn.execute("PRAGMA database_list").fetchone()[2]
+
+
+def has_table(conn, table_name):
+    """Check whether a feed database has a (derived) table."""
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?", (table_name,)
+    ).fetchone()
+    return row is not None
+
+
+FREQUENCY_BACKENDS = {
+    "sql": sql_frequency_rows,
+    "summary": summary_frequency_rows,
+    "numpy": numpy_frequency_rows,
+}
+
+
+def frequency_rows(conn, stop_ids, frequency_limit, service_ids=None, backend="summary", window=None):
+    """
+    Run the frequency analysis with the chosen backend, optionally only over
+    the trips of a set of services (those running on a date) and departures
+    inside a (start, end) window of service-day seconds. Every
+    backend returns identical rows; when the artifact a backend needs is
+    missing from the feed database, the SQL window query answers instead.
+    """
+    if backend not in FREQUENCY_BACKENDS:
+        raise ValueError(f"Unknown frequency backend: {backend}")
+    if backend == "summary" and not has_table(conn, "headway_cube" if window else "stop_route_summary"):
+        backend = "sql"
+    if backend == "numpy" and get_timetable(database_path(conn)) is None:
+        backend = "sql"
+    return FREQUENCY_BACKENDS[backend](conn, stop_ids, frequency_limit, service_ids, window)
@@ -0,0 +1,367 @@
+from datetime import datetime
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import zipfile
+
+import requests
+
+from .gtfs_loader import DERIVED_ARTIFACTS, build_signature, load_gtfs_to_sql, snapshot_outputs
+from .stop_index import stop_index
+
+POINTER_FILENAME = "gtfs_current.json"
+LOCK_FILENAME = "gtfs_refresh.lock"
+DOWNLOAD_FILENAME = "gtfs.zip.download"
+PARTIAL_FILENAME = "gtfs.zip.part"
+METADATA_FILENAME = "gtfs_feed_metadata.json"
+# The app cannot work without these members
+REQUIRED_MEMBERS = {"stops.txt", "trips.txt", "stop_times.txt"}
+# Read in modest chunks (little is lost if the connection drops) but write
+# through a large buffer
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+
+_pointer_cache = {"key": None, "feed": None}
+_pointer_lock = threading.Lock()
+_refresher_lock = threading.Lock()
+
+
+def _pointer_path(cache_dir):
+    return os.path.join(cache_dir, POINTER_FILENAME)
+
+
+def current_feed(cache_dir):
+    """
+    Return the feed that is currently being served, or None if no feed has
+    been built yet.
+
+    The pointer file is re-read only when it changes on disk.
+    """
+    pointer_path = _pointer_path(cache_dir)
+    try:
+        stat = os.stat(pointer_path)
+    except FileNotFoundError:
+        return None
+
+    key = (pointer_path, stat.st_mtime_ns, stat.st_ino)
+    with _pointer_lock:
+        if _pointer_cache["key"] != key:
+            with open(pointer_path) as f:
+                _pointer_cache["feed"] = json.load(f)
+            _pointer_cache["key"] = key
+        return _pointer_cache["feed"]
+
+
+def _write_json_atomic(path, data):
+    """Write JSON next to the destination and rename it into place."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_feed_metadata(cache_dir):
+    """Return the stored upstream metadata (ETag, Last-Modified, size, sha256) for the feed."""
+    try:
+        with open(os.path.join(cache_dir, METADATA_FILENAME)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _read_partial_metadata(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, PARTIAL_FILENAME + ".json")) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _discard_partial(cache_dir):
+    for name in (PARTIAL_FILENAME, PARTIAL_FILENAME + ".json"):
+        path = os.path.join(cache_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def verify_gtfs_zip(zip_path, expected_size=None):
+    """
+    Check a downloaded zip before it is used: size, archive integrity and
+    the files the app depends on. Returns its sha256, or raises ValueError.
+    """
+    size = os.path.getsize(zip_path)
+    if expected_size is not None and size != expected_size:
+        raise ValueError(f"GTFS download is {size} bytes, expected {expected_size}")
+    try:
+        with zipfile.ZipFile(zip_path) as zip_ref:
+            bad_member = zip_ref.testzip()
+            names = {name.rsplit("/", 1)[-1] for name in zip_ref.namelist()}
+    except zipfile.BadZipFile as e:
+        raise ValueError(f"GTFS download is not a valid zip: {e}")
+    if bad_member is not None:
+        raise ValueError(f"GTFS download has a corrupt member: {bad_member}")
+    missing = REQUIRED_MEMBERS - names
+    if missing:
+        raise ValueError(f"GTFS download is missing {', '.join(sorted(missing))}")
+    return _file_sha256(zip_path)
+
+
+def download_gtfs_file(gtfs_url, cache_dir, metadata=None):
+    """
+    Fetch the GTFS zip if it changed upstream.
+
+    Uses a conditional GET against the stored ETag/Last-Modified, resumes an
+    interrupted download with a Range request, and verifies the result.
+    Returns (zip_path, metadata), or (None, metadata) when not modified.
+    """
+    metadata = metadata or {}
+    partial_path = os.path.join(cache_dir, PARTIAL_FILENAME)
+    partial = _read_partial_metadata(cache_dir) if os.path.exists(partial_path) else None
+    offset = os.path.getsize(partial_path) if partial else 0
+
+    headers = {}
+    if partial and offset and (partial.get("etag") or partial.get("last_modified")):
+        # Resume the interrupted download only if it is still the same file
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = partial.get("etag") or partial["last_modified"]
+    else:
+        offset = 0
+        if metadata.get("etag"):
+            headers["If-None-Match"] = metadata["etag"]
+        if metadata.get("last_modified"):
+            headers["If-Modified-Since"] = metadata["last_modified"]
+
+    with requests.get(gtfs_url, headers=headers, stream=True, timeout=(10, 60)) as response:
+        if response.status_code == 304:
+            return None, metadata
+        if response.status_code == 416:
+            # Our partial file no longer matches anything upstream has
+            _discard_partial(cache_dir)
+            return download_gtfs_file(gtfs_url, cache_dir, metadata)
+        response.raise_for_status()
+
+        if response.status_code == 206:
+            print(f"Resuming GTFS download at byte {offset}.")
+            mode = "ab"
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            expected_size = int(total) if total.isdigit() else None
+        else:
+            mode = "wb"
+            expected_size = None
+            if "Content-Length" in response.headers and not response.headers.get("Content-Encoding"):
+                expected_size = int(response.headers["Content-Length"])
+            partial = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "size": expected_size,
+            }
+            _write_json_atomic(os.path.join(cache_dir, PARTIAL_FILENAME + ".json"), partial)
+
+        with open(partial_path, mode, buffering=WRITE_BUFFER_SIZE) as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+
+    try:
+        sha256 = verify_gtfs_zip(partial_path, expected_size or partial.get("size"))
+    except ValueError:
+        _discard_partial(cache_dir)
+        raise
+
+    download_path = os.path.join(cache_dir, DOWNLOAD_FILENAME)
+    os.replace(partial_path, download_path)
+    _discard_partial(cache_dir)
+    return download_path, {
+        "etag": partial.get("etag"),
+        "last_modified": partial.get("last_modified"),
+        "size": os.path.getsize(download_path),
+        "sha256": sha256,
+        "downloaded_at": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def _remove_old_versions(cache_dir, keep):
+    """Delete built versions, their tile caches and the snapshots they alone used, once no longer current or previous."""
+    for name in os.listdir(cache_dir):
+        if not name.startswith("gtfs-"):
+            continue
+        version = name[len("gtfs-"):].split(".", 1)[0]
+        if version in keep:
+            continue
+        try:
+            os.remove(os.path.join(cache_dir, name))
+            print(f"Removed old GTFS version file {name}.")
+        except OSError as e:
+            print(f"Could not remove old GTFS version file {name}: {e}")
+
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith("tiles-") and name[len("tiles-"):] not in keep and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+            print(f"Removed old GTFS tile cache {name}.")
+
+    referenced = set()
+    for version in keep:
+        referenced.update(snapshot_outputs(os.path.join(cache_dir, f"gtfs-{version}.db")).values())
+    prefixes = tuple(f"{artifact['name']}-" for artifact in DERIVED_ARTIFACTS if artifact["kind"] == "snapshot")
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith(prefixes) and os.path.isdir(path) and path not in referenced:
+            shutil.rmtree(path, ignore_errors=True)
+            print(f"Removed old GTFS snapshot {name}.")
+
+
+def install_feed(zip_path, cache_dir, metadata=None):
+    """
+    Build a downloaded GTFS zip into its own database and make it current.
+
+    The new database is built under a temporary name and renamed into
+    place before the version pointer is swapped, so readers always see
+    either the complete old version or the complete new one.
+    """
+    metadata = metadata or {}
+    sha256 = metadata.get("sha256") or _file_sha256(zip_path)
+    version = datetime.now().strftime("%Y%m%d%H%M%S") + "-" + sha256[:12]
+
+    signature = build_signature()
+    previous = current_feed(cache_dir)
+    if previous and previous.get("sha256") == sha256 and previous.get("build_signature") == signature:
+        print("Downloaded GTFS file matches the current feed. Skipping reload.")
+        os.remove(zip_path)
+        return previous
+
+    final_zip_path = os.path.join(cache_dir, f"gtfs-{version}.zip")
+    db_path = os.path.join(cache_dir, f"gtfs-{version}.db")
+    building_path = f"{db_path}.building"
+    if os.path.exists(building_path):
+        os.remove(building_path)
+
+    os.replace(zip_path, final_zip_path)
+    try:
+        # Start from the previous build so unchanged tables are reused
+        base_db_path = previous["db_path"] if previous else None
+        load_gtfs_to_sql(final_zip_path, building_path, base_db_path=base_db_path)
+    except Exception:
+        for path in (building_path, final_zip_path):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    os.replace(building_path, db_path)
+
+    feed = {
+        "version": version,
+        "sha256": sha256,
+        "db_path": db_path,
+        "zip_path": final_zip_path,
+        "etag": metadata.get("etag"),
+        "last_modified": metadata.get("last_modified"),
+        "build_signature": signature,
+        "loaded_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    _write_json_atomic(_pointer_path(cache_dir), feed)
+    print(f"GTFS feed version {version} is now current.")
+
+    # Keep the previous version for readers that opened it before the swap
+    keep = {version}
+    if previous:
+        keep.add(previous["version"])
+    _remove_old_versions(cache_dir, keep)
+    return feed
+
+
+def refresh_feed(gtfs_url, cache_dir, force=False, wait=False):
+    """
+    Check the upstream feed and install it if it changed.
+
+    Only one process refreshes at a time; others return immediately and
+    keep serving the current version, or with wait=True wait for the
+    refresh in progress and then check again. Returns the current feed.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, LOCK_FILENAME), "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if not wait:
+                print("Another worker is refreshing the GTFS feed.")
+                return current_feed(cache_dir)
+            print("Another worker is refreshing the GTFS feed. Waiting for it to finish.")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        feed = current_feed(cache_dir)
+        # Without a current feed there is nothing to compare against
+        metadata = read_feed_metadata(cache_dir) if feed and not force else {}
+        zip_path, new_metadata = download_gtfs_file(gtfs_url, cache_dir, metadata)
+        if zip_path is None and feed is None:
+            # Not modified, yet there is nothing installed to keep serving
+            # (a caching proxy can answer 304 to a plain GET); fetch it all
+            print("GTFS file not modified but no feed is installed. Downloading it again.")
+            _discard_partial(cache_dir)
+            zip_path, new_metadata = download_gtfs_file(gtfs_url, cache_dir)
+            if zip_path is None:
+                raise ValueError("GTFS server answered 304 Not Modified with no feed installed")
+        new_metadata["checked_at"] = datetime.now().isoformat(timespec="seconds")
+        if zip_path is None:
+            print("GTFS file not modified.")
+            _write_json_atomic(os.path.join(cache_dir, METADATA_FILENAME), new_metadata)
+            if feed.get("build_signature") == build_signature():
+                return feed
+            # The loader changed since this feed was built; rebuild it from
+            # the zip we already have
+            print("GTFS build is out of date. Rebuilding current feed.")
+            zip_path = os.path.join(cache_dir, DOWNLOAD_FILENAME)
+            shutil.copyfile(feed["zip_path"], zip_path)
+        else:
+            print(f"Downloaded GTFS file ({new_metadata['size']} bytes, sha256 {new_metadata['sha256'][:12]}).")
+
+        feed = install_feed(zip_path, cache_dir, new_metadata)
+        _write_json_atomic(os.path.join(cache_dir, METADATA_FILENAME), new_metadata)
+        return feed
+
+
+def _refresh_loop(gtfs_url, cache_dir, interval):
+    while True:
+        try:
+            feed = refresh_feed(gtfs_url, cache_dir)
+            if feed is not None:
+                # Index a new version here rather than in the first request to need it
+                stop_index(feed)
+        except Exception as e:
+            print(f"Error refreshing GTFS feed: {e}")
+        time.sleep(interval)
+
+
+def start_refresher(app):
+    """
+    Start the background GTFS refresh thread for this app, unless it is
+    already running. Called once the app serves requests, so CLI commands
+    that only build the app never start it.
+    """
+    interval = app.config.get("GTFS_REFRESH_INTERVAL", 0)
+    if not interval or interval <= 0:
+        return None
+
+    with _refresher_lock:
+        thread = app.extensions.get("gtfs_refresher")
+        if thread is None:
+            thread = app.extensions["gtfs_refresher"] = threading.Thread(
+                target=_refresh_loop,
+                args=(app.config["GTFS_URL"], app.config["GTFS_CACHE_DIR"], interval),
+                name="gtfs-refresher",
+                daemon=True,
+            )
+            thread.start()
+        return thread
@@ -0,0 +1,496 @@
+from datetime import datetime
+import csv
+import hashlib
+import io
+import os
+import sqlite3
+import time
+import zipfile
+
+from .frequency import build_headway_cube, build_stop_route_summary
+from .patterns import build_route_patterns
+from .service_calendar import build_service_calendar
+from .shapes import build_route_shapes
+from .spatial import build_stops_rtree
+from .timetable import build_timetable_snapshot
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Rows are inserted in batches of this size so memory stays bounded
+# no matter how large stop_times.txt gets.
+BATCH_SIZE = 50000
+
+# Explicit column types for every GTFS file we load. Columns that appear in a
+# feed but are not listed here are still loaded, as TEXT.
+GTFS_SCHEMA = {
+    "agency": [
+        ("agency_id", "TEXT"),
+        ("agency_name", "TEXT"),
+        ("agency_url", "TEXT"),
+        ("agency_timezone", "TEXT"),
+        ("agency_lang", "TEXT"),
+        ("agency_phone", "TEXT"),
+        ("agency_fare_url", "TEXT"),
+    ],
+    "stops": [
+        ("stop_id", "TEXT PRIMARY KEY"),
+        ("stop_code", "TEXT"),
+        ("stop_name", "TEXT"),
+        ("stop_desc", "TEXT"),
+        ("stop_lat", "REAL"),
+        ("stop_lon", "REAL"),
+        ("zone_id", "TEXT"),
+        ("stop_url", "TEXT"),
+        ("location_type", "INTEGER"),
+        ("parent_station", "TEXT"),
+        ("wheelchair_boarding", "INTEGER"),
+    ],
+    "routes": [
+        ("route_id", "TEXT PRIMARY KEY"),
+        ("agency_id", "TEXT"),
+        ("route_short_name", "TEXT"),
+        ("route_long_name", "TEXT"),
+        ("route_desc", "TEXT"),
+        ("route_type", "INTEGER"),
+        ("route_url", "TEXT"),
+        ("route_color", "TEXT"),
+        ("route_text_color", "TEXT"),
+        ("route_sort_order", "INTEGER"),
+    ],
+    "trips": [
+        ("route_id", "TEXT"),
+        ("service_id", "TEXT"),
+        ("trip_id", "TEXT PRIMARY KEY"),
+        ("trip_headsign", "TEXT"),
+        ("direction_id", "INTEGER"),
+        ("block_id", "TEXT"),
+        ("shape_id", "TEXT"),
+        ("wheelchair_accessible", "INTEGER"),
+        ("bikes_allowed", "INTEGER"),
+        ("branch_letter", "TEXT"),
+    ],
+    "stop_times": [
+        ("trip_id", "TEXT"),
+        ("arrival_time", "TEXT"),
+        ("departure_time", "TEXT"),
+        ("stop_id", "TEXT"),
+        ("stop_sequence", "INTEGER"),
+        ("stop_headsign", "TEXT"),
+        ("pickup_type", "INTEGER"),
+        ("drop_off_type", "INTEGER"),
+        ("shape_dist_traveled", "REAL"),
+        ("timepoint", "INTEGER"),
+    ],
+    "calendar": [
+        ("service_id", "TEXT PRIMARY KEY"),
+        ("monday", "INTEGER"),
+        ("tuesday", "INTEGER"),
+        ("wednesday", "INTEGER"),
+        ("thursday", "INTEGER"),
+        ("friday", "INTEGER"),
+        ("saturday", "INTEGER"),
+        ("sunday", "INTEGER"),
+        ("start_date", "TEXT"),
+        ("end_date", "TEXT"),
+    ],
+    "calendar_dates": [
+        ("service_id", "TEXT"),
+        ("date", "TEXT"),
+        ("exception_type", "INTEGER"),
+    ],
+    "shapes": [
+        ("shape_id", "TEXT"),
+        ("shape_pt_lat", "REAL"),
+        ("shape_pt_lon", "REAL"),
+        ("shape_pt_sequence", "INTEGER"),
+        ("shape_dist_traveled", "REAL"),
+    ],
+}
+
+# Integer seconds-since-midnight columns stored next to the raw HH:MM:SS
+# strings: (table, derived column, source column).
+SECONDS_COLUMNS = [
+    ("stop_times", "arrival_seconds", "arrival_time"),
+    ("stop_times", "departure_seconds", "departure_time"),
+]
+
+# Bump when the loader changes in a way that requires every table to be
+# reloaded even though the feed files did not change.
+LOADER_VERSION = 1
+
+# Indexes built after each table has been bulk loaded.
+GTFS_INDEXES = {
+    "stop_times": [
+        ("idx_stop_times_stop_id", "stop_id"),
+        ("idx_stop_times_trip_id", "trip_id"),
+    ],
+    "trips": [
+        ("idx_trips_route_branch", "route_id, branch_letter"),
+        ("idx_trips_shape_id", "shape_id"),
+    ],
+    "shapes": [
+        ("idx_shapes_shape_seq", "shape_id, shape_pt_sequence"),
+    ],
+    "calendar_dates": [
+        ("idx_calendar_dates_service_id", "service_id"),
+    ],
+}
+
+
+def gtfs_time_to_seconds(time_str):
+    """Convert a GTFS 'HH:MM:SS' time (hours may exceed 23) to seconds since midnight."""
+    if not time_str:
+        return None
+    hours, minutes, seconds = time_str.strip().split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def _converter(sql_type):
+    """Return a function converting a raw CSV string into the column's Python type."""
+    base_type = sql_type.split()[0]
+    if base_type == "INTEGER":
+        return lambda value: int(float(value)) if value != "" else None
+    if base_type == "REAL":
+        return lambda value: float(value) if value != "" else None
+    return lambda value: value if value != "" else None
+
+
+def peak_memory_mb():
+    """Peak resident memory of this process in megabytes, or None if unknown."""
+    if resource is None:
+        return None
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load_table(conn, zip_ref, member, table_name):
+    """
+    Stream one GTFS member file from the zip into a freshly created table.
+
+    Returns the number of rows loaded.
+    """
+    schema = GTFS_SCHEMA[table_name]
+    derived = [(column, source) for table, column, source in SECONDS_COLUMNS if table == table_name]
+
+    with zip_ref.open(member) as raw:
+        reader = csv.reader(io.TextIOWrapper(raw, encoding="utf-8-sig", newline=""))
+        header = [column.strip() for column in next(reader, [])]
+
+        # Known columns keep their declared type, anything else is TEXT
+        declared = dict(schema)
+        columns = [(name, sql_type) for name, sql_type in schema]
+        columns += [(name, "TEXT") for name in header if name not in declared]
+        columns += [(column, "INTEGER") for column, _ in derived]
+
+        cursor = conn.cursor()
+        cursor.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+        column_sql = ", ".join(f'"{name}" {sql_type}' for name, sql_type in columns)
+        cursor.execute(f'CREATE TABLE "{table_name}" ({column_sql})')
+
+        # Only insert the columns the file actually provides
+        positions = [header.index(name) for name, _ in columns if name in header]
+        insert_names = [header[i] for i in positions]
+        converters = [_converter(declared.get(name, "TEXT")) for name in insert_names]
+        derived_positions = [header.index(source) if source in header else None for _, source in derived]
+        insert_names += [column for column, _ in derived]
+
+        insert_sql = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+            table_name,
+            ", ".join(f'"{name}"' for name in insert_names),
+            ", ".join("?" for _ in insert_names),
+        )
+
+        row_count = 0
+        batch = []
+        for row in reader:
+            if not row:
+                continue
+            values = [convert(row[i]) if i < len(row) else None for convert, i in zip(converters, positions)]
+            for i in derived_positions:
+                values.append(gtfs_time_to_seconds(row[i]) if i is not None and i < len(row) else None)
+            batch.append(values)
+            if len(batch) >= BATCH_SIZE:
+                cursor.executemany(insert_sql, batch)
+                row_count += len(batch)
+                batch = []
+        if batch:
+            cursor.executemany(insert_sql, batch)
+            row_count += len(batch)
+
+    return row_count
+
+
+def build_index(conn, table_name, index_name, columns):
+    """Create one lookup index on a loaded table."""
+    conn.execute(f'DROP INDEX IF EXISTS "{index_name}"')
+    conn.execute(f'CREATE INDEX "{index_name}" ON "{table_name}" ({columns})')
+
+
+def _index_artifacts():
+    """Describe every GTFS index as a derived artifact of its table."""
+    artifacts = []
+    for table_name, indexes in GTFS_INDEXES.items():
+        for index_name, columns in indexes:
+            artifacts.append({
+                "name": f"index:{index_name}",
+                "kind": "index",
+                "inputs": [table_name],
+                "version": columns,
+                "build": lambda conn, context, t=table_name, i=index_name, c=columns: build_index(conn, t, i, c),
+            })
+    return artifacts
+
+
+# Artifacts derived from the loaded tables, in build order. Each one is
+# rebuilt only when the hash of its inputs (tables or earlier artifacts)
+# or its version changes. A build function receives the connection and a
+# context dict with "db_path" and "input_hash", and may return a row count.
+# Tables listed in "optional_inputs" count towards the hash when present.
+# "snapshot" artifacts write files instead of tables; they also get an
+# "output_dir" named after their input hash, shared by every feed version
+# that has the same inputs. "tables" are the tables an artifact creates,
+# dropped when a feed lacks its inputs.
+DERIVED_ARTIFACTS = _index_artifacts() + [
+    {
+        "name": "stops_rtree",
+        "kind": "index",
+        "inputs": ["stops"],
+        "version": 1,
+        "tables": ["stops_rtree"],
+        "build": build_stops_rtree,
+    },
+    {
+        "name": "service_calendar",
+        "kind": "summary",
+        "inputs": ["trips"],
+        "optional_inputs": ["calendar", "calendar_dates"],
+        "version": 3,
+        "tables": ["service_calendar"],
+        "build": build_service_calendar,
+    },
+    {
+        "name": "timetable",
+        "kind": "snapshot",
+        "inputs": ["stops", "trips", "stop_times", "service_calendar"],
+        "version": 3,
+        "build": build_timetable_snapshot,
+    },
+    {
+        "name": "stop_route_summary",
+        "kind": "summary",
+        "inputs": ["trips", "stop_times", "service_calendar"],
+        "version": 2,
+        "tables": ["stop_route_summary"],
+        "build": build_stop_route_summary,
+    },
+    {
+        "name": "headway_cube",
+        "kind": "summary",
+        "inputs": ["trips", "stop_times", "service_calendar"],
+        "version": 1,
+        "tables": ["headway_cube"],
+        "build": build_headway_cube,
+    },
+    {
+        "name": "route_shapes",
+        "kind": "summary",
+        "inputs": ["trips", "shapes"],
+        "version": 2,
+        "tables": ["route_shapes", "shape_geometries", "shape_bounds", "shapes_rtree"],
+        "build": build_route_shapes,
+    },
+    {
+        "name": "route_patterns",
+        "kind": "summary",
+        "inputs": ["trips", "stop_times"],
+        "version": 1,
+        "tables": ["route_patterns", "pattern_stops", "trip_patterns"],
+        "build": build_route_patterns,
+    },
+]
+
+
+def _hash_text(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def build_signature():
+    """Hash of everything in the loader that decides what a build contains."""
+    return _hash_text(
+        LOADER_VERSION, GTFS_SCHEMA, SECONDS_COLUMNS,
+        [(artifact["name"], artifact["version"], artifact["inputs"], artifact.get("optional_inputs"))
+         for artifact in DERIVED_ARTIFACTS],
+    )
+
+
+def hash_zip_member(zip_ref, member):
+    """sha256 of a member file's uncompressed contents, read in chunks."""
+    digest = hashlib.sha256()
+    with zip_ref.open(member) as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _ensure_manifest(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS build_manifest (
+            artifact TEXT PRIMARY KEY,
+            kind TEXT,
+            input_hash TEXT,
+            rows INTEGER,
+            seconds REAL,
+            built_at TEXT,
+            output TEXT
+        )
+    """)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(build_manifest)")]
+    if "output" not in columns:
+        conn.execute("ALTER TABLE build_manifest ADD COLUMN output TEXT")
+
+
+def read_manifest(conn):
+    """Return {artifact: input_hash} for everything recorded in the database."""
+    _ensure_manifest(conn)
+    return dict(conn.execute("SELECT artifact, input_hash FROM build_manifest"))
+
+
+def _record_artifact(conn, artifact, kind, input_hash, rows, seconds, output=None):
+    conn.execute(
+        "INSERT OR REPLACE INTO build_manifest (artifact, kind, input_hash, rows, seconds, built_at, output) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (artifact, kind, input_hash, rows, seconds, datetime.now().isoformat(timespec="seconds"), output),
+    )
+
+
+def snapshot_outputs(db_path):
+    """Return {artifact: absolute output directory} for a feed database's snapshots."""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        rows = conn.execute("SELECT artifact, output FROM build_manifest WHERE output IS NOT NULL").fetchall()
+    except sqlite3.OperationalError:
+        rows = []
+    finally:
+        conn.close()
+    return {artifact: os.path.join(os.path.dirname(db_path), output) for artifact, output in rows}
+
+
+def _copy_database(source_path, dest_path):
+    """Copy an existing feed database so unchanged artifacts can be reused."""
+    source = sqlite3.connect(f"file:{source_path}?mode=ro", uri=True)
+    dest = sqlite3.connect(dest_path)
+    try:
+        source.backup(dest)
+    finally:
+        source.close()
+        dest.close()
+
+
+def load_gtfs_to_sql(gtfs_zip_path, db_path, base_db_path=None):
+    """
+    Load a GTFS zip into SQLite, reading each member straight from the archive.
+
+    If base_db_path points at the database built from a previous feed, it is
+    copied first and only the tables and derived artifacts whose inputs
+    changed are rebuilt. Returns a dict of per-artifact build statistics.
+    """
+    if base_db_path and os.path.exists(base_db_path) and base_db_path != db_path:
+        _copy_database(base_db_path, db_path)
+        print(f"Starting from previous build {os.path.basename(base_db_path)}.")
+
+    conn = sqlite3.connect(db_path)
+    # The database is rebuilt from the zip on failure, so skip the journal
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    manifest = read_manifest(conn)
+
+    stats = {}
+    skipped = []
+    hashes = {}
+    started = time.perf_counter()
+    with zipfile.ZipFile(gtfs_zip_path, "r") as zip_ref:
+        members = {name.rsplit("/", 1)[-1]: name for name in zip_ref.namelist()}
+
+        for table_name in GTFS_SCHEMA:
+            member = members.get(f"{table_name}.txt")
+            if member is None:
+                # Drop tables left over from a previous feed that had this file
+                conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+                conn.execute("DELETE FROM build_manifest WHERE artifact = ?", (table_name,))
+                continue
+
+            table_started = time.perf_counter()
+            member_hash = hash_zip_member(zip_ref, member)
+            hashes[table_name] = _hash_text(LOADER_VERSION, GTFS_SCHEMA[table_name], SECONDS_COLUMNS, member_hash)
+            if manifest.get(table_name) == hashes[table_name]:
+                skipped.append(table_name)
+                print(f"Skipped table {table_name}: {member} unchanged "
+                      f"(hashed in {time.perf_counter() - table_started:.2f}s).")
+                continue
+
+            rows = load_table(conn, zip_ref, member, table_name)
+            elapsed = time.perf_counter() - table_started
+            _record_artifact(conn, table_name, "table", hashes[table_name], rows, elapsed)
+            conn.commit()
+
+            stats[table_name] = {
+                "rows": rows,
+                "seconds": elapsed,
+                "rows_per_second": rows / elapsed if elapsed else float(rows),
+            }
+            print(f"Loaded {member} into table {table_name}: {rows} rows in {elapsed:.2f}s "
+                  f"({stats[table_name]['rows_per_second']:.0f} rows/s).")
+
+    for artifact in DERIVED_ARTIFACTS:
+        name = artifact["name"]
+        if any(input_name not in hashes for input_name in artifact["inputs"]):
+            # Drop what a previous feed that had the inputs left behind
+            for table_name in artifact.get("tables", []):
+                conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+            conn.execute("DELETE FROM build_manifest WHERE artifact = ?", (name,))
+            conn.commit()
+            print(f"Skipped {name}: missing input.")
+            continue
+
+        hashes[name] = _hash_text(
+            artifact["version"],
+            *(hashes[i] for i in artifact["inputs"]),
+            *(hashes.get(i) for i in artifact.get("optional_inputs", [])),
+        )
+        context = {"db_path": db_path, "input_hash": hashes[name]}
+        output = None
+        if artifact["kind"] == "snapshot":
+            output = f"{name}-{hashes[name][:16]}"
+            context["output_dir"] = os.path.join(os.path.dirname(db_path), output)
+
+        if manifest.get(name) == hashes[name] and (output is None or os.path.isdir(context["output_dir"])):
+            skipped.append(name)
+            print(f"Skipped {name}: inputs unchanged.")
+            continue
+
+        artifact_started = time.perf_counter()
+        rows = artifact["build"](conn, context)
+        elapsed = time.perf_counter() - artifact_started
+        _record_artifact(conn, name, artifact["kind"], hashes[name], rows, elapsed, output)
+        conn.commit()
+        stats[name] = {"rows": rows, "seconds": elapsed}
+        print(f"Built {name} in {elapsed:.2f}s.")
+
+    conn.close()
+
+    total_rows = sum(stats[name]["rows"] for name in GTFS_SCHEMA if name in stats)
+    total_seconds = time.perf_counter() - started
+    rows_per_second = total_rows / total_seconds if total_seconds else float(total_rows)
+    peak_mb = peak_memory_mb()
+    peak_text = f"{peak_mb:.1f} MB" if peak_mb is not None else "unknown"
+    print(f"GTFS data loaded into database successfully! Rebuilt {len(stats)} artifacts, "
+          f"skipped {len(skipped)}; {total_rows} rows in {total_seconds:.2f}s "
+          f"({rows_per_second:.0f} rows/s), peak memory {peak_text}.")
+    return stats
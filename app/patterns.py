@@ -0,0 +1,124 @@
+from itertools import groupby
+
+PATTERN_FETCH_SIZE = 100000
+
+
+def build_route_patterns(conn, context):
+    """
+    Derive the distinct ordered stop lists (patterns) of every route, branch
+    and direction, how many trips run each one, and which pattern each trip
+    follows. Returns the number of patterns.
+    """
+    conn.execute("DROP TABLE IF EXISTS route_patterns")
+    conn.execute("DROP TABLE IF EXISTS pattern_stops")
+    conn.execute("DROP TABLE IF EXISTS trip_patterns")
+    conn.execute("""
+        CREATE TABLE route_patterns (
+            pattern_id INTEGER PRIMARY KEY,
+            route_id TEXT,
+            branch_letter TEXT,
+            direction_id INTEGER,
+            stop_count INTEGER,
+            trip_count INTEGER
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE pattern_stops (
+            pattern_id INTEGER,
+            stop_index INTEGER,
+            stop_id TEXT,
+            stop_sequence INTEGER,
+            PRIMARY KEY (pattern_id, stop_index)
+        )
+    """)
+    conn.execute("CREATE TABLE trip_patterns (trip_id TEXT PRIMARY KEY, pattern_id INTEGER)")
+
+    cursor = conn.execute("""
+        SELECT st.trip_id, t.route_id, t.branch_letter, t.direction_id, st.stop_id, st.stop_sequence
+        FROM stop_times st
+        JOIN trips t ON st.trip_id = t.trip_id
+        ORDER BY st.trip_id, st.stop_sequence
+    """)
+
+    def trip_rows():
+        while True:
+            rows = cursor.fetchmany(PATTERN_FETCH_SIZE)
+            if not rows:
+                return
+            yield from rows
+
+    # {(route, branch, direction, stop ids): [pattern_id, trip count, stop sequences]}
+    patterns = {}
+    trip_patterns = []
+    for trip_id, rows in groupby(trip_rows(), key=lambda row: row[0]):
+        rows = list(rows)
+        _, route_id, branch_letter, direction_id, _, _ = rows[0]
+        key = (route_id, branch_letter, direction_id, tuple(row[4] for row in rows))
+        if key not in patterns:
+            patterns[key] = [len(patterns) + 1, 0, [row[5] for row in rows]]
+        patterns[key][1] += 1
+        trip_patterns.append((trip_id, patterns[key][0]))
+        if len(trip_patterns) >= PATTERN_FETCH_SIZE:
+            conn.executemany("INSERT INTO trip_patterns VALUES (?, ?)", trip_patterns)
+            trip_patterns = []
+    conn.executemany("INSERT INTO trip_patterns VALUES (?, ?)", trip_patterns)
+
+    for (route_id, branch_letter, direction_id, stop_ids), (pattern_id, trip_count, sequences) in patterns.items():
+        conn.execute(
+            "INSERT INTO route_patterns VALUES (?, ?, ?, ?, ?, ?)",
+            (pattern_id, route_id, branch_letter, direction_id, len(stop_ids), trip_count),
+        )
+        conn.executemany("INSERT INTO pattern_stops VALUES (?, ?, ?, ?)", [
+            (pattern_id, stop_index, stop_id, sequence)
+            for stop_index, (stop_id, sequence) in enumerate(zip(stop_ids, sequences))
+        ])
+
+    conn.execute("CREATE INDEX idx_route_patterns_route ON route_patterns (route_id, branch_letter)")
+    conn.execute("CREATE INDEX idx_pattern_stops_stop_id ON pattern_stops (stop_id)")
+    return len(patterns)
+
+
+def _route_filter(branch_letter):
+    return "p.route_id = ?" + (" AND p.branch_letter = ?" if branch_letter else "")
+
+
+def route_stops(conn, route_id, branch_letter=None):
+    """Return [(stop_id, stop_lat, stop_lon)] for the distinct stops a route (and branch) serves."""
+    params = [route_id] + ([branch_letter] if branch_letter else [])
+    return conn.execute(f"""
+        SELECT DISTINCT s.stop_id, s.stop_lat, s.stop_lon
+        FROM route_patterns p
+        JOIN pattern_stops ps ON ps.pattern_id = p.pattern_id
+        JOIN stops s ON s.stop_id = ps.stop_id
+        WHERE {_route_filter(branch_letter)}
+    """, params).fetchall()
+
+
+def downstream_stops(conn, route_id, branch_letter, stop_id):
+    """
+    Return [(stop_id, stop_lat, stop_lon, stop_sequence)] for the stop and
+    every stop after it on the route's patterns that serve it, each stop
+    once, in riding order. A stop reached by several patterns takes its
+    position from the one that reaches it soonest, then the busiest.
+    """
+    params = [route_id] + ([branch_letter] if branch_letter else []) + [stop_id]
+    rows = conn.execute(f"""
+        WITH start AS (
+            SELECT ps.pattern_id, MIN(ps.stop_index) AS stop_index, p.trip_count
+            FROM route_patterns p
+            JOIN pattern_stops ps ON ps.pattern_id = p.pattern_id
+            WHERE {_route_filter(branch_letter)} AND ps.stop_id = ?
+            GROUP BY ps.pattern_id
+        )
+        SELECT ps.stop_id, s.stop_lat, s.stop_lon, ps.stop_sequence,
+               ps.stop_index - start.stop_index AS stops_away, start.trip_count
+        FROM start
+        JOIN pattern_stops ps ON ps.pattern_id = start.pattern_id AND ps.stop_index >= start.stop_index
+        JOIN stops s ON s.stop_id = ps.stop_id
+        ORDER BY stops_away, start.trip_count DESC
+    """, params).fetchall()
+
+    stops = {}
+    for stop_id, stop_lat, stop_lon, stop_sequence, _, _ in rows:
+        stops.setdefault(stop_id, (stop_id, stop_lat, stop_lon, stop_sequence))
+    return list(stops.values())
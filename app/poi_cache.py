@@ -0,0 +1,207 @@
+from math import floor
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+# Amenities are cached per grid cell of this many degrees
+CELL_DEGREES = 0.01
+# Cells fetched from Overpass per request when filling the cache
+FETCH_CHUNK_CELLS = 200
+# How long a worker may hold a stale cell while revalidating it
+REVALIDATE_CLAIM_SECONDS = 120
+# Cell boxes are padded by this much so nodes on an edge are never missed
+CELL_PADDING = 1e-7
+
+
+def cell_of(lat, lon):
+    return floor(lat / CELL_DEGREES), floor(lon / CELL_DEGREES)
+
+
+def cells_for_box(south, west, north, east):
+    """Every cell overlapping a bounding box."""
+    min_row, min_col = cell_of(south, west)
+    max_row, max_col = cell_of(north, east)
+    return [(row, col) for row in range(min_row, max_row + 1) for col in range(min_col, max_col + 1)]
+
+
+def cell_box(cell):
+    """(south, west, north, east) of a cell, padded slightly."""
+    row, col = cell
+    return (
+        row * CELL_DEGREES - CELL_PADDING, col * CELL_DEGREES - CELL_PADDING,
+        (row + 1) * CELL_DEGREES + CELL_PADDING, (col + 1) * CELL_DEGREES + CELL_PADDING,
+    )
+
+
+class PoiCache:
+    """
+    SQLite-backed cache of Overpass amenities per grid cell, shared by every
+    worker that points at the same file.
+
+    Cells younger than ttl are fresh. Cells older than ttl but within
+    stale_seconds more are served as they are while one worker refetches
+    them in the background; older cells are fetched again before use. The
+    least recently used cells are evicted once the cache outgrows max_bytes.
+    """
+
+    def __init__(self, path, ttl, stale_seconds, max_bytes):
+        self.path = path
+        self.ttl = ttl
+        self.stale_seconds = stale_seconds
+        self.max_bytes = max_bytes
+        self._init_db()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode = WAL")
+        return conn
+
+    def _init_db(self):
+        conn = self._connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS poi_cells (
+                    filter TEXT,
+                    cell TEXT,
+                    fetched_at REAL,
+                    last_used REAL,
+                    revalidating_until REAL DEFAULT 0,
+                    size INTEGER,
+                    elements BLOB,
+                    PRIMARY KEY (filter, cell)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_poi_cells_last_used ON poi_cells (last_used)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def lookup(self, amenity_filter, cells):
+        """
+        Return ({cell: elements} usable now, [stale cells this worker should
+        revalidate], [missing or expired cells]) and mark the usable ones as
+        recently used.
+        """
+        now = time.time()
+        keys = {f"{row}:{col}": (row, col) for row, col in cells}
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT cell, fetched_at, elements FROM poi_cells "
+                "WHERE filter = ? AND cell IN (SELECT value FROM json_each(?))",
+                (amenity_filter, json.dumps(list(keys))),
+            ).fetchall()
+            found, stale = {}, []
+            for key, fetched_at, elements in rows:
+                age = now - fetched_at
+                if age > self.ttl + self.stale_seconds:
+                    continue
+                found[keys[key]] = json.loads(zlib.decompress(elements))
+                # Only one worker claims each stale cell for revalidation
+                if age > self.ttl and conn.execute(
+                    "UPDATE poi_cells SET revalidating_until = ? "
+                    "WHERE filter = ? AND cell = ? AND revalidating_until < ?",
+                    (now + REVALIDATE_CLAIM_SECONDS, amenity_filter, key, now),
+                ).rowcount:
+                    stale.append(keys[key])
+            conn.execute(
+                "UPDATE poi_cells SET last_used = ? WHERE filter = ? AND cell IN (SELECT value FROM json_each(?))",
+                (now, amenity_filter, json.dumps([f"{row}:{col}" for row, col in found])),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        missing = [cell for cell in keys.values() if cell not in found]
+        return found, stale, missing
+
+    def store(self, amenity_filter, cell_elements):
+        """Save {cell: elements} and evict least recently used cells over the size cap."""
+        now = time.time()
+        rows = []
+        for (row, col), elements in cell_elements.items():
+            blob = zlib.compress(json.dumps(elements, separators=(",", ":")).encode("utf-8"))
+            rows.append((amenity_filter, f"{row}:{col}", now, now, len(blob), blob))
+        conn = self._connect()
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO poi_cells (filter, cell, fetched_at, last_used, size, elements) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM poi_cells").fetchone()[0]
+            if total > self.max_bytes:
+                evicted = 0
+                for key_filter, key, size in conn.execute(
+                    "SELECT filter, cell, size FROM poi_cells ORDER BY last_used"
+                ).fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    conn.execute("DELETE FROM poi_cells WHERE filter = ? AND cell = ?", (key_filter, key))
+                    total -= size
+                    evicted += 1
+                print(f"Evicted {evicted} POI cache cells to stay under {self.max_bytes} bytes.")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def stats(self):
+        conn = self._connect()
+        try:
+            cells, size, oldest = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(fetched_at) FROM poi_cells"
+            ).fetchone()
+        finally:
+            conn.close()
+        return {
+            "cells": cells,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "oldest_age_seconds": time.time() - oldest if oldest else None,
+        }
+
+
+def fetch_cells(cells, fetch_boxes):
+    """
+    Fetch the amenities of the given cells with fetch_boxes([box, ...]),
+    FETCH_CHUNK_CELLS cells per call, and split them back into {cell: elements}.
+    """
+    cell_elements = {cell: [] for cell in cells}
+    # A fetch may return elements of cells from other chunks too
+    seen = set()
+    for start in range(0, len(cells), FETCH_CHUNK_CELLS):
+        chunk = cells[start:start + FETCH_CHUNK_CELLS]
+        for element in fetch_boxes([cell_box(cell) for cell in chunk]):
+            cell = cell_of(element["lat"], element["lon"])
+            if cell in cell_elements and element["id"] not in seen:
+                seen.add(element["id"])
+                cell_elements[cell].append(element)
+    return cell_elements
+
+
+def cached_amenities(cache, amenity_filter, boxes, fetch_boxes):
+    """
+    Return every amenity inside the given boxes, from the cache where it can
+    and from fetch_boxes for the cells it is missing. Stale cells are served
+    as they are and refetched on a background thread.
+    """
+    cells = list(dict.fromkeys(cell for box in boxes for cell in cells_for_box(*box)))
+    found, stale, missing = cache.lookup(amenity_filter, cells)
+
+    if missing:
+        fetched = fetch_cells(missing, fetch_boxes)
+        cache.store(amenity_filter, fetched)
+        found.update(fetched)
+        print(f"POI cache: fetched {len(missing)} of {len(cells)} cells.")
+
+    if stale:
+        def revalidate():
+            try:
+                cache.store(amenity_filter, fetch_cells(stale, fetch_boxes))
+            except Exception as e:
+                print(f"Error revalidating POI cache cells: {e}")
+
+        threading.Thread(target=revalidate, daemon=True).start()
+
+    return [element for cell in cells for element in found.get(cell, [])]
@@ -0,0 +1,204 @@
+from bisect import bisect_left, bisect_right
+import bz2
+import gzip
+import json
+import os
+import sqlite3
+import xml.etree.ElementTree as ET
+
+try:
+    import osmium
+except ImportError:  # Only needed to import .osm.pbf extracts
+    osmium = None
+
+from .spatial import haversine_distance
+
+BATCH_SIZE = 10000
+# Points per corridor query; long routes are split into a few overlapping pieces
+CORRIDOR_CHUNK_POINTS = 100
+
+
+def _open_extract(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rb")
+    return open(path, "rb")
+
+
+def iter_osm_xml(path):
+    """Yield (id, lat, lon, tags) for every amenity node of an .osm XML extract."""
+    with _open_extract(path) as f:
+        for _, element in ET.iterparse(f, events=("end",)):
+            if element.tag != "node":
+                if element.tag in ("way", "relation"):
+                    element.clear()
+                continue
+            tags = {tag.get("k"): tag.get("v") for tag in element.iter("tag")}
+            if "amenity" in tags:
+                yield int(element.get("id")), float(element.get("lat")), float(element.get("lon")), tags
+            # Nodes are not needed once read; keep memory flat on large extracts
+            element.clear()
+
+
+def iter_overpass_json(path):
+    """Yield (id, lat, lon, tags) for every amenity node of an Overpass JSON dump."""
+    with _open_extract(path) as f:
+        elements = json.load(f).get("elements", [])
+    for element in elements:
+        tags = element.get("tags", {})
+        if element.get("type", "node") == "node" and "amenity" in tags and "lat" in element:
+            yield element["id"], element["lat"], element["lon"], tags
+
+
+def iter_osm_pbf(path):
+    """Yield (id, lat, lon, tags) for every amenity node of an .osm.pbf extract (needs pyosmium)."""
+    if osmium is None:
+        raise RuntimeError("Importing .osm.pbf extracts needs the osmium package (pip install osmium)")
+    for node in osmium.FileProcessor(path, osmium.osm.NODE).with_filter(osmium.filter.KeyFilter("amenity")):
+        yield node.id, node.location.lat, node.location.lon, dict(node.tags)
+
+
+def iter_extract(path):
+    """Pick the reader for an OSM extract from its file name."""
+    name = path.lower()
+    for suffix in (".gz", ".bz2"):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    if name.endswith(".pbf"):
+        return iter_osm_pbf(path)
+    if name.endswith(".json"):
+        return iter_overpass_json(path)
+    return iter_osm_xml(path)
+
+
+def import_pois(extract_path, db_path):
+    """
+    Load the amenity nodes of an OSM extract into a POI database with an
+    R*Tree over their coordinates. The database is built next to db_path
+    and renamed over it, so readers see either the old or the new store.
+    Returns the number of POIs imported.
+    """
+    temp_path = f"{db_path}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    conn = sqlite3.connect(temp_path)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("""
+        CREATE TABLE pois (
+            id INTEGER PRIMARY KEY,
+            lat REAL,
+            lon REAL,
+            name TEXT,
+            amenity TEXT,
+            tags TEXT
+        )
+    """)
+
+    count = 0
+    batch = []
+    for node_id, lat, lon, tags in iter_extract(extract_path):
+        batch.append((node_id, lat, lon, tags.get("name"), tags["amenity"], json.dumps(tags)))
+        if len(batch) >= BATCH_SIZE:
+            conn.executemany("INSERT OR REPLACE INTO pois VALUES (?, ?, ?, ?, ?, ?)", batch)
+            count += len(batch)
+            batch = []
+    conn.executemany("INSERT OR REPLACE INTO pois VALUES (?, ?, ?, ?, ?, ?)", batch)
+    count += len(batch)
+
+    try:
+        conn.execute("CREATE VIRTUAL TABLE pois_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)")
+        conn.execute("INSERT INTO pois_rtree SELECT id, lat, lat, lon, lon FROM pois")
+    except sqlite3.OperationalError as e:
+        print(f"R*Tree unavailable ({e}); indexing POI coordinates instead.")
+        conn.execute("CREATE INDEX idx_pois_lat_lon ON pois (lat, lon)")
+    conn.commit()
+    conn.close()
+
+    os.replace(temp_path, db_path)
+    print(f"Imported {count} POIs from {os.path.basename(extract_path)} into {db_path}.")
+    return count
+
+
+def poi_store_imported(db_path):
+    return bool(db_path) and os.path.exists(db_path)
+
+
+def open_poi_store(db_path):
+    """Open the local POI store read-only, or return None if it has not been imported."""
+    if not poi_store_imported(db_path):
+        return None
+    return sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+
+
+def amenities_in_box(conn, south, west, north, east):
+    """
+    Return the amenity nodes inside a bounding box, shaped and ordered like
+    Overpass elements ({"type", "id", "lat", "lon", "tags"}).
+    """
+    try:
+        rows = conn.execute("""
+            SELECT p.id, p.lat, p.lon, p.tags
+            FROM pois_rtree r
+            JOIN pois p ON p.id = r.id
+            WHERE r.max_lat >= :south AND r.min_lat <= :north AND r.max_lon >= :west AND r.min_lon <= :east
+              -- The R*Tree rounds coordinates outwards, so recheck them exactly
+              AND p.lat BETWEEN :south AND :north AND p.lon BETWEEN :west AND :east
+            ORDER BY p.id
+        """, {"south": south, "west": west, "north": north, "east": east})
+    except sqlite3.OperationalError:
+        rows = conn.execute(
+            "SELECT id, lat, lon, tags FROM pois WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ? ORDER BY id",
+            (south, north, west, east),
+        )
+    return [
+        {"type": "node", "id": node_id, "lat": lat, "lon": lon, "tags": json.loads(tags)}
+        for node_id, lat, lon, tags in rows
+    ]
+
+
+def fetch_corridor_amenities(points, radius, fetch_around):
+    """
+    Fetch the amenities within radius meters of a route in one query per
+    CORRIDOR_CHUNK_POINTS points, using fetch_around(points, radius), and
+    return them indexed for amenities_in_box_index.
+    """
+    elements = {}
+    step = CORRIDOR_CHUNK_POINTS - 1
+    for start in range(0, max(len(points) - 1, 1), step):
+        # Consecutive chunks share a point so the corridor has no gaps
+        for element in fetch_around(points[start:start + CORRIDOR_CHUNK_POINTS], radius):
+            elements[element["id"]] = element
+    return index_amenities(elements.values())
+
+
+def fetch_corridor_boxes(boxes, fetch_around):
+    """
+    Fetch every amenity inside the given boxes with corridor queries through
+    their centers, wide enough to reach each box's corners. The result also
+    holds amenities outside the boxes, between consecutive centers.
+    """
+    points = [((south + north) / 2, (west + east) / 2) for south, west, north, east in boxes]
+    radius = max(
+        max(haversine_distance(lat, lon, north, east), haversine_distance(lat, lon, south, east))
+        for (lat, lon), (south, west, north, east) in zip(points, boxes)
+    )
+    return fetch_corridor_amenities(points, radius + 1, fetch_around)[1]
+
+
+def index_amenities(elements):
+    """Sort fetched amenities by latitude for amenities_in_box_index."""
+    ordered = sorted(elements, key=lambda element: element["lat"])
+    return [element["lat"] for element in ordered], ordered
+
+
+def amenities_in_box_index(index, south, west, north, east):
+    """Same as amenities_in_box, over amenities already fetched and indexed by index_amenities."""
+    lats, elements = index
+    found = [
+        element for element in elements[bisect_left(lats, south):bisect_right(lats, north)]
+        if west <= element["lon"] <= east
+    ]
+    found.sort(key=lambda element: element["id"])
+    return found
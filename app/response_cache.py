@@ -0,0 +1,71 @@
+from collections import OrderedDict
+import threading
+
+
+class ResponseCache:
+    """
+    In-memory LRU cache of serialized API responses for one feed version.
+
+    Entries are evicted least recently used first once their total size goes
+    over max_bytes. Looking up a different feed version than the one the
+    entries were built from drops them all, so a newly loaded feed never
+    serves results of the old one.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.version = None
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def _check_version(self, version):
+        if version != self.version:
+            self.entries.clear()
+            self.size = 0
+            self.version = version
+
+    def get(self, version, key):
+        """Return the cached body for key, or None."""
+        with self.lock:
+            self._check_version(version)
+            body = self.entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, version, key, body):
+        """Store a body (bytes) for key, evicting old entries to stay under the cap."""
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            self._check_version(version)
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "version": self.version,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else None,
+            }
@@ -1,10 +1,24 @@
-from flask import Blueprint, json, render_template, jsonify, request, make_response, send_file
+from flask import Blueprint, Response, current_app, g, json, render_template, jsonify, request, make_response, send_file, stream_with_context
 from math import radians, sin, cos, sqrt, atan2
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import wraps
+from itertools import groupby
+import hashlib
+from concurrent.futures import as_completed
 import zipfile
 import pandas as pd
-from .services import fetch_routes, fetch_stops, fetch_departures, fetch_stops_nearby, check_route_frequency, fetch_osm_bus_stops, fetch_stop_departures, calculate_frequency, fetch_osm_bus_stops, fetch_all_departures, calculate_frequency
+from .gtfs_feed import current_feed
+from .frequency import frequency_rows, has_table
+from .shapes import POLYLINE_PRECISION, decode_polyline, encode_polyline, route_shape_polylines, tolerance_for_zoom
+from .service_calendar import services_on
+from .tiles import cached_tile_path, is_valid_tile
+from . import transport
+from .patterns import downstream_stops, route_stops
+from .poi_cache import cached_amenities
+from .poi_store import amenities_in_box, amenities_in_box_index, fetch_corridor_amenities, fetch_corridor_boxes, index_amenities, open_poi_store, poi_store_imported
+from .stop_index import stop_index
+from .spatial import find_nearby_stops, haversine_distance, snap_to_grid
+from .services import fetch_routes, fetch_stops, fetch_departures, fetch_stops_nearby, check_route_frequency, fetch_osm_bus_stops, fetch_stop_departures, calculate_frequency, fetch_osm_bus_stops, fetch_all_departures, calculate_frequency, fetch_osm_amenities_around, fetch_osm_amenities_async, fetch_osm_amenities_in_boxes, departures_cache
 import asyncio
 import requests
 import os
@@ -13,77 +27,9 @@ import numpy as np
 import sqlite3
 
 ##Constants
-GTFS_URL = "https://svc.metrotransit.org/mtgtfs/gtfs.zip"
-CACHE_DIR = "/tmp"
-GTFS_FILENAME = "gtfs.zip"
-COOKIE_NAME = "gtfs_last_updated"
-
-def haversine_distance(lat1, lon1, lat2, lon2):
-    """
-    Calculate the great-circle distance between two points on the Earth
-    specified by latitude and longitude.
-
-    Parameters:
-    - lat1, lon1: Latitude and longitude of the first point in decimal degrees.
-    - lat2, lon2: Latitude and longitude of the second point in decimal degrees.
-
-    Returns:
-    - Distance in meters between the two points.
-    """
-    # Radius of the Earth in meters
-    R = 6371000  
-
-    # Convert latitude and longitude from degrees to radians
-    phi1 = radians(lat1)
-    phi2 = radians(lat2)
-    delta_phi = radians(lat2 - lat1)
-    delta_lambda = radians(lon2 - lon1)
-
-    # Haversine formula
-    a = sin(delta_phi / 2) ** 2 + cos(phi1) * cos(phi2) * sin(delta_lambda / 2) ** 2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
-
-    # Distance in meters
-    distance = R * c
-    return distance
-
-def load_gtfs_to_sql(gtfs_zip_path, db_path):
-    # Extract the GTFS zip file
-    with zipfile.ZipFile(gtfs_zip_path, 'r') as zip_ref:
-        zip_ref.extractall("gtfs_data")
-
-    # Connect to SQLite database (or create it)
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    # Define GTFS files and corresponding SQL table names
-    gtfs_files = [
-        "agency.txt",
-        "stops.txt",
-        "routes.txt",
-        "trips.txt",
-        "stop_times.txt",
-        "calendar.txt",
-        "calendar_dates.txt",
-        "shapes.txt"
-    ]
-
-    for file_name in gtfs_files:
-        file_path = os.path.join("gtfs_data", file_name)
-        if os.path.exists(file_path):
-            # Load the CSV file into a DataFrame
-            df = pd.read_csv(file_path)
-
-            # Create a table in SQLite
-            table_name = file_name.replace(".txt", "")
-            df.to_sql(table_name, conn, if_exists="replace", index=False)
-
-            print(f"Loaded {file_name} into table {table_name}.")
-
-    # Commit changes and close the connection
-    conn.commit()
-    conn.close()
-    print("GTFS data loaded into database successfully!")
+GTFS_LOADING_ERROR = "GTFS data is still loading. Please try again shortly."
+# Farthest a POI can be from a stop and still fall in its +/-0.01 degree search box
+POI_BOX_REACH_METERS = 1600
 
 # Define a Blueprint
 main = Blueprint('main', __name__)
@@ -111,18 +57,8 @@ def calculate_distance(lat1, lon1, lat2, lon2):
     return distance_meters * 3.28084  # Convert to feet
 
 def get_walking_distance(lat1, lon1, lat2, lon2):
-    url = f"http://router.project-osrm.org/route/v1/walking/{lon1},{lat1};{lon2},{lat2}?overview=false"
-    response = requests.get(url)
-    data = response.json()
-
-    if "routes" in data and len(data["routes"]) > 0:
-        return data["routes"][0]["distance"]  # Distance in meters
-    else:
-        return None
-
-# # Example usage
-# walking_distance = get_walking_distance(user_lat, user_lon, stop_lat, stop_lon)
-# print(f"Walking Distance: {walking_distance / 1609.34:.2f} miles")
+    """Walking distance in meters between two points (see app/walking.py)."""
+    return current_app.extensions["walking_distances"].distance(lat1, lon1, lat2, lon2)
 
 def filter_stops_by_distance(stops, user_lat, user_lon, max_distance):
     return [
@@ -164,13 +100,110 @@ def list_departures():
 
 @main.route('/api/stops', methods=['GET'])
 def stops_nearby():
+    """Stops within distance meters, from the in-memory stop index of the current feed."""
     user_lat = float(request.args.get('lat'))
     user_lng = float(request.args.get('lng'))
     max_distance = float(request.args.get('distance'))
 
-    stops = fetch_stops_nearby(user_lat, user_lng, max_distance)
+    feed = get_current_feed()
+    if feed is None:
+        return jsonify({"error": GTFS_LOADING_ERROR}), 503
+    index = stop_index(feed)
+    stops = [
+        {
+            "stop_id": stop_id,
+            "name": stop_name,
+            "latitude": stop_lat,
+            "longitude": stop_lon,
+            "distance": distance,
+            "routes": index.routes(stop_id),
+        }
+        for stop_id, stop_name, stop_lat, stop_lon, distance in index.nearby(user_lat, user_lng, max_distance)
+    ]
     return jsonify(stops)
 
+def nearby_stops_with_routes(feed, user_lat, user_lon, radius):
+    """Nearby stops with the routes serving them, from the stop index: [{stop_id, latitude, longitude, routes}]."""
+    index = stop_index(feed)
+    stops_info = []
+    for stop_id, _, stop_lat, stop_lon, _ in index.nearby(user_lat, user_lon, radius):
+        routes = index.routes(stop_id)
+        if not routes:
+            continue
+
+        stops_info.append({
+            "stop_id": stop_id,
+            "latitude": stop_lat,
+            "longitude": stop_lon,
+            "routes": routes
+        })
+    return stops_info
+
+def summarize_route_departures(user_lat, user_lon, frequency_limit, stops_info, departure_data):
+    """For every route, the closest stop serving it with its upcoming departures and frequency color."""
+    # Find the closest stop for each route
+    closest_stops = {}
+    current_time = int(datetime.now().timestamp())
+
+    for stop_info, stop_data in zip(stops_info, departure_data):
+        if not stop_data or "departures" not in stop_data:
+            continue
+
+        stop_distance = calculate_distance(
+            user_lat, user_lon, stop_info["latitude"], stop_info["longitude"]
+        )
+
+        for route in stop_info["routes"]:
+            # Filter departures for this route
+            departures = [
+                dep for dep in stop_data["departures"] if dep["route_id"] == route
+            ]
+
+            # Count the number of valid departures
+            num_departures = len(departures)
+
+            # Determine the route's color
+            if num_departures == 0:
+                color = "white"  # No buses scheduled
+            elif num_departures <= 2:
+                color = "black"  # Few buses remaining
+            else:
+                avg_frequency = calculate_frequency(departures, current_time)
+                color = (
+                    "green" if avg_frequency is not None and avg_frequency <= frequency_limit
+                    else "red"
+                )
+
+            # Check if this stop is closer for this route
+            if (
+                route not in closest_stops
+                or stop_distance < closest_stops[route]["distance"]
+            ):
+                closest_stops[route] = {
+                    "stop_id": stop_info["stop_id"],
+                    "description": stop_data.get("stops", [{}])[0].get("description", ""),
+                    "distance": stop_distance,
+                    "frequency": calculate_frequency(departures, current_time),
+                    "num_departures": num_departures,
+                    "color": color,
+                }
+
+    # Format results
+    results = [
+        {
+            "route_id": route_id,
+            "stop_id": info["stop_id"],
+            "description": info["description"],
+            "distance": info["distance"],
+            "frequency": info["frequency"],
+            "num_departures": info["num_departures"],
+            "color": info["color"],
+        }
+        for route_id, info in closest_stops.items()
+    ]
+
+    return results
+
 @main.route('/api/routes', methods=['GET'])
 def get_routes_and_stops():
     user_lat = float(request.args.get('lat'))
@@ -179,203 +212,83 @@ def get_routes_and_stops():
     frequency_limit = float(request.args.get('frequency'))
 
     try:
-        # Fetch nearby stops from OSM
-        osm_stops = fetch_osm_bus_stops(user_lat, user_lon, radius)
-
-        # Collect all stops with their routes
-        stops_info = []
-        for stop in osm_stops:
-            route_string = stop.get("tags", {}).get("route", "")
-            stop_id = stop.get("tags", {}).get("metcouncil:site_id")
-            if not stop_id or not route_string:
-                continue
-
-            routes = route_string.split()  # Split space-separated route numbers
-            stops_info.append({
-                "stop_id": stop_id,
-                "latitude": stop.get("lat"),
-                "longitude": stop.get("lon"),
-                "routes": routes
-            })
+        feed = get_current_feed()
+        if feed is None:
+            return jsonify({"error": GTFS_LOADING_ERROR}), 503
 
-        # Fetch departures for all stops asynchronously
-        stop_ids = [stop["stop_id"] for stop in stops_info]
-        departure_data = asyncio.run(fetch_all_departures(stop_ids))
-
-        # Find the closest stop for each route
-        closest_stops = {}
-        current_time = int(datetime.now().timestamp())
+        # Find nearby stops and the routes serving them in the stop index
+        stops_info = nearby_stops_with_routes(feed, user_lat, user_lon, radius)
 
-        for stop_info, stop_data in zip(stops_info, departure_data):
-            if not stop_data or "departures" not in stop_data:
-                continue
-
-            stop_distance = calculate_distance(
-                user_lat, user_lon, stop_info["latitude"], stop_info["longitude"]
-            )
-
-            for route in stop_info["routes"]:
-                # Filter departures for this route
-                departures = [
-                    dep for dep in stop_data["departures"] if dep["route_id"] == route
-                ]
-
-                # Count the number of valid departures
-                num_departures = len(departures)
-
-                # Determine the route's color
-                if num_departures == 0:
-                    color = "white"  # No buses scheduled
-                elif num_departures <= 2:
-                    color = "black"  # Few buses remaining
-                else:
-                    avg_frequency = calculate_frequency(departures, current_time)
-                    color = (
-                        "green" if avg_frequency is not None and avg_frequency <= frequency_limit
-                        else "red"
-                    )
-
-                # Check if this stop is closer for this route
-                if (
-                    route not in closest_stops
-                    or stop_distance < closest_stops[route]["distance"]
-                ):
-                    closest_stops[route] = {
-                        "stop_id": stop_info["stop_id"],
-                        "description": stop_data.get("stops", [{}])[0].get("description", ""),
-                        "distance": stop_distance,
-                        "frequency": calculate_frequency(departures, current_time),
-                        "num_departures": num_departures,
-                        "color": color,
-                    }
-
-        # Format results
-        results = [
-            {
-                "route_id": route_id,
-                "stop_id": info["stop_id"],
-                "description": info["description"],
-                "distance": info["distance"],
-                "frequency": info["frequency"],
-                "num_departures": info["num_departures"],
-                "color": info["color"],
-            }
-            for route_id, info in closest_stops.items()
-        ]
+        # Fetch departures for all stops on the shared event loop
+        stop_ids = [stop["stop_id"] for stop in stops_info]
+        departure_data = transport.run_async(fetch_all_departures(stop_ids))
 
+        results = summarize_route_departures(user_lat, user_lon, frequency_limit, stops_info, departure_data)
         return jsonify(results)
     except Exception as e:
         print(f"Error fetching routes and stops: {e}")
         return jsonify({"error": str(e)}), 500
     
-def download_gtfs_file():
-    """Download the GTFS file from the URL and save it to the cache directory."""
-    response = requests.get(GTFS_URL, stream=True)
-    response.raise_for_status()
-    gtfs_path = os.path.join(CACHE_DIR, GTFS_FILENAME)
-    with open(gtfs_path, "wb") as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            f.write(chunk)
-    return gtfs_path
-
-# Update the handle_gtfs function
-@main.route('/api/gtfs')
-def handle_gtfs():
-    """Check if the GTFS file needs to be updated or served."""
-    gtfs_path = os.path.join(CACHE_DIR, GTFS_FILENAME)
-    db_path = os.path.join(CACHE_DIR, "gtfs.db")  # Path for SQLite database
-    last_modified_cookie = request.cookies.get(COOKIE_NAME)
-    # last_load_cookie = request.cookies.get(COOKIE_NAME)
-
-    # Check if the GTFS file exists and is recent
-    if os.path.exists(gtfs_path):
-        file_age = (datetime.now() - datetime.fromtimestamp(os.path.getmtime(gtfs_path))).total_seconds()
-        if file_age < 86400:  # File is less than a day old
-            print("GTFS file is less than a day old. Skipping download.")
-            # Ensure the SQLite database exists
-            if not os.path.exists(db_path):
-                print("SQLite database missing. Loading GTFS data into database.")
-                load_gtfs_to_sql(gtfs_path, db_path)
-            else:
-                print("SQLite database exists. Skipping data reload.")
-            return send_file(gtfs_path)
-
-    headers = {}
-    if last_modified_cookie:
-        # Add "If-Modified-Since" header if we have a cookie
-        headers["If-Modified-Since"] = last_modified_cookie
-
-    # Make a HEAD request to check "Last-Modified"
-    response = requests.head(GTFS_URL, headers=headers)
-    if response.status_code == 304:
-        # File has not been modified; serve the cached file
-        if os.path.exists(gtfs_path):
-            print("GTFS file not modified. Serving cached file.")
-            if not os.path.exists(db_path):
-                print("SQLite database missing. Loading GTFS data into database.")
-                load_gtfs_to_sql(gtfs_path, db_path)
-            else:
-                print("SQLite database exists. Skipping data reload.")
-            return send_file(gtfs_path)
-
-    if response.status_code == 200:
-        # File has been modified or no cache exists; download the updated file
-        print("GTFS file updated. Downloading new file.")
-        gtfs_path = download_gtfs_file()
-        last_modified = response.headers.get("Last-Modified", datetime.now().strftime("%Y-%m-%d"))
-
-        # Load GTFS data into SQLite
-        print("Reloading data into database.")
-        load_gtfs_to_sql(gtfs_path, db_path)
-
-        # Set a cookie with the new "Last-Modified" date
-        response = make_response(send_file(gtfs_path))
-        response.set_cookie(COOKIE_NAME, last_modified, max_age=7 * 24 * 60 * 60)
+def get_current_feed():
+    """
+    Return the GTFS feed currently being served, or None if none is built yet.
+    A request keeps the feed it first saw even if a new one is swapped in.
+    """
+    if "feed" not in g:
+        g.feed = current_feed(current_app.config["GTFS_CACHE_DIR"])
+    return g.feed
+
+def feed_etag(feed):
+    """Strong ETag of the current request's response under a feed version."""
+    digest = hashlib.sha256()
+    for part in [feed["version"], request.path, *sorted(request.args.items(multi=True))]:
+        digest.update(repr(part).encode("utf-8"))
+    return digest.hexdigest()[:32]
+
+def conditional_on_feed(view):
+    """
+    Tag successful responses with an ETag derived from the feed version and
+    the request parameters, and answer a matching If-None-Match with 304
+    before the view (and SQLite) runs.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        feed = get_current_feed()
+        if feed is None:
+            return view(*args, **kwargs)
+        etag = feed_etag(feed)
+        if request.if_none_match.contains(etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code not in (200, 206):
+                return response
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = f"public, max-age={current_app.config['API_CACHE_MAX_AGE']}"
         return response
+    return wrapper
 
-    # Handle errors gracefully
-    return jsonify({"error": "Failed to fetch GTFS data"}), response.status_code
-
-
-# @main.route('/api/gtfs')
-# def handle_gtfs():
-#     """Handle GTFS file fetching and database loading."""
-#     gtfs_path = os.path.join(CACHE_DIR, GTFS_FILENAME)
-#     db_path = os.path.join(CACHE_DIR, "gtfs.db")  # Path for SQLite database
-#     last_load_cookie = request.cookies.get(COOKIE_NAME)
-
-#     # Check if this is a fresh load (no cookie) or the file is missing
-#     if not last_load_cookie or not os.path.exists(gtfs_path):
-#         print("Fresh page load or missing GTFS file. Fetching data.")
-#         gtfs_path = download_gtfs_file()
-#         load_gtfs_to_sql(gtfs_path, db_path)
+def connect_gtfs_db(feed):
+    """Open a read-only connection to a feed's database."""
+    return sqlite3.connect(f"file:{feed['db_path']}?mode=ro", uri=True)
 
-#         # Set a cookie to track this load
-#         last_loaded_time = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-#         response = make_response(send_file(gtfs_path))
-#         response.set_cookie(COOKIE_NAME, last_loaded_time, max_age=7 * 24 * 60 * 60)  # Cookie expires in 7 days
-#         return response
-
-#     # If the GTFS file exists and cookie is present, check if the database exists
-#     if os.path.exists(gtfs_path):
-#         if not os.path.exists(db_path):
-#             print("SQLite database missing. Reloading GTFS data into the database.")
-#             load_gtfs_to_sql(gtfs_path, db_path)
-#         else:
-#             print("SQLite database exists. Skipping data reload.")
-#         return send_file(gtfs_path)
-
-#     # Default to a graceful failure if something unexpected occurs
-#     return jsonify({"error": "Failed to fetch GTFS data"}), 500
+@main.route('/api/gtfs')
+@conditional_on_feed
+def handle_gtfs():
+    """Serve the GTFS file for the feed version currently loaded."""
+    feed = get_current_feed()
+    if feed is None:
+        return jsonify({"error": GTFS_LOADING_ERROR}), 503
+    # Same ETag as the 304 check, so Range/If-Range requests agree with it
+    return send_file(feed["zip_path"], etag=feed_etag(feed))
 
 
 @main.route('/api/schedule', methods=['GET'])
 def schedule_data():
-    # Fetch the GTFS file path from the /api/gtfs route
-    gtfs_path = "/tmp/gtfs.zip"  # Cached file path
-
-    if not os.path.exists(gtfs_path):
-        download_gtfs_file()
+    feed = get_current_feed()
+    if feed is None:
+        return jsonify({"error": GTFS_LOADING_ERROR}), 503
+    gtfs_path = feed["zip_path"]
 
     with zipfile.ZipFile(gtfs_path, 'r') as z:
         # Load relevant GTFS files
@@ -408,7 +321,7 @@ def get_nearby_stops(lat, lon, distance_feet):
     node["highway"="bus_stop"](around:{radius_meters},{lat},{lon});
     out body;
     """
-    response = requests.post("https://overpass-api.de/api/interpreter", data={"data": query})
+    response = transport.post("https://overpass-api.de/api/interpreter", data={"data": query})
     response.raise_for_status()
     return response.json()["elements"]
 
@@ -425,466 +338,192 @@ def normalize_departure_time(time_str):
     return time_str, 0  # No offset
 
 @main.route('/api/schedule/nearby', methods=['GET'])
+@conditional_on_feed
 def schedule_nearby():
     """Find nearby stops and analyze GTFS data."""
     try:
-        ## handle gtfs
-        handle_gtfs()
         # Get user input
         user_lat = float(request.args.get("lat"))
         user_lon = float(request.args.get("lon"))
         distance_limit = float(request.args.get("distance"))
         frequency_limit = float(request.args.get("frequency"))
+        service_date = request.args.get("date")
+        start_hour = request.args.get("start_hour")
+        end_hour = request.args.get("end_hour")
+
+        feed = get_current_feed()
+        if feed is None:
+            return jsonify({"error": GTFS_LOADING_ERROR}), 503
+
+        # Repeat searches from about the same spot share one cached answer,
+        # computed for the center of the grid cell the user is in
+        cell_meters = current_app.config["NEARBY_CACHE_CELL_METERS"]
+        if cell_meters > 0:
+            cell, user_lat, user_lon = snap_to_grid(user_lat, user_lon, cell_meters)
+        else:
+            cell = (user_lat, user_lon)
+        cache = current_app.extensions["nearby_cache"]
+        cache_key = (cell, distance_limit, frequency_limit, service_date, start_hour, end_hour)
+        body = cache.get(feed["version"], cache_key)
+        if body is not None:
+            return current_app.response_class(body, mimetype="application/json")
+
+        # Connect to the database of the feed currently being served
+        conn = connect_gtfs_db(feed)
+
+        # Look up the nearby stops through the spatial index (distance is in feet)
+        nearby_stops = find_nearby_stops(conn, user_lat, user_lon, distance_limit / 3.28084)
+        nearby_stop_ids = [stop[0] for stop in nearby_stops]
+
+        # Optionally only count the trips of services running on a given date (YYYYMMDD)
+        service_ids = None
+        if service_date:
+            try:
+                service_ids = services_on(conn, service_date)
+            except ValueError:
+                conn.close()
+                return jsonify({"error": "date must be in YYYYMMDD format"}), 400
+
+        # Optionally only count departures between two hours of the day;
+        # a window ending at or before its start runs past midnight and
+        # takes in the departures after it however the feed writes them
+        # (24:30:00 or 00:30:00)
+        window = None
+        if start_hour is not None or end_hour is not None:
+            try:
+                window_start, window_end = int(start_hour), int(end_hour)
+            except (TypeError, ValueError):
+                window_start = window_end = None
+            if window_start is None or not (0 <= window_start < 24 and 0 <= window_end <= 24):
+                conn.close()
+                return jsonify({"error": "start_hour and end_hour must both be hours from 0 to 24"}), 400
+            if window_end <= window_start:
+                window_end += 24
+            window = (window_start * 3600, window_end * 3600)
 
-        # Connect to the database
-        db_path = os.path.join(CACHE_DIR, "gtfs.db")
-        conn = sqlite3.connect(db_path)
-        print("part1")
-        # SQL query with bindings
-        query = """
-WITH nearby_stops AS (
-    SELECT 
-        stop_id,
-        stop_lat,
-        stop_lon,
-        (
-            6371000 * 2 * ATAN2(
-                SQRT(
-                    SIN(RADIANS(stop_lat - :user_lat) / 2) * SIN(RADIANS(stop_lat - :user_lat) / 2) +
-                    COS(RADIANS(:user_lat)) * COS(RADIANS(stop_lat)) *
-                    SIN(RADIANS(stop_lon - :user_lon) / 2) * SIN(RADIANS(stop_lon - :user_lon) / 2)
-                ),
-                SQRT(1 - (
-                    SIN(RADIANS(stop_lat - :user_lat) / 2) * SIN(RADIANS(stop_lat - :user_lat) / 2) +
-                    COS(RADIANS(:user_lat)) * COS(RADIANS(stop_lat)) *
-                    SIN(RADIANS(stop_lon - :user_lon) / 2) * SIN(RADIANS(stop_lon - :user_lon) / 2)
-                ))
-            )
-        ) * 3.28084 AS distance_feet
-    FROM stops
-    WHERE (
-        6371000 * 2 * ATAN2(
-            SQRT(
-                SIN(RADIANS(stop_lat - :user_lat) / 2) * SIN(RADIANS(stop_lat - :user_lat) / 2) +
-                COS(RADIANS(:user_lat)) * COS(RADIANS(stop_lat)) *
-                SIN(RADIANS(stop_lon - :user_lon) / 2) * SIN(RADIANS(stop_lon - :user_lon) / 2)
-            ),
-            SQRT(1 - (
-                SIN(RADIANS(stop_lat - :user_lat) / 2) * SIN(RADIANS(stop_lat - :user_lat) / 2) +
-                COS(RADIANS(:user_lat)) * COS(RADIANS(stop_lat)) *
-                SIN(RADIANS(stop_lon - :user_lon) / 2) * SIN(RADIANS(stop_lon - :user_lon) / 2)
-            ))
-        )
-    ) * 3.28084 <= :distance_limit
-),
-trip_times AS (
-    SELECT 
-        t.route_id,
-        t.branch_letter,
-        st.trip_id,
-        st.stop_id,
-        st.departure_time,
-        (
-            CASE
-                WHEN CAST(SUBSTR(st.departure_time, 1, 2) AS INTEGER) >= 24 THEN
-                    (CAST(SUBSTR(st.departure_time, 1, 2) AS INTEGER) - 24) * 3600 +
-                    CAST(SUBSTR(st.departure_time, 4, 2) AS INTEGER) * 60 +
-                    CAST(SUBSTR(st.departure_time, 7, 2) AS INTEGER) + 86400
-                ELSE
-                    CAST(SUBSTR(st.departure_time, 1, 2) AS INTEGER) * 3600 +
-                    CAST(SUBSTR(st.departure_time, 4, 2) AS INTEGER) * 60 +
-                    CAST(SUBSTR(st.departure_time, 7, 2) AS INTEGER)
-            END
-        ) AS departure_time_seconds,
-        (CASE 
-            WHEN t.trip_id LIKE '%Reduced%' THEN 'Reduced'
-            WHEN t.trip_id LIKE '%Holiday%' THEN 'Holiday'
-            WHEN t.trip_id LIKE '%Saturday%' THEN 'Saturday'
-            WHEN t.trip_id LIKE '%Sunday%' THEN 'Sunday'
-            ELSE 'Weekday'
-        END) AS schedule_type
-    FROM stop_times st
-    JOIN trips t ON st.trip_id = t.trip_id
-    JOIN nearby_stops ns ON st.stop_id = ns.stop_id
-    WHERE st.departure_time IS NOT NULL
-),
-lagged_times AS (
-    SELECT 
-        route_id,
-        branch_letter,
-        schedule_type,
-        departure_time_seconds,
-        departure_time_seconds - LAG(departure_time_seconds) OVER (
-            PARTITION BY route_id, branch_letter, schedule_type ORDER BY departure_time_seconds
-        ) AS frequency_gap
-    FROM trip_times
-),
-frequency_analysis AS (
-    SELECT 
-        route_id,
-        branch_letter,
-        schedule_type,
-        COUNT(*) AS total_trips,
-        MIN(departure_time_seconds) AS first_trip,
-        MAX(departure_time_seconds) AS last_trip,
-        AVG(frequency_gap) / 60 AS average_frequency,
-        MIN(frequency_gap) / 60 AS min_frequency_minutes,
-        MAX(frequency_gap) / 60 AS max_frequency_minutes
-    FROM lagged_times
-    GROUP BY route_id, branch_letter, schedule_type
-),
-frequency_flags AS (
-    SELECT 
-        route_id,
-        branch_letter,
-        schedule_type,
-        total_trips,
-        first_trip,
-        last_trip,
-        average_frequency,
-        min_frequency_minutes,
-        max_frequency_minutes,
-        CASE 
-            WHEN total_trips = 0 THEN 0
-            WHEN total_trips = 1 THEN 1  -- Single trip always red
-            WHEN average_frequency > :frequency_limit THEN 1
-            ELSE 2
-        END AS frequency_flag
-    FROM frequency_analysis
-)
-SELECT 
-    route_id,
-    branch_letter,
-    MAX(CASE WHEN schedule_type = 'Reduced' THEN frequency_flag ELSE 0 END) AS reduced,
-    MAX(CASE WHEN schedule_type = 'Holiday' THEN frequency_flag ELSE 0 END) AS holiday,
-    MAX(CASE WHEN schedule_type = 'Saturday' THEN frequency_flag ELSE 0 END) AS saturday,
-    MAX(CASE WHEN schedule_type = 'Sunday' THEN frequency_flag ELSE 0 END) AS sunday,
-    MAX(CASE WHEN schedule_type = 'Weekday' THEN frequency_flag ELSE 0 END) AS weekday,
-    MIN(first_trip) AS first_run_seconds,
-    MAX(last_trip) AS last_run_seconds,
-    MAX(total_trips) AS total_trips,
-    MIN(min_frequency_minutes) AS most_frequent_minutes,
-    MAX(max_frequency_minutes) AS least_frequent_minutes
-FROM frequency_flags
-GROUP BY route_id, branch_letter
-ORDER BY route_id, branch_letter;
-
-
-     """
-
-#         test0 = """
-# SELECT 
-#     t.route_id,
-#     t.branch_letter,
-#     st.trip_id,
-#     st.departure_time,
-#     LAG(st.departure_time) OVER (
-#         PARTITION BY t.route_id, t.branch_letter
-#         ORDER BY st.departure_time
-#     ) AS prev_departure_time
-# FROM stop_times st
-# JOIN trips t ON st.trip_id = t.trip_id
-# LIMIT 10;
-
-# """
-
-#         test1 = """
-# SELECT 
-#     st.departure_time,
-#     CASE
-#         WHEN CAST(SUBSTR(st.departure_time, 1, 2) AS INTEGER) >= 24 THEN
-#             (CAST(SUBSTR(st.departure_time, 1, 2) AS INTEGER) - 24) * 3600 +
-#             CAST(SUBSTR(st.departure_time, 4, 2) AS INTEGER) * 60 +
-#             CAST(SUBSTR(st.departure_time, 7, 2) AS INTEGER) + 86400
-#         ELSE
-#             CAST(SUBSTR(st.departure_time, 1, 2) AS INTEGER) * 3600 +
-#             CAST(SUBSTR(st.departure_time, 4, 2) AS INTEGER) * 60 +
-#             CAST(SUBSTR(st.departure_time, 7, 2) AS INTEGER)
-#     END AS departure_time_seconds
-# FROM stop_times st
-# WHERE st.departure_time IS NOT NULL;
-        
-# """
-        
-#         testquery = """
-# SELECT 
-#         stop_id,
-#         stop_lat,
-#         stop_lon,
-#         (
-#             6371000 * 2 * ATAN2(
-#                 SQRT(
-#                     SIN(RADIANS(stop_lat - :user_lat) / 2) * SIN(RADIANS(stop_lat - :user_lat) / 2) +
-#                     COS(RADIANS(:user_lat)) * COS(RADIANS(stop_lat)) *
-#                     SIN(RADIANS(stop_lon - :user_lon) / 2) * SIN(RADIANS(stop_lon - :user_lon) / 2)
-#                 ),
-#                 SQRT(1 - (
-#                     SIN(RADIANS(stop_lat - :user_lat) / 2) * SIN(RADIANS(stop_lat - :user_lat) / 2) +
-#                     COS(RADIANS(:user_lat)) * COS(RADIANS(stop_lat)) *
-#                     SIN(RADIANS(stop_lon - :user_lon) / 2) * SIN(RADIANS(stop_lon - :user_lon) / 2)
-#                 ))
-#             )
-#         ) * 3.28084 AS distance_feet
-#     FROM stops
-#     WHERE (
-#         6371000 * 2 * ATAN2(
-#             SQRT(
-#                 SIN(RADIANS(stop_lat - :user_lat) / 2) * SIN(RADIANS(stop_lat - :user_lat) / 2) +
-#                 COS(RADIANS(:user_lat)) * COS(RADIANS(stop_lat)) *
-#                 SIN(RADIANS(stop_lon - :user_lon) / 2) * SIN(RADIANS(stop_lon - :user_lon) / 2)
-#             ),
-#             SQRT(1 - (
-#                 SIN(RADIANS(stop_lat - :user_lat) / 2) * SIN(RADIANS(stop_lat - :user_lat) / 2) +
-#                 COS(RADIANS(:user_lat)) * COS(RADIANS(stop_lat)) *
-#                 SIN(RADIANS(stop_lon - :user_lon) / 2) * SIN(RADIANS(stop_lon - :user_lon) / 2)
-#             ))
-#         )
-#     ) * 3.28084 <= :distance_limit
-#         """
-
-
-#         testquery2 = """
-# SELECT 
-#         t.route_id,
-#         t.branch_letter,
-#         st.trip_id,
-#         st.stop_id,
-#         st.departure_time,
-#         (
-#             CASE
-#                 WHEN CAST(SUBSTR(st.departure_time, 1, 2) AS INTEGER) >= 24 THEN
-#                     (CAST(SUBSTR(st.departure_time, 1, 2) AS INTEGER) - 24) * 3600 +
-#                     CAST(SUBSTR(st.departure_time, 4, 2) AS INTEGER) * 60 +
-#                     CAST(SUBSTR(st.departure_time, 7, 2) AS INTEGER) + 86400
-#                 ELSE
-#                     CAST(SUBSTR(st.departure_time, 1, 2) AS INTEGER) * 3600 +
-#                     CAST(SUBSTR(st.departure_time, 4, 2) AS INTEGER) * 60 +
-#                     CAST(SUBSTR(st.departure_time, 7, 2) AS INTEGER)
-#             END
-#         ) AS departure_time_seconds,
-#         (CASE 
-#             WHEN t.trip_id LIKE '%Reduced%' THEN 'Reduced'
-#             WHEN t.trip_id LIKE '%Holiday%' THEN 'Holiday'
-#             WHEN t.trip_id LIKE '%Saturday%' THEN 'Saturday'
-#             WHEN t.trip_id LIKE '%Sunday%' THEN 'Sunday'
-#             ELSE 'Weekday'
-#         END) AS schedule_type
-#     FROM stop_times st
-#     JOIN trips t ON st.trip_id = t.trip_id
-#     JOIN nearby_stops ns ON st.stop_id = ns.stop_id
-#     WHERE st.departure_time IS NOT NULL
-#         """
-
-#         testquery3 = """
-# SELECT 
-#         route_id,
-#         branch_letter,
-#         schedule_type,
-#         COUNT(*) AS total_trips,
-#         MIN(departure_time_seconds) AS first_trip,
-#         MAX(departure_time_seconds) AS last_trip,
-#         CASE 
-#             WHEN COUNT(*) > 1 THEN (MAX(departure_time_seconds) - MIN(departure_time_seconds)) / (COUNT(*) - 1) / 60
-#             ELSE NULL
-#         END AS average_frequency,
-#         MIN(departure_time_seconds - LAG(departu
-#         # cursor.execute(testquery, {
-#         #     "user_lat": user_lat,re_time_seconds) OVER (
-#             PARTITION BY route_id, branch_letter, schedule_type ORDER BY departure_time_seconds
-#         )) AS min_frequency_minutes,
-#         MAX(departure_time_seconds - LAG(departure_time_seconds) OVER (
-#             PARTITION BY route_id, branch_letter, schedule_type ORDER BY departure_time_seconds
-#         )) AS max_frequency_minutes
-#     FROM trip_times
-#     GROUP BY route_id, branch_letter, schedule_type        
-# """
-
-
-        # print ("testquery1.txt")
-        # # Execute the query with parameters
-        # cursor = conn.cursor()
-        #     "user_lon": user_lon,
-        #     "distance_limit": distance_limit,
-        #     "frequency_limit": frequency_limit
-        # })
-        # results = cursor.fetchall()
-
-        # # Close the connection
-        # conn.close()
-
-        # with open("testquery.txt", "w") as json_file:
-        #     json.dump(results, json_file, indent=4)
-
-        # print ("testquery3.txt")
-        # # Execute the query with parameters
-        # cursor = conn.cursor()
-        # cursor.execute(testquery3, {
-        #     "user_lat": user_lat,
-        #     "user_lon": user_lon,
-        #     "distance_limit": distance_limit,
-        #     "frequency_limit": frequency_limit
-        # })
-        # results = cursor.fetchall()
-        # print ("testquery3.txt")
-        # # Execute the query with parameters
-        # cursor = conn.cursor()
-        # cursor.execute(testquery3, {
-        #     "user_lat": user_lat,
-        #     "user_lon": user_lon,
-        #     "distance_limit": distance_limit,
-        #     "frequency_limit": frequency_limit
-        # })
-        # results = cursor.fetchall()
-
-        # # Close the connection
-        # conn.close()
-
-        # with open("testquery3.txt", "w") as json_file:
-        #     json.dump(results, json_file, indent=4)
-        # # Close the connection
-        # conn.close()
-
-        # with open("testquery3.txt", "w") as json_file:
-        #     json.dump(results, json_file, indent=4)
-
-        # print ("test1.txt")
-        # # Execute the query with parameters
-        # cursor = conn.cursor()
-        # cursor.execute(test1, {
-        #     "user_lat": user_lat,
-        #     "user_lon": user_lon,
-        #     "distance_limit": distance_limit,
-        #     "frequency_limit": frequency_limit
-        # })
-        # results = cursor.fetchall()
-
-        # # Close the connection
-        # conn.close()
-
-        # with open("test1.txt", "w") as json_file:
-        #     json.dump(results, json_file, indent=4)
-
-        # print ("runschedule.txt")
-        # # Execute the query with parameters
-        # cursor = conn.cursor()
-        # cursor.execute(query, {
-        #     "user_lat": user_lat,
-        #     "user_lon": user_lon,
-        #     "distance_limit": distance_limit,
-        #     "frequency_limit": frequency_limit
-        # })
-        # results = cursor.fetchall()
-
-        # # Close the connection
-        # conn.close()
-
-        # with open("runschedule.txt", "w") as json_file:
-        #     json.dump(results, json_file, indent=4)
-
-        # print ("testquery2.txt")
-        # # Execute the query with parameters
-        # cursor = conn.cursor()
-        # cursor.execute(testquery2, {
-        #     "user_lat": user_lat,
-        #     "user_lon": user_lon,
-        #     "distance_limit": distance_limit,
-        #     "frequency_limit": frequency_limit
-        # })
-        # results = cursor.fetchall()
-
-        # # Close the connection
-        # conn.close()
-
-        # with open("testquery2.txt", "w") as json_file:
-        #     json.dump(results, json_file, indent=4)
-
-
-
-
-        print ("part2")
-        # Execute the query with parameters
-        cursor = conn.cursor()
         try:
-            cursor.execute(query, {
-                "user_lat": user_lat,
-                "user_lon": user_lon,
-                "distance_limit": distance_limit,
-                "frequency_limit": frequency_limit
-            })
+            results = frequency_rows(
+                conn, nearby_stop_ids, frequency_limit, service_ids,
+                backend=current_app.config["FREQUENCY_BACKEND"], window=window,
+            )
         except sqlite3.Error as e:
             print(f"SQL execution error: {e}")
-            print(f"Query: {query}")
             print(f"Parameters: user_lat={user_lat}, user_lon={user_lon}, distance_limit={distance_limit}, frequency_limit={frequency_limit}")
             raise  # Re-raise the exception to propagate it
+        finally:
+            # Close the connection
+            conn.close()
 
-        results = cursor.fetchall()
-        print(results)
-        # Close the connection
-        conn.close()
+        print(f"Frequencies calculated for {len(nearby_stop_ids)} nearby stops.")
+        response = jsonify(results)
+        cache.put(feed["version"], cache_key, response.get_data())
+        return response
 
-        print("Frequencies calculated.")
-        with open("frequency_data.json", "w") as json_file:
-            json.dump(results, json_file, indent=4)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
+@main.route('/api/cache_stats', methods=['GET'])
+def cache_stats():
+    """Hit/miss counters and memory use of the response caches, and per-host upstream counters."""
+    stats = {"schedule_nearby": current_app.extensions["nearby_cache"].stats()}
+    if current_app.extensions.get("poi_cache") is not None:
+        stats["pois"] = current_app.extensions["poi_cache"].stats()
+    stats["walking_distances"] = current_app.extensions["walking_distances"].stats()
+    stats["departures"] = departures_cache.stats()
+    stats["vehicles"] = current_app.extensions["vehicle_hub"].stats()
+    stats["upstream"] = transport.stats()
+    return jsonify(stats)
+    
+@main.route('/api/stream/vehicles', methods=['GET'])
+def stream_vehicles():
+    """
+    Server-Sent Events stream of a route's vehicle positions: a "snapshot"
+    event with every vehicle, then "update" events with only the vehicles
+    that moved and the trip ids that left. All clients watching a route
+    share one upstream poll.
+    """
+    route_id = request.args.get("route_id")
+    if not route_id:
+        return jsonify({"error": "Missing route_id"}), 400
 
+    hub = current_app.extensions["vehicle_hub"]
+    keepalive = current_app.config["VEHICLE_STREAM_KEEPALIVE"]
+    subscription = hub.subscribe(route_id)
 
-        return jsonify(results)
+    def generate():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                message = subscription.get(timeout=keepalive)
+                if message is None:
+                    # Comment lines keep proxies from closing an idle stream
+                    yield ": keep-alive\n\n"
+                    continue
+                event, data = message
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            hub.unsubscribe(subscription)
+
+    response = Response(generate(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
 
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-    
 #make a bus route on the map after the user clicks the bus route
 @main.route('/api/route_shape', methods=['GET'])
+@conditional_on_feed
 def route_shape():
     """
-    Fetch and return the GeoJSON shape of a specified route and branch.
+    Fetch and return the shape of a specified route and branch, as GeoJSON
+    or (format=polyline) as encoded polylines.
+
+    Shapes are simplified to the detail visible at the given map zoom, or to
+    an explicit tolerance in meters; without either, every point is kept.
     """
     print('Trying to shape out the route')
     try:
         # Retrieve route_id and branch_letter from request parameters
         route_id = request.args.get("route_id")
         branch_letter = request.args.get("branch_letter", None)  # Optional
+        output_format = request.args.get("format", "geojson")
 
         if not route_id:
             return jsonify({"error": "Route ID is required"}), 400
+        if output_format not in ("geojson", "polyline"):
+            return jsonify({"error": "format must be geojson or polyline"}), 400
+        try:
+            if request.args.get("zoom") is not None:
+                tolerance = tolerance_for_zoom(float(request.args.get("zoom")))
+            else:
+                tolerance = float(request.args.get("tolerance", 0))
+        except ValueError:
+            return jsonify({"error": "zoom and tolerance must be numbers"}), 400
 
         # Connect to SQLite database
-        db_path = os.path.join(CACHE_DIR, "gtfs.db")
-        conn = sqlite3.connect(db_path)
-
-        # Build SQL query to get shape data
-        query = """
-            SELECT s.shape_id, s.shape_pt_lat AS lat, s.shape_pt_lon AS lon, s.shape_pt_sequence AS seq
-            FROM shapes s
-            JOIN trips t ON s.shape_id = t.shape_id
-            WHERE t.route_id = ?
-        """
-
-        params = [route_id]
-
-        # If branch_letter is provided, add it to the query
-        if branch_letter:
-            query += " AND t.branch_letter = ?"
-            params.append(branch_letter)
-
-        query += " ORDER BY s.shape_id, s.shape_pt_sequence"
-
-        # Execute query
-        cursor = conn.cursor()
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        conn.close()
+        feed = get_current_feed()
+        if feed is None:
+            return jsonify({"error": GTFS_LOADING_ERROR}), 503
+        conn = connect_gtfs_db(feed)
+
+        try:
+            if has_table(conn, "shape_geometries"):
+                polylines = route_shape_polylines(conn, route_id, branch_letter, tolerance)
+            else:
+                # Feed built before shapes were precomputed: read the raw points
+                polylines = raw_route_shape_polylines(conn, route_id, branch_letter)
+        finally:
+            conn.close()
 
-        if not rows:
+        if not polylines:
             return jsonify({"error": "No shape data found for the specified route and branch"}), 404
 
-        # Group data by shape_id
-        from collections import defaultdict
-        shapes = defaultdict(list)
-        for row in rows:
-            shape_id = row[0]
-            lat, lon = row[1], row[2]
-            shapes[shape_id].append((lon, lat))  # (lon, lat) format
+        if output_format == "polyline":
+            return jsonify({
+                "route_id": route_id,
+                "branch_letter": branch_letter,
+                "precision": POLYLINE_PRECISION,
+                "shapes": [{"shape_id": shape_id, "polyline": polyline} for shape_id, polyline in polylines],
+            })
 
         # Prepare GeoJSON structure
         geojson = {
@@ -892,12 +531,12 @@ def route_shape():
             "features": []
         }
 
-        for shape_id, coordinates in shapes.items():
+        for shape_id, polyline in polylines:
             geojson["features"].append({
                 "type": "Feature",
                 "geometry": {
                     "type": "LineString",
-                    "coordinates": coordinates
+                    "coordinates": [(lon, lat) for lat, lon in decode_polyline(polyline)]  # (lon, lat) format
                 },
                 "properties": {
                     "route_id": route_id,
@@ -912,11 +551,234 @@ def route_shape():
         print(f"Error: {e}")
         return jsonify({"error": str(e)}), 500
 
+def raw_route_shape_polylines(conn, route_id, branch_letter=None):
+    """Read a route's distinct shapes straight from the shapes table, as [(shape_id, polyline)]."""
+    query = """
+        SELECT s.shape_id, s.shape_pt_lat, s.shape_pt_lon
+        FROM shapes s
+        WHERE s.shape_id IN (SELECT shape_id FROM trips WHERE route_id = ?{branch_filter})
+        ORDER BY s.shape_id, s.shape_pt_sequence
+    """
+    params = [route_id]
+    if branch_letter:
+        params.append(branch_letter)
+    rows = conn.execute(query.format(branch_filter=" AND branch_letter = ?" if branch_letter else ""), params)
+    return [
+        (shape_id, encode_polyline([(lat, lon) for _, lat, lon in points]))
+        for shape_id, points in groupby(rows, key=lambda row: row[0])
+    ]
+
+@main.route('/tiles/<int:z>/<int:x>/<int:y>')
+@conditional_on_feed
+def route_tile(z, x, y):
+    """Serve one GeoJSON tile of the route and stop layer, rendered on first use."""
+    if not is_valid_tile(z, x, y):
+        return jsonify({"error": "No such tile"}), 404
+    feed = get_current_feed()
+    if feed is None:
+        return jsonify({"error": GTFS_LOADING_ERROR}), 503
+    return send_file(cached_tile_path(feed, z, x, y), mimetype="application/geo+json", etag=feed_etag(feed))
+
+def legacy_route_stops(conn, route_id, branch_letter=None, from_sequence=None):
+    """
+    Read a route's stops straight from stop_times, once per trip, for feeds
+    built before route patterns were derived.
+    """
+    query = """
+        SELECT s.stop_id, s.stop_lat, s.stop_lon, st.stop_sequence
+        FROM stops s
+        JOIN stop_times st ON s.stop_id = st.stop_id
+        JOIN trips t ON st.trip_id = t.trip_id
+        WHERE t.route_id = ?
+    """
+    params = [route_id]
+    if branch_letter:
+        query += " AND t.branch_letter = ?"
+        params.append(branch_letter)
+    if from_sequence is not None:
+        query += " AND st.stop_sequence >= ? ORDER BY st.stop_sequence"
+        params.append(from_sequence)
+    return conn.execute(query, params).fetchall()
+
+def subsequent_route_stops(feed, route_id, branch_letter, user_lat, user_lon):
+    """
+    The stops of a route from the one nearest the user on, in riding order.
+    Returns (stops, None), or (None, error message) when there are none.
+    """
+    conn = connect_gtfs_db(feed)
+    try:
+        # Step 1: Find the nearest stop to the user among the stops the
+        # route's patterns serve
+        if has_table(conn, "route_patterns"):
+            stops = route_stops(conn, route_id, branch_letter)
+        else:
+            stops = legacy_route_stops(conn, route_id, branch_letter)
+
+        if not stops:
+            return None, "No stops found for the specified route"
+
+        # Find the nearest stop to the user
+        nearest_stop = min(
+            stops,
+            key=lambda stop: haversine_distance(user_lat, user_lon, stop[1], stop[2])
+        )
+
+        # Step 2: Get the stops from there on, in riding order
+        if has_table(conn, "route_patterns"):
+            subsequent_stops = downstream_stops(conn, route_id, branch_letter, nearest_stop[0])
+        else:
+            subsequent_stops = legacy_route_stops(conn, route_id, branch_letter, nearest_stop[3])
+
+        if not subsequent_stops:
+            return None, "No subsequent stops found for the specified route"
+        return subsequent_stops, None
+    finally:
+        conn.close()
+
+def poi_stop_box(stop):
+    stop_lat, stop_lon = stop[1], stop[2]
+    return (stop_lat - 0.01, stop_lon - 0.01, stop_lat + 0.01, stop_lon + 0.01)
+
+def filter_pois_for_stop(stop, pois, walking_distance):
+    """The POIs within walking_distance of a stop in a straight line, shaped for the response."""
+    stop_id, stop_lat, stop_lon, stop_sequence = stop
+
+    # Filter POIs by walking distance
+    filtered = []
+    for poi in pois:
+        poi_lat = poi["lat"]
+        poi_lon = poi["lon"]
+
+        # Calculate distance from the stop
+        distance = haversine_distance(stop_lat, stop_lon, poi_lat, poi_lon)
+        if distance <= walking_distance:
+            filtered.append({
+                "name": poi.get("tags", {}).get("name", "Unknown POI"),
+                "type": poi.get("tags", {}).get("amenity", "Unknown Type"),
+                "distance": distance,
+                "stop": {
+                    "stop_id": stop_id,
+                    "stop_sequence": stop_sequence,
+                    "stop_lat": stop_lat,
+                    "stop_lon": stop_lon
+                },
+                "coordinates": (poi_lat, poi_lon)
+            })
+    return filtered
+
+def with_walking_distances(walking, walking_distance, results):
+    """
+    Swap the straight-line distances of [(stop, pois)] for walking ones and
+    drop the POIs that are now too far. No walk is shorter than the
+    straight line, so only the POIs kept so far need one, and every stop's
+    are asked for in one batch.
+    """
+    if walking is None:
+        return results
+    pairs = [((stop[1], stop[2]), poi["coordinates"]) for stop, pois in results for poi in pois]
+    distances = iter(walking.pair_distances(pairs) if pairs else [])
+    for _, pois in results:
+        for poi in pois:
+            poi["distance"] = next(distances)
+    return [(stop, [poi for poi in pois if poi["distance"] <= walking_distance]) for stop, pois in results]
+
+def local_route_pois(app, unique_stops, walking_distance):
+    """
+    Step 3 for the POI sources that need no query per stop: [(stop, pois)]
+    for every stop from the local POI store when one has been imported, the
+    shared POI cache or one corridor query. Returns None when each stop
+    must be looked up in Overpass on its own.
+    """
+    poi_conn = open_poi_store(app.config["POI_DB_PATH"])
+    if poi_conn is not None:
+        # Local lookups are quick R*Tree reads
+        try:
+            return [
+                (stop, filter_pois_for_stop(stop, amenities_in_box(poi_conn, *poi_stop_box(stop)), walking_distance))
+                for stop in unique_stops
+            ]
+        finally:
+            poi_conn.close()
+
+    poi_cache = app.extensions.get("poi_cache")
+    if poi_cache is not None:
+        # Cells of the shared POI cache, with the missing ones fetched in one
+        # request. Cached cells must hold everything in them, so in corridor
+        # mode the corridor runs through the missing cells' centers.
+        fetch_boxes = fetch_osm_amenities_in_boxes
+        if app.config["POI_OVERPASS_MODE"] == "corridor":
+            fetch_boxes = lambda boxes: fetch_corridor_boxes(boxes, fetch_osm_amenities_around)
+        fetched = index_amenities(cached_amenities(
+            poi_cache, "amenity", [poi_stop_box(stop) for stop in unique_stops], fetch_boxes
+        ))
+    elif app.config["POI_OVERPASS_MODE"] == "corridor":
+        # One query along the route instead of one per stop. A POI further
+        # than the walking distance, or than the corner of the box each stop
+        # searches, can never be kept, so that bounds the corridor width.
+        points = list(dict.fromkeys((stop[1], stop[2]) for stop in unique_stops))
+        fetched = fetch_corridor_amenities(
+            points, min(walking_distance, POI_BOX_REACH_METERS), fetch_osm_amenities_around
+        )
+    else:
+        return None
+    return [
+        (stop, filter_pois_for_stop(stop, amenities_in_box_index(fetched, *poi_stop_box(stop)), walking_distance))
+        for stop in unique_stops
+    ]
+
+def streamed_stop_line(stop_positions, stop, pois, seen, dedupe):
+    """One NDJSON line of a streamed pois_along_route response."""
+    pois.sort(key=lambda x: x["distance"])
+    if dedupe:
+        # Streamed POIs cannot move to a closer stop later, so each one
+        # stays with the first stop that lists it
+        pois = [poi for poi in pois if (poi["coordinates"], poi["name"], poi["type"]) not in seen]
+        seen.update((poi["coordinates"], poi["name"], poi["type"]) for poi in pois)
+    stop_id, stop_lat, stop_lon, stop_sequence = stop
+    return json.dumps({
+        "index": stop_positions[stop],
+        "stop": {
+            "stop_id": stop_id,
+            "stop_sequence": stop_sequence,
+            "stop_lat": stop_lat,
+            "stop_lon": stop_lon
+        },
+        "pois": pois
+    }) + "\n"
+
+def pois_in_riding_order(subsequent_stops, pois_by_stop, dedupe):
+    """
+    Step 4: List POIs stop by stop in riding order, nearest first at each
+    stop. stop_sequence comes from several patterns, so it cannot order the
+    stops.
+    """
+    filtered_pois = [
+        poi for stop in subsequent_stops
+        for poi in sorted(pois_by_stop.get(stop, []), key=lambda x: x["distance"])
+    ]
+
+    # Optionally list every POI only once, at the stop closest to it
+    if dedupe:
+        nearest = {}
+        for poi in filtered_pois:
+            key = (poi["coordinates"], poi["name"], poi["type"])
+            if key not in nearest or poi["distance"] < nearest[key]["distance"]:
+                nearest[key] = poi
+        filtered_pois = [
+            poi for poi in filtered_pois
+            if nearest[(poi["coordinates"], poi["name"], poi["type"])] is poi
+        ]
+    return filtered_pois
+
 @main.route('/api/pois_along_route', methods=['GET'])
 def pois_along_route():
     """
     Fetch POIs along the specified route, starting from the nearest stop to the user
-    and moving in the direction of the route.
+    and moving in the direction of the route. With stream=1 or an Accept of
+    application/x-ndjson, each stop's POIs are sent as one NDJSON line as soon
+    as they are found. With metric=walking, distances are walking distances
+    from the stop rather than straight-line ones. app/asgi.py serves the
+    same endpoint as a coroutine.
     """
     try:
         # Retrieve parameters
@@ -925,117 +787,74 @@ def pois_along_route():
         user_lat = float(request.args.get("lat"))
         user_lon = float(request.args.get("lon"))
         walking_distance = float(request.args.get("distance"))
+        walking = current_app.extensions["walking_distances"] if request.args.get("metric") == "walking" else None
 
         if not route_id or not user_lat or not user_lon or not walking_distance:
             return jsonify({"error": "Missing required parameters"}), 400
 
-        # Connect to SQLite database
-        db_path = os.path.join(CACHE_DIR, "gtfs.db")
-        conn = sqlite3.connect(db_path)
-
-        # Step 1: Find the nearest stop to the user
-        nearest_stop_query = """
-            SELECT s.stop_id, s.stop_lat, s.stop_lon, st.stop_sequence
-            FROM stops s
-            JOIN stop_times st ON s.stop_id = st.stop_id
-            JOIN trips t ON st.trip_id = t.trip_id
-            WHERE t.route_id = ?
-        """
-        params = [route_id]
-        if branch_letter:
-            nearest_stop_query += " AND t.branch_letter = ?"
-            params.append(branch_letter)
-
-        cursor = conn.cursor()
-        cursor.execute(nearest_stop_query, params)
-        stops = cursor.fetchall()
-
-        if not stops:
-            return jsonify({"error": "No stops found for the specified route"}), 404
-
-        # Find the nearest stop to the user
-        nearest_stop = min(
-            stops,
-            key=lambda stop: haversine_distance(user_lat, user_lon, stop[1], stop[2])
-        )
-        user_stop_sequence = nearest_stop[3]
-
-        # Step 2: Get all stops after the nearest stop
-        subsequent_stops_query = """
-            SELECT s.stop_id, s.stop_lat, s.stop_lon, st.stop_sequence
-            FROM stops s
-            JOIN stop_times st ON s.stop_id = st.stop_id
-            JOIN trips t ON st.trip_id = t.trip_id
-            WHERE t.route_id = ? AND st.stop_sequence >= ?
-            ORDER BY st.stop_sequence
-        """
-        params = [route_id, user_stop_sequence]
-        if branch_letter:
-            subsequent_stops_query += " AND t.branch_letter = ?"
-            params.append(branch_letter)
-
-        cursor.execute(subsequent_stops_query, params)
-        subsequent_stops = cursor.fetchall()
-
-        if not subsequent_stops:
-            return jsonify({"error": "No subsequent stops found for the specified route"}), 404
-
-        # Step 3: Parallelize OSM queries for all stops
-        def fetch_pois_for_stop(stop):
-            stop_id, stop_lat, stop_lon, stop_sequence = stop
-            bounding_box = (
-                stop_lat - 0.01, stop_lon - 0.01, stop_lat + 0.01, stop_lon + 0.01
-            )
-            overpass_query = f"""
-            [out:json];
-            node
-              ["amenity"]
-              ({bounding_box[0]},{bounding_box[1]},{bounding_box[2]},{bounding_box[3]});
-            out body;
-            """
-            response = requests.post("https://overpass-api.de/api/interpreter", data={"data": overpass_query})
-            response.raise_for_status()
-            pois = response.json()["elements"]
-
-            # Filter POIs by walking distance
-            filtered = []
-            for poi in pois:
-                poi_lat = poi["lat"]
-                poi_lon = poi["lon"]
-
-                # Calculate distance from the stop
-                distance = haversine_distance(stop_lat, stop_lon, poi_lat, poi_lon)
-                if distance <= walking_distance:
-                    filtered.append({
-                        "name": poi.get("tags", {}).get("name", "Unknown POI"),
-                        "type": poi.get("tags", {}).get("amenity", "Unknown Type"),
-                        "distance": distance,
-                        "stop": {
-                            "stop_id": stop_id,
-                            "stop_sequence": stop_sequence,
-                            "stop_lat": stop_lat,
-                            "stop_lon": stop_lon
-                        },
-                        "coordinates": (poi_lat, poi_lon)
-                    })
-            return filtered
-
-        # Use ThreadPoolExecutor to parallelize OSM queries
-        filtered_pois = []
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            future_to_stop = {executor.submit(fetch_pois_for_stop, stop): stop for stop in subsequent_stops}
-
-            for future in as_completed(future_to_stop):
-                try:
-                    result = future.result()
-                    filtered_pois.extend(result)
-                except Exception as e:
-                    print(f"Error fetching POIs for stop: {e}")
-
-        # Step 4: Sort POIs by stop_sequence and distance
-        filtered_pois.sort(key=lambda x: (x["stop"]["stop_sequence"], x["distance"]))
-
-        return jsonify(filtered_pois)
+        feed = get_current_feed()
+        if feed is None:
+            return jsonify({"error": GTFS_LOADING_ERROR}), 503
+        subsequent_stops, error = subsequent_route_stops(feed, route_id, branch_letter, user_lat, user_lon)
+        if error:
+            return jsonify({"error": error}), 404
+
+        # Step 3: Look up the amenities around every stop, in the local POI
+        # store when one has been imported, otherwise through Overpass
+        if not poi_store_imported(current_app.config["POI_DB_PATH"]) and not current_app.config["POI_OVERPASS_FALLBACK"]:
+            return jsonify({"error": "No local POI store has been imported"}), 503
+
+        # The same stop comes back once per trip; look each one up only once
+        unique_stops = list(dict.fromkeys(subsequent_stops))
+        local_results = local_route_pois(current_app, unique_stops, walking_distance)
+
+        def stop_results():
+            """Yield (stop, pois) for every stop as soon as its POIs are known."""
+            if local_results is not None:
+                yield from local_results
+                return
+
+            # One Overpass query per stop, all in flight on the shared event
+            # loop (the transport caps how many reach Overpass at once)
+            future_to_stop = {
+                transport.submit(fetch_osm_amenities_async(*poi_stop_box(stop))): stop for stop in unique_stops
+            }
+            try:
+                for future in as_completed(future_to_stop):
+                    try:
+                        pois = future.result()
+                    except Exception as e:
+                        print(f"Error fetching POIs for stop: {e}")
+                        continue
+                    stop = future_to_stop[future]
+                    yield stop, filter_pois_for_stop(stop, pois, walking_distance)
+            finally:
+                # A client that hangs up mid-stream leaves no queued lookups behind
+                for future in future_to_stop:
+                    future.cancel()
+
+        dedupe = request.args.get("dedupe", "").lower() in ("1", "true", "yes")
+        streaming = request.args.get("stream", "").lower() in ("1", "true", "yes") or \
+            request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"]) == "application/x-ndjson"
+
+        if streaming:
+            stop_positions = {stop: index for index, stop in enumerate(unique_stops)}
+
+            def generate():
+                # One line per stop, in the order the lookups finish; "index"
+                # is the stop's place along the route
+                seen = set()
+                for stop, pois in stop_results():
+                    [(_, pois)] = with_walking_distances(walking, walking_distance, [(stop, pois)])
+                    yield streamed_stop_line(stop_positions, stop, pois, seen, dedupe)
+
+            response = Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+            # Keep proxies from holding the lines back until the end
+            response.headers["X-Accel-Buffering"] = "no"
+            return response
+
+        pois_by_stop = dict(with_walking_distances(walking, walking_distance, list(stop_results())))
+        return jsonify(pois_in_riding_order(subsequent_stops, pois_by_stop, dedupe))
 
     except Exception as e:
         print(f"Error: {str(e)}")
@@ -0,0 +1,174 @@
+from datetime import date, datetime, timedelta
+
+WEEKDAY_COLUMNS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+# day_mask bits 0-6 are Monday to Sunday; bit 7 marks services that only run
+# on dates listed in calendar_dates.txt. Those also get the weekday bits of
+# the dates they are added on, but are classified Holiday regardless.
+SPECIAL_DAYS_BIT = 1 << 7
+WEEKDAYS_MASK = 0b0011111
+SATURDAY_BIT = 1 << 5
+SUNDAY_BIT = 1 << 6
+
+
+def parse_gtfs_date(value):
+    return datetime.strptime(str(value), "%Y%m%d").date()
+
+
+def classify_service(service_id, day_mask):
+    """
+    Pick the schedule type of a service from the days it runs.
+
+    calendar.txt cannot tell a reduced weekday timetable from the regular
+    one, so Reduced still comes from the service's name. A service that
+    only runs on dates listed in calendar_dates.txt, or on no day of the
+    week at all, is a Holiday one.
+    """
+    if day_mask & SPECIAL_DAYS_BIT:
+        return "Holiday"
+    if day_mask & WEEKDAYS_MASK:
+        if "reduced" in (service_id or "").lower():
+            return "Reduced"
+        return "Weekday"
+    if day_mask & SATURDAY_BIT:
+        return "Saturday"
+    if day_mask & SUNDAY_BIT:
+        return "Sunday"
+    return "Holiday"
+
+
+def expand_services(calendar_rows, calendar_date_rows):
+    """
+    Expand calendar.txt and calendar_dates.txt rows into
+    {service_id: (start date, end date, day_mask, date_mask)}.
+
+    date_mask has bit i set when the service runs on start date + i days.
+    """
+    services = {}
+    for service_id, *flags, start_date, end_date in calendar_rows:
+        start, end = parse_gtfs_date(start_date), parse_gtfs_date(end_date)
+        day_mask = sum(1 << i for i, flag in enumerate(flags) if flag)
+        date_mask = 0
+        for offset in range((end - start).days + 1):
+            if day_mask & (1 << (start + timedelta(days=offset)).weekday()):
+                date_mask |= 1 << offset
+        services[service_id] = [start, end, day_mask, date_mask]
+
+    exceptions = {}
+    for service_id, service_date, exception_type in calendar_date_rows:
+        exceptions.setdefault(service_id, []).append((parse_gtfs_date(service_date), exception_type))
+
+    dates_only = set()
+    for service_id, entries in exceptions.items():
+        if service_id not in services:
+            # Service that only exists as a list of dates
+            added = [day for day, exception_type in entries if exception_type == 1] or [entries[0][0]]
+            services[service_id] = [min(added), min(added), SPECIAL_DAYS_BIT, 0]
+            dates_only.add(service_id)
+        service = services[service_id]
+        for day, exception_type in entries:
+            if day < service[0]:
+                # Grow the window backwards, shifting the existing bits
+                service[3] <<= (service[0] - day).days
+                service[0] = day
+            service[1] = max(service[1], day)
+            bit = 1 << (day - service[0]).days
+            if exception_type == 1:
+                service[3] |= bit
+            elif exception_type == 2:
+                service[3] &= ~bit
+
+    for service_id in dates_only:
+        # Such a service runs on the days of the week of its dates; the
+        # special-days bit keeps it classified Holiday
+        start, _, _, date_mask = services[service_id]
+        for offset in range(date_mask.bit_length()):
+            if date_mask >> offset & 1:
+                services[service_id][2] |= 1 << (start + timedelta(days=offset)).weekday()
+
+    return {service_id: tuple(values) for service_id, values in services.items()}
+
+
+def _mask_to_blob(mask):
+    return mask.to_bytes(max(1, (mask.bit_length() + 7) // 8), "little")
+
+
+def service_runs_on(start_date, date_mask_blob, day):
+    """Whether a service_calendar row is active on the given date."""
+    offset = (day - parse_gtfs_date(start_date)).days
+    if offset < 0:
+        return False
+    return bool(int.from_bytes(date_mask_blob, "little") >> offset & 1)
+
+
+def build_service_calendar(conn, context):
+    """
+    Store a day-of-week mask, an active-date bitmask and a schedule type
+    for every service, and copy the mask and schedule type onto trips.
+    Returns the number of services.
+    """
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    calendar_rows = []
+    if "calendar" in tables:
+        calendar_rows = conn.execute(
+            f"SELECT service_id, {', '.join(WEEKDAY_COLUMNS)}, start_date, end_date FROM calendar"
+        ).fetchall()
+    calendar_date_rows = []
+    if "calendar_dates" in tables:
+        calendar_date_rows = conn.execute(
+            "SELECT service_id, date, exception_type FROM calendar_dates"
+        ).fetchall()
+    services = expand_services(calendar_rows, calendar_date_rows)
+
+    conn.execute("DROP TABLE IF EXISTS service_calendar")
+    conn.execute("""
+        CREATE TABLE service_calendar (
+            service_id TEXT PRIMARY KEY,
+            start_date TEXT,
+            end_date TEXT,
+            day_mask INTEGER,
+            date_mask BLOB,
+            schedule_type TEXT
+        )
+    """)
+    conn.executemany("INSERT INTO service_calendar VALUES (?, ?, ?, ?, ?, ?)", [
+        (
+            service_id,
+            start.strftime("%Y%m%d"),
+            end.strftime("%Y%m%d"),
+            day_mask,
+            _mask_to_blob(date_mask),
+            classify_service(service_id, day_mask),
+        )
+        for service_id, (start, end, day_mask, date_mask) in services.items()
+    ])
+
+    trip_columns = [row[1] for row in conn.execute("PRAGMA table_info(trips)")]
+    if "day_mask" not in trip_columns:
+        conn.execute("ALTER TABLE trips ADD COLUMN day_mask INTEGER")
+    if "schedule_type" not in trip_columns:
+        conn.execute("ALTER TABLE trips ADD COLUMN schedule_type TEXT")
+    # Trips whose service is missing from both calendar files never run;
+    # they keep a zero mask and are treated as Weekday like before
+    conn.execute("""
+        UPDATE trips SET
+            day_mask = COALESCE((SELECT day_mask FROM service_calendar c WHERE c.service_id = trips.service_id), 0),
+            schedule_type = COALESCE((SELECT schedule_type FROM service_calendar c WHERE c.service_id = trips.service_id), 'Weekday')
+    """)
+    return len(services)
+
+
+def services_on(conn, day):
+    """Return the service_ids that run on the given date."""
+    if isinstance(day, str):
+        day = parse_gtfs_date(day)
+    elif isinstance(day, datetime):
+        day = day.date()
+    if not isinstance(day, date):
+        raise ValueError(f"Invalid service date: {day}")
+
+    key = day.strftime("%Y%m%d")
+    rows = conn.execute(
+        "SELECT service_id, start_date, date_mask FROM service_calendar WHERE start_date <= ? AND end_date >= ?",
+        (key, key),
+    )
+    return {service_id for service_id, start_date, date_mask in rows if service_runs_on(start_date, date_mask, day)}
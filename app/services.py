@@ -1,11 +1,18 @@
 from datetime import datetime
-import requests
 from math import radians, sin, cos, sqrt, atan2
-import aiohttp
 import asyncio
 
+from . import transport
+from .single_flight import SingleFlightCache
+
 OSM_API_URL = "https://overpass-api.de/api/interpreter"
 METRO_TRANSIT_API_URL = "https://svc.metrotransit.org/nextrip"
+# Overpass may take a while to answer large queries
+OVERPASS_READ_TIMEOUT = 90
+
+# NexTrip departures by stop, shared by every caller in this process; the
+# TTL is set from DEPARTURES_CACHE_TTL when the app is created
+departures_cache = SingleFlightCache(ttl=20)
 
 # Query OSM for nearby bus stops
 def fetch_osm_bus_stops(lat, lon, radius):
@@ -14,15 +21,68 @@ def fetch_osm_bus_stops(lat, lon, radius):
     node["highway"="bus_stop"](around:{radius},{lat},{lon});
     out body;
     """
-    response = requests.post(OSM_API_URL, data={"data": query})
+    response = transport.post(OSM_API_URL, data={"data": query}, read_timeout=OVERPASS_READ_TIMEOUT)
+    response.raise_for_status()
+    return response.json()["elements"]
+
+# Query OSM for amenity nodes inside a bounding box
+def fetch_osm_amenities(south, west, north, east):
+    query = f"""
+    [out:json];
+    node
+      ["amenity"]
+      ({south},{west},{north},{east});
+    out body;
+    """
+    response = transport.post(OSM_API_URL, data={"data": query}, read_timeout=OVERPASS_READ_TIMEOUT)
+    response.raise_for_status()
+    return response.json()["elements"]
+
+# Async fetch_osm_amenities, for fanning out many boxes on the shared event loop
+async def fetch_osm_amenities_async(south, west, north, east):
+    query = f"""
+    [out:json];
+    node
+      ["amenity"]
+      ({south},{west},{north},{east});
+    out body;
+    """
+    status, data = await transport.request_json_async(
+        "POST", OSM_API_URL, data={"data": query}, read_timeout=OVERPASS_READ_TIMEOUT
+    )
+    if status != 200:
+        raise ValueError(f"Overpass returned {status}")
+    return data["elements"]
+
+# Query OSM for amenity nodes within radius meters of a line through the given (lat, lon) points
+def fetch_osm_amenities_around(points, radius):
+    coordinates = ",".join(f"{lat},{lon}" for lat, lon in points)
+    query = f"""
+    [out:json];
+    node
+      ["amenity"]
+      (around:{radius},{coordinates});
+    out body;
+    """
+    response = transport.post(OSM_API_URL, data={"data": query}, read_timeout=OVERPASS_READ_TIMEOUT)
+    response.raise_for_status()
+    return response.json()["elements"]
+
+# Query OSM for amenity nodes inside any of several bounding boxes, in one request
+def fetch_osm_amenities_in_boxes(boxes):
+    statements = "".join(f'node["amenity"]({south},{west},{north},{east});' for south, west, north, east in boxes)
+    query = f"""
+    [out:json];
+    ({statements});
+    out body;
+    """
+    response = transport.post(OSM_API_URL, data={"data": query}, read_timeout=OVERPASS_READ_TIMEOUT)
     response.raise_for_status()
     return response.json()["elements"]
 
 # Query Metro Transit API for stop details
 def fetch_stop_departures(stop_id):
-    response = requests.get(f"{METRO_TRANSIT_API_URL}/{stop_id}")
-    response.raise_for_status()
-    return response.json()
+    return fetch_departures(stop_id)
 
 # Calculate time intervals between departures
 def calculate_frequency(departures, current_time):
@@ -49,7 +109,7 @@ def calculate_distance(lat1, lon1, lat2, lon2):
 
 # Fetch nearby stops
 def fetch_stops_nearby(user_lat, user_lon, max_distance):
-    response = requests.get(f"{METRO_TRANSIT_API_URL}/stops/all")
+    response = transport.get(f"{METRO_TRANSIT_API_URL}/stops/all")
     response.raise_for_status()
     all_stops = response.json()
 
@@ -61,9 +121,7 @@ def fetch_stops_nearby(user_lat, user_lon, max_distance):
 
 # Fetch departures and check frequency
 def check_route_frequency(stop_id, frequency_limit):
-    response = requests.get(f"{METRO_TRANSIT_API_URL}/{stop_id}")
-    response.raise_for_status()
-    departures = response.json()["departures"]
+    departures = fetch_departures(stop_id)["departures"]
 
     # Get the next 4 departures
     if len(departures) < 4:
@@ -82,35 +140,48 @@ def check_route_frequency(stop_id, frequency_limit):
     return avg_interval <= frequency_limit
 
 def fetch_routes():
-    response = requests.get(f"{METRO_TRANSIT_API_URL}/routes")
+    response = transport.get(f"{METRO_TRANSIT_API_URL}/routes")
     response.raise_for_status()
     return response.json()
 
 def fetch_stops(route_id, direction_id):
-    response = requests.get(f"{METRO_TRANSIT_API_URL}/stops/{route_id}/{direction_id}")
+    response = transport.get(f"{METRO_TRANSIT_API_URL}/stops/{route_id}/{direction_id}")
     response.raise_for_status()
     return response.json()
 
 def fetch_departures(stop_id):
-    response = requests.get(f"{METRO_TRANSIT_API_URL}/{stop_id}")
-    response.raise_for_status()
-    return response.json()
+    """Departures of a stop, from the departures cache or a single NexTrip request."""
+    def fetch():
+        response = transport.get(f"{METRO_TRANSIT_API_URL}/{stop_id}")
+        response.raise_for_status()
+        return response.json()
+
+    return departures_cache.get(str(stop_id), fetch)
 
 def fetch_vehicles(route_id):
-    response = requests.get(f"{METRO_TRANSIT_API_URL}/vehicles/{route_id}")
+    response = transport.get(f"{METRO_TRANSIT_API_URL}/vehicles/{route_id}")
     response.raise_for_status()
     return response.json()
 
-async def fetch_departure_data(session, stop_id):
-    """Fetch departures for a single stop asynchronously."""
-    async with session.get(f"{METRO_TRANSIT_API_URL}/{stop_id}") as response:
-        if response.status == 200:
-            return await response.json()
-        else:
-            return None
+async def fetch_departures_async(stop_id):
+    """Async fetch_departures, sharing its cache and in-flight requests."""
+    async def fetch():
+        status, data = await transport.request_json_async("GET", f"{METRO_TRANSIT_API_URL}/{stop_id}")
+        if status != 200:
+            raise ValueError(f"NexTrip returned {status} for stop {stop_id}")
+        return data
+
+    return await departures_cache.get_async(str(stop_id), fetch)
+
+async def fetch_departure_data(stop_id):
+    """Fetch departures for a single stop asynchronously, through the departures cache."""
+    try:
+        return await fetch_departures_async(stop_id)
+    except Exception as e:
+        print(f"Error fetching departures for stop {stop_id}: {e}")
+        return None
 
 async def fetch_all_departures(stop_ids):
     """Fetch departures for all stops in parallel."""
-    async with aiohttp.ClientSession() as session:
-        tasks = [fetch_departure_data(session, stop_id) for stop_id in stop_ids]
-        return await asyncio.gather(*tasks)
\ No newline at end of file
+    tasks = [fetch_departure_data(stop_id) for stop_id in stop_ids]
+    return await asyncio.gather(*tasks)
@@ -0,0 +1,229 @@
+from itertools import groupby
+from math import cos, radians
+
+import sqlite3
+
+import numpy as np
+
+from .frequency import has_table
+from .spatial import EARTH_RADIUS
+
+# Douglas-Peucker tolerances (meters) every shape is stored at; 0 keeps
+# every distinct point
+SHAPE_TOLERANCES = [0, 1, 5, 20, 80, 300]
+POLYLINE_PRECISION = 6
+SHAPE_FETCH_SIZE = 100000
+# Web Mercator meters per pixel at zoom 0 on the equator
+METERS_PER_PIXEL_ZOOM0 = 156543.03392
+
+
+def simplify(points, tolerance):
+    """
+    Simplify [(lat, lon)] with Douglas-Peucker, dropping points closer than
+    tolerance meters to the line through the points kept around them.
+    """
+    if tolerance <= 0 or len(points) < 3:
+        return list(points)
+
+    # Project onto a local plane in meters, good enough at route scale
+    coords = np.asarray(points, dtype=np.float64)
+    scale = radians(1) * EARTH_RADIUS
+    xy = np.column_stack((
+        coords[:, 1] * scale * cos(radians(coords[:, 0].mean())),
+        coords[:, 0] * scale,
+    ))
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = xy[first], xy[last]
+        segment = end - start
+        interior = xy[first + 1:last]
+        length = np.hypot(*segment)
+        if length == 0:
+            distances = np.hypot(*(interior - start).T)
+        else:
+            offsets = interior - start
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def encode_polyline(points, precision=POLYLINE_PRECISION):
+    """Encode [(lat, lon)] in the Google encoded polyline format."""
+    factor = 10 ** precision
+    output = []
+    previous_lat = previous_lon = 0
+    for lat, lon in points:
+        lat, lon = round(lat * factor), round(lon * factor)
+        for delta in (lat - previous_lat, lon - previous_lon):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                output.append(chr((0x20 | (value & 0x1F)) + 63))
+                value >>= 5
+            output.append(chr(value + 63))
+        previous_lat, previous_lon = lat, lon
+    return "".join(output)
+
+
+def decode_polyline(encoded, precision=POLYLINE_PRECISION):
+    """Decode a Google encoded polyline into [(lat, lon)]."""
+    factor = 10 ** precision
+    points = []
+    index = lat = lon = 0
+    while index < len(encoded):
+        deltas = []
+        for _ in range(2):
+            shift = value = 0
+            while True:
+                byte = ord(encoded[index]) - 63
+                index += 1
+                value |= (byte & 0x1F) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            deltas.append(~(value >> 1) if value & 1 else value >> 1)
+        lat += deltas[0]
+        lon += deltas[1]
+        points.append((lat / factor, lon / factor))
+    return points
+
+
+def tolerance_for_zoom(zoom):
+    """Largest stored tolerance below half a map pixel at a Leaflet zoom level."""
+    half_pixel = METERS_PER_PIXEL_ZOOM0 / 2 ** zoom / 2
+    return max(tolerance for tolerance in SHAPE_TOLERANCES if tolerance <= half_pixel)
+
+
+def stored_tolerance(tolerance):
+    """Largest stored tolerance not coarser than the one asked for."""
+    return max(level for level in SHAPE_TOLERANCES if level <= max(tolerance, 0))
+
+
+def build_route_shapes(conn, context):
+    """
+    Store every shape once per tolerance as an encoded polyline, with
+    consecutive duplicate points removed, plus the distinct (route, branch,
+    shape) combinations trips use and an R*Tree over shape bounding boxes.
+    Returns the number of geometries.
+    """
+    conn.execute("DROP TABLE IF EXISTS route_shapes")
+    conn.execute("DROP TABLE IF EXISTS shape_geometries")
+    conn.execute("DROP TABLE IF EXISTS shape_bounds")
+    conn.execute("DROP TABLE IF EXISTS shapes_rtree")
+    conn.execute("""
+        CREATE TABLE route_shapes AS
+        SELECT DISTINCT route_id, branch_letter, shape_id
+        FROM trips
+        WHERE shape_id IS NOT NULL
+    """)
+    conn.execute("CREATE INDEX idx_route_shapes_route_id ON route_shapes (route_id, branch_letter)")
+    conn.execute("""
+        CREATE TABLE shape_geometries (
+            shape_id TEXT,
+            tolerance INTEGER,
+            point_count INTEGER,
+            polyline TEXT,
+            PRIMARY KEY (shape_id, tolerance)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE shape_bounds (
+            id INTEGER PRIMARY KEY,
+            shape_id TEXT,
+            min_lat REAL,
+            max_lat REAL,
+            min_lon REAL,
+            max_lon REAL
+        )
+    """)
+    try:
+        conn.execute("CREATE VIRTUAL TABLE shapes_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)")
+    except sqlite3.OperationalError as e:
+        print(f"R*Tree unavailable ({e}); shape bounds are scanned instead.")
+
+    cursor = conn.execute("""
+        SELECT shape_id, shape_pt_lat, shape_pt_lon
+        FROM shapes
+        WHERE shape_id IN (SELECT shape_id FROM route_shapes)
+        ORDER BY shape_id, shape_pt_sequence
+    """)
+
+    def shape_rows():
+        while True:
+            rows = cursor.fetchmany(SHAPE_FETCH_SIZE)
+            if not rows:
+                return
+            yield from rows
+
+    geometry_count = 0
+    for shape_id, rows in groupby(shape_rows(), key=lambda row: row[0]):
+        points = [key for key, _ in groupby((lat, lon) for _, lat, lon in rows)]
+        conn.executemany("INSERT INTO shape_geometries VALUES (?, ?, ?, ?)", [
+            (shape_id, tolerance, len(simplified), encode_polyline(simplified))
+            for tolerance in SHAPE_TOLERANCES
+            for simplified in [simplify(points, tolerance)]
+        ])
+        geometry_count += len(SHAPE_TOLERANCES)
+        lats = [lat for lat, _ in points]
+        lons = [lon for _, lon in points]
+        conn.execute(
+            "INSERT INTO shape_bounds (shape_id, min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?)",
+            (shape_id, min(lats), max(lats), min(lons), max(lons)),
+        )
+
+    if has_table(conn, "shapes_rtree"):
+        conn.execute("""
+            INSERT INTO shapes_rtree (id, min_lat, max_lat, min_lon, max_lon)
+            SELECT id, min_lat, max_lat, min_lon, max_lon FROM shape_bounds
+        """)
+    return geometry_count
+
+
+def route_shape_polylines(conn, route_id, branch_letter=None, tolerance=0):
+    """
+    Return [(shape_id, polyline)] for the distinct shapes of a route (and
+    branch) at the largest stored tolerance not coarser than the one asked for.
+    """
+    query = """
+        SELECT DISTINCT g.shape_id, g.polyline
+        FROM route_shapes r
+        JOIN shape_geometries g ON g.shape_id = r.shape_id
+        WHERE r.route_id = ? AND g.tolerance = ?
+    """
+    params = [route_id, stored_tolerance(tolerance)]
+    if branch_letter:
+        query += " AND r.branch_letter = ?"
+        params.append(branch_letter)
+    query += " ORDER BY g.shape_id"
+    return conn.execute(query, params).fetchall()
+
+
+def shapes_in_box(conn, min_lat, max_lat, min_lon, max_lon, tolerance=0):
+    """
+    Return [(route_id, shape_id, polyline)] for every route shape whose
+    bounding box overlaps the given box, at a stored tolerance.
+    """
+    box = (max_lat, min_lat, max_lon, min_lon)
+    if has_table(conn, "shapes_rtree"):
+        candidates = "SELECT b.shape_id FROM shapes_rtree r JOIN shape_bounds b ON b.id = r.id " \
+                     "WHERE r.min_lat <= ? AND r.max_lat >= ? AND r.min_lon <= ? AND r.max_lon >= ?"
+    else:
+        candidates = "SELECT shape_id FROM shape_bounds " \
+                     "WHERE min_lat <= ? AND max_lat >= ? AND min_lon <= ? AND max_lon >= ?"
+    return conn.execute(f"""
+        SELECT DISTINCT r.route_id, g.shape_id, g.polyline
+        FROM shape_geometries g
+        JOIN route_shapes r ON r.shape_id = g.shape_id
+        WHERE g.tolerance = ? AND g.shape_id IN ({candidates})
+        ORDER BY r.route_id, g.shape_id
+    """, (stored_tolerance(tolerance), *box)).fetchall()
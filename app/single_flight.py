@@ -0,0 +1,105 @@
+from concurrent.futures import Future
+import asyncio
+import threading
+import time
+
+# Expired entries are swept once the cache holds more than this many keys
+PRUNE_THRESHOLD = 1000
+
+
+class SingleFlightCache:
+    """
+    In-process cache of upstream results that keeps each for ttl seconds and
+    lets only one fetch per key run at a time. Callers arriving while a
+    fetch is in flight wait for its result instead of starting their own,
+    whether they are request threads (get) or coroutines (get_async); both
+    share the same entries and in-flight fetches. Failures are passed to
+    every waiter but not cached.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # key: (stored_at, value)
+        self._in_flight = {}  # key: concurrent.futures.Future
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _claim(self, key):
+        """
+        Return (value, None, False) for a fresh entry, (None, future, False)
+        to wait on another caller's fetch, or (None, future, True) when this
+        caller must fetch and resolve the future.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1], None, False
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return None, future, False
+            self.misses += 1
+            future = self._in_flight[key] = Future()
+            return None, future, True
+
+    def _resolve(self, key, future, value=None, error=None):
+        with self._lock:
+            del self._in_flight[key]
+            if error is None:
+                now = time.monotonic()
+                self._entries[key] = (now, value)
+                if len(self._entries) > PRUNE_THRESHOLD:
+                    self._entries = {
+                        k: entry for k, entry in self._entries.items() if now - entry[0] < self.ttl
+                    }
+        if error is None:
+            future.set_result(value)
+        else:
+            future.set_exception(error)
+
+    def get(self, key, fetch):
+        """Return the cached value of key, calling fetch() only if no fresh value or fetch in flight exists."""
+        value, future, owner = self._claim(key)
+        if future is None:
+            return value
+        if not owner:
+            return future.result()
+        try:
+            value = fetch()
+        except BaseException as e:
+            self._resolve(key, future, error=e)
+            raise
+        self._resolve(key, future, value)
+        return value
+
+    async def get_async(self, key, fetch):
+        """Same as get, awaiting the coroutine function fetch() instead."""
+        value, future, owner = self._claim(key)
+        if future is None:
+            return value
+        if not owner:
+            # Shielded, so a waiter that is cancelled leaves the shared
+            # future to the fetching caller and the other waiters
+            return await asyncio.shield(asyncio.wrap_future(future))
+        try:
+            value = await fetch()
+        except BaseException as e:
+            # Cancelled fetches release their waiters too
+            self._resolve(key, future, error=e)
+            raise
+        self._resolve(key, future, value)
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "in_flight": len(self._in_flight),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "ttl_seconds": self.ttl,
+            }
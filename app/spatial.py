@@ -0,0 +1,117 @@
+from math import radians, degrees, sin, cos, sqrt, atan2
+import sqlite3
+
+# Radius of the Earth in meters
+EARTH_RADIUS = 6371000
+
+
+def haversine_distance(lat1, lon1, lat2, lon2):
+    """
+    Calculate the great-circle distance between two points on the Earth
+    specified by latitude and longitude.
+
+    Parameters:
+    - lat1, lon1: Latitude and longitude of the first point in decimal degrees.
+    - lat2, lon2: Latitude and longitude of the second point in decimal degrees.
+
+    Returns:
+    - Distance in meters between the two points.
+    """
+    # Convert latitude and longitude from degrees to radians
+    phi1 = radians(lat1)
+    phi2 = radians(lat2)
+    delta_phi = radians(lat2 - lat1)
+    delta_lambda = radians(lon2 - lon1)
+
+    # Haversine formula
+    a = sin(delta_phi / 2) ** 2 + cos(phi1) * cos(phi2) * sin(delta_lambda / 2) ** 2
+    c = 2 * atan2(sqrt(a), sqrt(1 - a))
+
+    # Distance in meters
+    return EARTH_RADIUS * c
+
+
+def bounding_box(lat, lon, distance_meters):
+    """
+    Return (min_lat, max_lat, min_lon, max_lon) of a box that contains every
+    point within distance_meters of (lat, lon).
+    """
+    delta_lat = degrees(distance_meters / EARTH_RADIUS)
+    # Longitude degrees shrink towards the poles
+    cos_lat = max(cos(radians(lat)), 1e-6)
+    delta_lon = min(degrees(distance_meters / (EARTH_RADIUS * cos_lat)), 180)
+    return lat - delta_lat, lat + delta_lat, lon - delta_lon, lon + delta_lon
+
+
+def build_stops_rtree(conn, context):
+    """
+    Build an R*Tree over stop coordinates, keyed by the stops table rowid.
+
+    Falls back to a plain (stop_lat, stop_lon) index when SQLite was built
+    without the R*Tree module. Returns the number of stops indexed.
+    """
+    conn.execute("DROP TABLE IF EXISTS stops_rtree")
+    try:
+        conn.execute("CREATE VIRTUAL TABLE stops_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)")
+    except sqlite3.OperationalError as e:
+        print(f"R*Tree unavailable ({e}); indexing stop coordinates instead.")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_stops_lat_lon ON stops (stop_lat, stop_lon)")
+        return conn.execute("SELECT COUNT(*) FROM stops").fetchone()[0]
+
+    cursor = conn.execute("""
+        INSERT INTO stops_rtree (id, min_lat, max_lat, min_lon, max_lon)
+        SELECT rowid, stop_lat, stop_lat, stop_lon, stop_lon
+        FROM stops
+        WHERE stop_lat IS NOT NULL AND stop_lon IS NOT NULL
+    """)
+    return cursor.rowcount
+
+
+def stops_in_box(conn, min_lat, max_lat, min_lon, max_lon):
+    """Return [(stop_id, stop_lat, stop_lon)] for the stops inside a bounding box."""
+    try:
+        return conn.execute("""
+            SELECT s.stop_id, s.stop_lat, s.stop_lon
+            FROM stops_rtree r
+            JOIN stops s ON s.rowid = r.id
+            WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ?
+        """, (min_lat, max_lat, min_lon, max_lon)).fetchall()
+    except sqlite3.OperationalError:
+        return conn.execute("""
+            SELECT stop_id, stop_lat, stop_lon
+            FROM stops
+            WHERE stop_lat BETWEEN ? AND ? AND stop_lon BETWEEN ? AND ?
+        """, (min_lat, max_lat, min_lon, max_lon)).fetchall()
+
+
+def find_nearby_stops(conn, lat, lon, distance_meters):
+    """
+    Return [(stop_id, stop_lat, stop_lon, distance_meters)] for every stop
+    within distance_meters of (lat, lon), nearest first.
+
+    The spatial index narrows the search to a bounding box, and the exact
+    haversine distance is only computed for those few candidates.
+    """
+    nearby = []
+    for stop_id, stop_lat, stop_lon in stops_in_box(conn, *bounding_box(lat, lon, distance_meters)):
+        distance = haversine_distance(lat, lon, stop_lat, stop_lon)
+        if distance <= distance_meters:
+            nearby.append((stop_id, stop_lat, stop_lon, distance))
+    nearby.sort(key=lambda stop: stop[3])
+    return nearby
+
+
+def snap_to_grid(lat, lon, cell_meters):
+    """
+    Snap a point to the center of its cell on a grid of roughly
+    cell_meters-square cells. Returns (cell, center_lat, center_lon), where
+    cell is a (row, column) pair identifying the cell.
+    """
+    lat_step = degrees(cell_meters / EARTH_RADIUS)
+    row = int(lat // lat_step)
+    center_lat = (row + 0.5) * lat_step
+    # Columns are narrower in degrees towards the poles, so size them by the row's latitude
+    lon_step = lat_step / max(cos(radians(center_lat)), 1e-6)
+    column = int(lon // lon_step)
+    center_lon = (column + 0.5) * lon_step
+    return (row, column), center_lat, center_lon
@@ -2,9 +2,64 @@
 const map = L.map("map").setView([44.9778, -93.2650], 13);
 L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png').addTo(map);
 
+// Whole transit network, drawn from GeoJSON tiles the server renders and caches
+const TransitNetworkLayer = L.GridLayer.extend({
+    createTile: function (coords, done) {
+        const tile = L.DomUtil.create("canvas", "leaflet-tile");
+        const size = this.getTileSize();
+        tile.width = size.x;
+        tile.height = size.y;
+
+        fetch(`/tiles/${coords.z}/${coords.x}/${coords.y}`)
+            .then((response) => (response.ok ? response.json() : { features: [] }))
+            .then((data) => {
+                this.drawTile(tile, coords, data);
+                done(null, tile);
+            })
+            .catch((error) => done(error, tile));
+        return tile;
+    },
+
+    drawTile: function (tile, coords, data) {
+        const context = tile.getContext("2d");
+        const origin = coords.scaleBy(this.getTileSize());
+        const toPixel = ([lng, lat]) => this._map.project([lat, lng], coords.z).subtract(origin);
+
+        data.features.forEach((feature) => {
+            if (feature.geometry.type === "MultiLineString") {
+                // A stable color per route
+                let hash = 0;
+                for (const char of feature.properties.route_id) hash = (hash * 31 + char.charCodeAt(0)) % 360;
+                context.strokeStyle = `hsl(${hash}, 70%, 45%)`;
+                context.lineWidth = 2;
+                feature.geometry.coordinates.forEach((line) => {
+                    context.beginPath();
+                    line.forEach((coordinate, index) => {
+                        const point = toPixel(coordinate);
+                        index === 0 ? context.moveTo(point.x, point.y) : context.lineTo(point.x, point.y);
+                    });
+                    context.stroke();
+                });
+            } else if (feature.geometry.type === "Point") {
+                const point = toPixel(feature.geometry.coordinates);
+                context.fillStyle = "#333";
+                context.beginPath();
+                context.arc(point.x, point.y, 3, 0, 2 * Math.PI);
+                context.fill();
+            }
+        });
+    }
+});
+
+const networkLayer = new TransitNetworkLayer({ minZoom: 10, maxNativeZoom: 18, opacity: 0.7 }).addTo(map);
+L.control.layers(null, { "Transit network": networkLayer }).addTo(map);
+
 let userLat, userLng;
 let userMarker = null;
 let routeLayer = null; // For route visualization
+let vehicleStream = null; // Live vehicle positions of the shown route
+const vehicleLayer = L.layerGroup().addTo(map);
+const vehicleMarkers = {};
 
 document.getElementById("get-stops-btn").addEventListener("click", () => {
     const distance = document.getElementById("distance").value;
@@ -169,10 +224,20 @@ async function fetchNearbyStops() {
 
     showLoading();
 
+    const params = { lat: userLat, lon: userLng, distance, frequency };
+    const serviceDate = document.getElementById("service-date").value;
+    if (serviceDate) {
+        params.date = serviceDate.replaceAll("-", ""); // YYYY-MM-DD to YYYYMMDD
+    }
+    const startHour = document.getElementById("start-hour").value;
+    const endHour = document.getElementById("end-hour").value;
+    if (startHour !== "" && endHour !== "") {
+        params.start_hour = startHour; // e.g. 7 to 9 for the morning rush
+        params.end_hour = endHour;
+    }
+
     try {
-        const response = await axios.get("/api/schedule/nearby", {
-            params: { lat: userLat, lon: userLng, distance, frequency },
-        });
+        const response = await axios.get("/api/schedule/nearby", { params });
 
         const data = response.data;
 
@@ -204,6 +269,7 @@ async function fetchNearbyStops() {
             routeButton.dataset.branchLetter = row[1];
             routeButton.addEventListener("click", () => {
                 fetchRouteShape(row[0], row[1]);
+                watchVehicles(row[0]);
             });
             routeButtonCell.appendChild(routeButton);
             actionRow.appendChild(routeButtonCell);
@@ -264,25 +330,53 @@ async function fetchPOIs(routeId, branchLetter) {
     }
 }
 
+// Decode a Google encoded polyline into [[lat, lng], ...]
+function decodePolyline(encoded, precision) {
+    const factor = Math.pow(10, precision);
+    const points = [];
+    let index = 0, lat = 0, lng = 0;
+    while (index < encoded.length) {
+        const deltas = [];
+        for (let i = 0; i < 2; i++) {
+            let shift = 0, value = 0, byte;
+            do {
+                byte = encoded.charCodeAt(index++) - 63;
+                value += (byte & 0x1f) * Math.pow(2, shift); // Avoid 32-bit overflow of <<
+                shift += 5;
+            } while (byte >= 0x20);
+            deltas.push(value % 2 ? -(value + 1) / 2 : value / 2);
+        }
+        lat += deltas[0];
+        lng += deltas[1];
+        points.push([lat / factor, lng / factor]);
+    }
+    return points;
+}
+
 // Fetch route shape and display on map
 async function fetchRouteShape(routeId, branchLetter) {
     try {
+        // Encoded polylines simplified for the current zoom are a fraction of the full GeoJSON
         const response = await axios.get("/api/route_shape", {
             params: {
                 route_id: routeId,
-                branch_letter: branchLetter
+                branch_letter: branchLetter,
+                format: "polyline",
+                zoom: map.getZoom()
             }
         });
 
-        const geojsonData = response.data;
+        const shapeData = response.data;
 
         if (routeLayer) {
             map.removeLayer(routeLayer);
         }
 
-        routeLayer = L.geoJSON(geojsonData, {
-            style: { color: "blue", weight: 4 }
-        }).addTo(map);
+        routeLayer = L.featureGroup(
+            shapeData.shapes.map((shape) =>
+                L.polyline(decodePolyline(shape.polyline, shapeData.precision), { color: "blue", weight: 4 })
+            )
+        ).addTo(map);
 
         const bounds = routeLayer.getBounds();
         map.fitBounds(bounds);
@@ -328,36 +422,103 @@ async function handleRouteVisualization(event) {
     }
 }
 
-// Fetch and display POIs along the selected route
+// Fetch and display POIs along the selected route, rendering each stop's
+// POIs as soon as the server streams them
 async function fetchPOIs(routeId, branchLetter) {
-    try {
-        const response = await axios.get("/api/pois_along_route", {
-            params: {
-                route_id: routeId,
-                branch_letter: branchLetter,
-                lat: userLat,
-                lon: userLng,
-                distance: document.getElementById("distance").value
-            }
-        });
+    const params = new URLSearchParams({
+        route_id: routeId,
+        lat: userLat,
+        lon: userLng,
+        distance: document.getElementById("distance").value
+    });
+    if (branchLetter) {
+        params.set("branch_letter", branchLetter);
+    }
 
-        const pois = response.data;
-        const poiList = document.getElementById("poi-list");
-        poiList.innerHTML = ""; // Clear existing POIs
+    const poiList = document.getElementById("poi-list");
+    poiList.innerHTML = ""; // Clear existing POIs
+    document.getElementById("poi-section").style.display = "block";
 
-        pois.forEach((poi) => {
+    // Lines arrive in the order lookups finish; keep the list in route order
+    const renderStop = (line) => {
+        const result = JSON.parse(line);
+        const next = Array.from(poiList.children).find((li) => Number(li.dataset.stopIndex) > result.index);
+        result.pois.forEach((poi) => {
             const li = document.createElement("li");
+            li.dataset.stopIndex = result.index;
             li.textContent = `${poi.name} (${poi.type}) - ${poi.distance.toFixed(2)} ft`;
-            poiList.appendChild(li);
+            poiList.insertBefore(li, next || null);
         });
+    };
 
-        document.getElementById("poi-section").style.display = "block";
+    try {
+        const response = await fetch(`/api/pois_along_route?${params}`, {
+            headers: { Accept: "application/x-ndjson" }
+        });
+        if (!response.ok) {
+            throw new Error(`HTTP ${response.status}`);
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffered = "";
+        while (true) {
+            const { done, value } = await reader.read();
+            buffered += decoder.decode(value || new Uint8Array(), { stream: !done });
+            const lines = buffered.split("\n");
+            buffered = lines.pop();
+            lines.filter((line) => line.trim()).forEach(renderStop);
+            if (done) {
+                break;
+            }
+        }
+        if (buffered.trim()) {
+            renderStop(buffered);
+        }
     } catch (error) {
         console.error("Error fetching POIs:", error);
         alert("Error fetching points of interest. Please try again.");
     }
 }
 
+// Show the vehicles of a route live; the server pushes only the ones that moved
+function watchVehicles(routeId) {
+    if (vehicleStream) {
+        vehicleStream.close();
+    }
+    vehicleLayer.clearLayers();
+    Object.keys(vehicleMarkers).forEach((key) => delete vehicleMarkers[key]);
+
+    const placeVehicle = (vehicle) => {
+        const key = vehicle.trip_id || `${vehicle.latitude},${vehicle.longitude}`;
+        const position = [vehicle.latitude, vehicle.longitude];
+        if (vehicleMarkers[key]) {
+            vehicleMarkers[key].setLatLng(position);
+        } else {
+            vehicleMarkers[key] = L.circleMarker(position, {
+                radius: 6, color: "#fff", weight: 2, fillColor: "#d33", fillOpacity: 1
+            }).bindTooltip(`Route ${routeId} ${vehicle.direction || ""}`).addTo(vehicleLayer);
+        }
+    };
+
+    vehicleStream = new EventSource(`/api/stream/vehicles?route_id=${encodeURIComponent(routeId)}`);
+    vehicleStream.addEventListener("snapshot", (event) => {
+        vehicleLayer.clearLayers();
+        Object.keys(vehicleMarkers).forEach((key) => delete vehicleMarkers[key]);
+        JSON.parse(event.data).forEach(placeVehicle);
+    });
+    vehicleStream.addEventListener("update", (event) => {
+        const update = JSON.parse(event.data);
+        update.vehicles.forEach(placeVehicle);
+        update.removed.forEach((key) => {
+            if (vehicleMarkers[key]) {
+                vehicleLayer.removeLayer(vehicleMarkers[key]);
+                delete vehicleMarkers[key];
+            }
+        });
+    });
+}
+
 // Attach click event to route buttons
 document.querySelectorAll(".route-btn").forEach((button) => {
     button.addEventListener("click", (event) => {
@@ -366,6 +527,7 @@ document.querySelectorAll(".route-btn").forEach((button) => {
 
         fetchRouteShape(routeId, branchLetter);
         fetchPOIs(routeId, branchLetter);
+        watchVehicles(routeId);
     });
 });
 
@@ -0,0 +1,106 @@
+from math import cos, degrees, floor, radians
+import sqlite3
+import threading
+
+from .frequency import has_table
+from .spatial import EARTH_RADIUS, bounding_box, haversine_distance
+
+# Side of the index's grid cells in meters
+CELL_METERS = 250
+
+_index_cache = {"version": None, "index": None}
+_index_lock = threading.Lock()
+
+
+class StopIndex:
+    """
+    The stops of one feed version held in memory: a grid of roughly
+    CELL_METERS-square cells for radius searches and the routes serving
+    each stop.
+    """
+
+    def __init__(self, version, stops, routes_by_stop):
+        self.version = version
+        # [(stop_id, stop_name, stop_lat, stop_lon)]
+        self.stops = stops
+        self.routes_by_stop = routes_by_stop
+        mean_lat = sum(stop[2] for stop in stops) / len(stops) if stops else 0
+        self.lat_step = degrees(CELL_METERS / EARTH_RADIUS)
+        self.lon_step = self.lat_step / max(cos(radians(mean_lat)), 1e-6)
+        self.cells = {}
+        for stop in stops:
+            self.cells.setdefault(self._cell(stop[2], stop[3]), []).append(stop)
+
+    def _cell(self, lat, lon):
+        return floor(lat / self.lat_step), floor(lon / self.lon_step)
+
+    def nearby(self, lat, lon, distance_meters):
+        """
+        Return [(stop_id, stop_name, stop_lat, stop_lon, distance_meters)]
+        for every stop within distance_meters of (lat, lon), nearest first.
+        """
+        min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, distance_meters)
+        min_row, min_col = self._cell(min_lat, min_lon)
+        max_row, max_col = self._cell(max_lat, max_lon)
+        nearby = []
+        for row in range(min_row, max_row + 1):
+            for col in range(min_col, max_col + 1):
+                for stop_id, stop_name, stop_lat, stop_lon in self.cells.get((row, col), ()):
+                    distance = haversine_distance(lat, lon, stop_lat, stop_lon)
+                    if distance <= distance_meters:
+                        nearby.append((stop_id, stop_name, stop_lat, stop_lon, distance))
+        nearby.sort(key=lambda stop: stop[4])
+        return nearby
+
+    def routes(self, stop_id):
+        """Route ids serving a stop."""
+        return self.routes_by_stop.get(stop_id, [])
+
+
+def _stop_routes(conn):
+    """(stop_id, route_id) pairs from the smallest table that has them."""
+    if has_table(conn, "route_patterns"):
+        return conn.execute("""
+            SELECT DISTINCT ps.stop_id, p.route_id
+            FROM pattern_stops ps
+            JOIN route_patterns p ON p.pattern_id = ps.pattern_id
+        """)
+    if has_table(conn, "stop_route_summary"):
+        return conn.execute("SELECT DISTINCT stop_id, route_id FROM stop_route_summary")
+    return conn.execute("""
+        SELECT DISTINCT st.stop_id, t.route_id
+        FROM stop_times st
+        JOIN trips t ON st.trip_id = t.trip_id
+    """)
+
+
+def build_stop_index(feed):
+    """Load a feed's stops and the routes serving them into a StopIndex."""
+    conn = sqlite3.connect(f"file:{feed['db_path']}?mode=ro", uri=True)
+    try:
+        stops = conn.execute("""
+            SELECT stop_id, stop_name, stop_lat, stop_lon
+            FROM stops
+            WHERE stop_lat IS NOT NULL AND stop_lon IS NOT NULL
+        """).fetchall()
+        routes_by_stop = {}
+        for stop_id, route_id in _stop_routes(conn):
+            routes_by_stop.setdefault(stop_id, []).append(route_id)
+    finally:
+        conn.close()
+    for routes in routes_by_stop.values():
+        routes.sort()
+    return StopIndex(feed["version"], stops, routes_by_stop)
+
+
+def stop_index(feed):
+    """
+    Return the StopIndex of a feed version, building it the first time that
+    version is asked for. Only the index of the latest version is kept.
+    """
+    with _index_lock:
+        if _index_cache["version"] != feed["version"]:
+            _index_cache["index"] = build_stop_index(feed)
+            _index_cache["version"] = feed["version"]
+            print(f"Indexed {len(_index_cache['index'].stops)} stops of GTFS version {feed['version']}.")
+        return _index_cache["index"]
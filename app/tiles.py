@@ -0,0 +1,152 @@
+from math import atan, cos, degrees, floor, log, pi, radians, sinh, tan
+import json
+import os
+import sqlite3
+import threading
+
+from .frequency import has_table
+from .shapes import decode_polyline, shapes_in_box, tolerance_for_zoom
+from .spatial import stops_in_box
+
+MAX_TILE_ZOOM = 18
+# Stops are only drawn once the map is close enough to tell them apart
+STOPS_MIN_ZOOM = 14
+# Lines are clipped to the tile grown by this fraction on every side, so
+# strokes crossing the edge join up with the neighbouring tile
+TILE_BUFFER = 0.05
+
+
+def tile_bounds(z, x, y):
+    """Return (min_lat, max_lat, min_lon, max_lon) of a Web Mercator tile."""
+    n = 2 ** z
+
+    def lat(row):
+        return degrees(atan(sinh(pi * (1 - 2 * row / n))))
+
+    return lat(y + 1), lat(y), x / n * 360 - 180, (x + 1) / n * 360 - 180
+
+
+def tile_for_point(lat, lon, z):
+    """Return the (x, y) of the tile containing a point at zoom z."""
+    n = 2 ** z
+    x = int(floor((lon + 180) / 360 * n))
+    y = int(floor((1 - log(tan(radians(lat)) + 1 / cos(radians(lat))) / pi) / 2 * n))
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def is_valid_tile(z, x, y):
+    return 0 <= z <= MAX_TILE_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def _clip(points, min_lat, max_lat, min_lon, max_lon):
+    """
+    Split a line into the runs of segments that touch a box, dropping the
+    rest. Segments crossing the edge are kept whole.
+    """
+    runs, run = [], []
+    for start, end in zip(points, points[1:]):
+        touches = (
+            min(start[0], end[0]) <= max_lat and max(start[0], end[0]) >= min_lat
+            and min(start[1], end[1]) <= max_lon and max(start[1], end[1]) >= min_lon
+        )
+        if touches:
+            if not run:
+                run.append(start)
+            run.append(end)
+        elif run:
+            runs.append(run)
+            run = []
+    if run:
+        runs.append(run)
+    return runs
+
+
+def render_tile(conn, z, x, y):
+    """
+    Build the GeoJSON FeatureCollection of one tile: route lines clipped to
+    the tile, simplified for its zoom, and (from STOPS_MIN_ZOOM) the stops.
+    """
+    min_lat, max_lat, min_lon, max_lon = tile_bounds(z, x, y)
+    buffer_lat = (max_lat - min_lat) * TILE_BUFFER
+    buffer_lon = (max_lon - min_lon) * TILE_BUFFER
+    box = (min_lat - buffer_lat, max_lat + buffer_lat, min_lon - buffer_lon, max_lon + buffer_lon)
+
+    features = []
+    # Feeds built before shapes were precomputed only get their stops drawn
+    shapes = shapes_in_box(conn, *box, tolerance=tolerance_for_zoom(z)) if has_table(conn, "shape_bounds") else []
+    for route_id, shape_id, polyline in shapes:
+        runs = _clip(decode_polyline(polyline), *box)
+        if not runs:
+            continue
+        features.append({
+            "type": "Feature",
+            "geometry": {
+                "type": "MultiLineString",
+                "coordinates": [[(lon, lat) for lat, lon in run] for run in runs],
+            },
+            "properties": {"route_id": route_id, "shape_id": shape_id},
+        })
+
+    if z >= STOPS_MIN_ZOOM:
+        for stop_id, stop_lat, stop_lon in stops_in_box(conn, min_lat, max_lat, min_lon, max_lon):
+            features.append({
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": (stop_lon, stop_lat)},
+                "properties": {"stop_id": stop_id},
+            })
+
+    return {"type": "FeatureCollection", "features": features}
+
+
+def tile_cache_dir(feed):
+    """Directory holding the rendered tiles of a feed version."""
+    return os.path.join(os.path.dirname(feed["db_path"]), f"tiles-{feed['version']}")
+
+
+def cached_tile_path(feed, z, x, y):
+    """
+    Return the path of a tile on disk, rendering it first if this feed
+    version has not served it before.
+    """
+    path = os.path.join(tile_cache_dir(feed), str(z), str(x), f"{y}.json")
+    if os.path.exists(path):
+        return path
+
+    conn = sqlite3.connect(f"file:{feed['db_path']}?mode=ro", uri=True)
+    try:
+        tile = render_tile(conn, z, x, y)
+    finally:
+        conn.close()
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Concurrent renders of the same tile each write their own temp file
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(tile, f, separators=(",", ":"))
+    os.replace(temp_path, path)
+    return path
+
+
+def seed_tiles(feed, min_zoom, max_zoom):
+    """Render every tile covering the feed's stops between two zoom levels. Returns the tile count."""
+    conn = sqlite3.connect(f"file:{feed['db_path']}?mode=ro", uri=True)
+    try:
+        min_lat, max_lat, min_lon, max_lon = conn.execute(
+            "SELECT MIN(stop_lat), MAX(stop_lat), MIN(stop_lon), MAX(stop_lon) FROM stops"
+        ).fetchone()
+    finally:
+        conn.close()
+    if min_lat is None:
+        print("No stops with coordinates; nothing to seed.")
+        return 0
+
+    count = 0
+    for z in range(min_zoom, max_zoom + 1):
+        min_x, min_y = tile_for_point(max_lat, min_lon, z)
+        max_x, max_y = tile_for_point(min_lat, max_lon, z)
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                cached_tile_path(feed, z, x, y)
+                count += 1
+        print(f"Seeded zoom {z}: {(max_x - min_x + 1) * (max_y - min_y + 1)} tiles.")
+    return count
@@ -0,0 +1,160 @@
+from array import array
+import os
+import shutil
+import threading
+
+import numpy as np
+
+TIMETABLE_ARTIFACT = "timetable"
+
+# Schedule types in code order
+SCHEDULE_TYPES = ["Weekday", "Reduced", "Holiday", "Saturday", "Sunday"]
+
+FETCH_SIZE = 100000
+
+_timetables = {}
+_timetables_lock = threading.Lock()
+
+
+def _save(directory, name, values):
+    np.save(os.path.join(directory, f"{name}.npy"), values, allow_pickle=False)
+
+
+def _string_array(values):
+    # Fixed-width unicode so the dictionary can be memory mapped too
+    return np.array(values, dtype=str) if values else np.array([], dtype="<U1")
+
+
+def build_timetable_snapshot(conn, context):
+    """
+    Write the columnar timetable for a feed database.
+
+    Layout (all .npy, memory mapped read-only by every worker):
+    - stop_ids, trip_ids, route_ids, branch_letters, service_ids: ID dictionaries
+    - trip_route, trip_branch, trip_service (int32), trip_schedule (int8),
+      trip_days (uint8): per-trip columns; trip_days is the service day_mask
+    - stop_offsets (int64): CSR offsets into the departure columns, by stop
+    - dep_seconds (uint32), dep_trip (int32): departures sorted by stop then time
+
+    The directory is named after the artifact's input hash, so unchanged
+    feeds reuse it. Returns the number of departures written.
+    """
+    directory = context["output_dir"]
+    if os.path.exists(os.path.join(directory, "stop_offsets.npy")):
+        return int(np.load(os.path.join(directory, "dep_seconds.npy"), mmap_mode="r").shape[0])
+
+    stop_ids = [row[0] for row in conn.execute("SELECT stop_id FROM stops ORDER BY stop_id")]
+    stop_codes = {stop_id: code for code, stop_id in enumerate(stop_ids)}
+
+    trip_ids, trip_route, trip_branch, trip_service = [], array("i"), array("i"), array("i")
+    trip_schedule, trip_days = array("b"), array("B")
+    route_codes, branch_codes, service_codes = {}, {}, {}
+    for trip_id, route_id, branch_letter, service_id, schedule_type, day_mask in conn.execute(
+        "SELECT trip_id, route_id, branch_letter, service_id, schedule_type, day_mask FROM trips ORDER BY trip_id"
+    ):
+        trip_ids.append(trip_id)
+        trip_route.append(route_codes.setdefault(route_id, len(route_codes)))
+        trip_branch.append(branch_codes.setdefault(branch_letter or "", len(branch_codes)))
+        trip_service.append(service_codes.setdefault(service_id or "", len(service_codes)))
+        trip_schedule.append(SCHEDULE_TYPES.index(schedule_type))
+        trip_days.append(day_mask or 0)
+    trip_codes = {trip_id: code for code, trip_id in enumerate(trip_ids)}
+
+    counts = np.zeros(len(stop_ids), dtype=np.int64)
+    dep_seconds, dep_trip = array("I"), array("i")
+    cursor = conn.execute("""
+        SELECT stop_id, trip_id, departure_seconds
+        FROM stop_times
+        WHERE departure_seconds IS NOT NULL
+        ORDER BY stop_id, departure_seconds
+    """)
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        for stop_id, trip_id, seconds in rows:
+            stop_code = stop_codes.get(stop_id)
+            trip_code = trip_codes.get(trip_id)
+            if stop_code is None or trip_code is None:
+                continue
+            counts[stop_code] += 1
+            dep_seconds.append(seconds)
+            dep_trip.append(trip_code)
+
+    stop_offsets = np.zeros(len(stop_ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=stop_offsets[1:])
+
+    # Write next to the final directory and rename, so readers never see
+    # a half-written snapshot
+    building = f"{directory}.building"
+    shutil.rmtree(building, ignore_errors=True)
+    os.makedirs(building)
+    _save(building, "stop_ids", _string_array(stop_ids))
+    _save(building, "trip_ids", _string_array(trip_ids))
+    _save(building, "route_ids", _string_array(list(route_codes)))
+    _save(building, "branch_letters", _string_array(list(branch_codes)))
+    _save(building, "service_ids", _string_array(list(service_codes)))
+    _save(building, "trip_route", np.frombuffer(trip_route, dtype=np.int32))
+    _save(building, "trip_branch", np.frombuffer(trip_branch, dtype=np.int32))
+    _save(building, "trip_service", np.frombuffer(trip_service, dtype=np.int32))
+    _save(building, "trip_schedule", np.frombuffer(trip_schedule, dtype=np.int8))
+    _save(building, "trip_days", np.frombuffer(trip_days, dtype=np.uint8))
+    _save(building, "stop_offsets", stop_offsets)
+    _save(building, "dep_seconds", np.frombuffer(dep_seconds, dtype=np.uint32))
+    _save(building, "dep_trip", np.frombuffer(dep_trip, dtype=np.int32))
+    os.replace(building, directory)
+    return len(dep_seconds)
+
+
+class Timetable:
+    """Read-only, memory-mapped view of a feed's columnar timetable."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        for name in ("stop_ids", "trip_ids", "route_ids", "branch_letters", "service_ids", "trip_route",
+                     "trip_branch", "trip_service", "trip_schedule", "trip_days", "stop_offsets", "dep_seconds",
+                     "dep_trip"):
+            setattr(self, name, np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r"))
+        self._stop_codes = {stop_id: code for code, stop_id in enumerate(self.stop_ids.tolist())}
+
+    def stop_codes(self, stop_ids):
+        """Dictionary codes for the given stop IDs, skipping unknown stops."""
+        codes = [self._stop_codes.get(str(stop_id)) for stop_id in stop_ids]
+        return np.array([code for code in codes if code is not None], dtype=np.int64)
+
+    def departures_at(self, stop_ids):
+        """
+        All departures at the given stops.
+
+        Returns (seconds, trip codes) arrays, built by slicing each stop's
+        range out of the CSR columns.
+        """
+        codes = self.stop_codes(stop_ids)
+        if not len(codes):
+            return np.array([], dtype=np.uint32), np.array([], dtype=np.int32)
+        starts = self.stop_offsets[codes]
+        ends = self.stop_offsets[codes + 1]
+        seconds = np.concatenate([self.dep_seconds[s:e] for s, e in zip(starts, ends)])
+        trips = np.concatenate([self.dep_trip[s:e] for s, e in zip(starts, ends)])
+        return seconds, trips
+
+
+def get_timetable(db_path):
+    """Return the process-wide Timetable for a feed database, mapping it on first use."""
+    from .gtfs_loader import snapshot_outputs
+
+    with _timetables_lock:
+        if db_path not in _timetables:
+            directory = snapshot_outputs(db_path).get(TIMETABLE_ARTIFACT)
+            if directory is None or not os.path.isdir(directory):
+                return None
+            try:
+                timetable = Timetable(directory)
+            except FileNotFoundError:
+                # Written by an older build that lacks a column; the feed is
+                # rebuilt on its next refresh
+                return None
+            # Only the current feed stays mapped
+            _timetables.clear()
+            _timetables[db_path] = timetable
+        return _timetables[db_path]
@@ -0,0 +1,298 @@
+from urllib.parse import urlsplit
+import asyncio
+import os
+import random
+import threading
+import time
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+# Every upstream call (NexTrip, Overpass, OSRM) goes through here. Each host
+# gets one pooled keep-alive session (a requests.Session for threads, an
+# aiohttp.ClientSession per event loop for async code), a cap on concurrent
+# requests, connect/read timeouts, retries with jittered exponential backoff,
+# a circuit breaker and latency/error counters.
+
+# Statuses worth another try; anything else is returned to the caller as is
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Defaults, replaced by configure() from the app config
+settings = {
+    "connect_timeout": 3.05,
+    "read_timeout": 30,
+    "max_per_host": 10,
+    "retries": 2,
+    "backoff": 0.5,
+    "failure_threshold": 5,
+    "reset_seconds": 30,
+}
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised without contacting a host whose circuit breaker is open."""
+
+
+class _Host:
+    """Pool, concurrency cap, circuit breaker and counters of one upstream host."""
+
+    def __init__(self, host):
+        self.host = host
+        self.lock = threading.Lock()
+        self.semaphore = threading.BoundedSemaphore(settings["max_per_host"])
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings["max_per_host"])
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # Consecutive failed attempts, when the circuit opened, and whether
+        # a trial request is already out while it is half-open
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.rejected = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < settings["reset_seconds"]:
+            return "open"
+        return "half-open"
+
+    def admit(self):
+        """
+        Raise CircuitOpenError unless a request may go out now. Returns True
+        when the request is the half-open trial, whose caller must end_probe()
+        however it finishes.
+        """
+        with self.lock:
+            state = self.state()
+            if state == "closed":
+                return False
+            if state == "half-open" and not self.probing:
+                self.probing = True
+                return True
+            self.rejected += 1
+        raise CircuitOpenError(f"Circuit breaker open for {self.host}")
+
+    def end_probe(self):
+        """
+        Free the trial slot once the trial request is over, also when it was
+        cancelled or failed unexpectedly. Only the trial itself may free it:
+        other requests finishing while it is out must not let a second
+        trial start.
+        """
+        with self.lock:
+            self.probing = False
+
+    def record(self, seconds, failed):
+        with self.lock:
+            self.requests += 1
+            self.latency_total += seconds
+            self.latency_max = max(self.latency_max, seconds)
+            if failed:
+                self.errors += 1
+                self.failures += 1
+                if self.opened_at is not None or self.failures >= settings["failure_threshold"]:
+                    if self.opened_at is None:
+                        print(f"Opening circuit breaker for {self.host} after {self.failures} failures.")
+                    self.opened_at = time.monotonic()
+            else:
+                if self.opened_at is not None:
+                    print(f"Closing circuit breaker for {self.host}.")
+                self.failures = 0
+                self.opened_at = None
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "retries": self.retries,
+                "rejected": self.rejected,
+                "mean_ms": round(self.latency_total / self.requests * 1000, 1) if self.requests else None,
+                "max_ms": round(self.latency_max * 1000, 1),
+                "circuit": self.state(),
+            }
+
+
+_hosts = {}
+_hosts_lock = threading.Lock()
+# {event loop: {host: (aiohttp.ClientSession, asyncio.Semaphore)}}
+_async_sessions = {}
+_shared_loop = {"loop": None, "pid": None}
+_loop_lock = threading.Lock()
+
+
+def configure(config):
+    """Take the transport settings from the app config; call before the first request."""
+    settings.update({
+        "connect_timeout": config["HTTP_CONNECT_TIMEOUT"],
+        "read_timeout": config["HTTP_READ_TIMEOUT"],
+        "max_per_host": config["HTTP_MAX_PER_HOST"],
+        "retries": config["HTTP_RETRIES"],
+        "backoff": config["HTTP_RETRY_BACKOFF"],
+        "failure_threshold": config["HTTP_BREAKER_FAILURES"],
+        "reset_seconds": config["HTTP_BREAKER_RESET_SECONDS"],
+    })
+
+
+def _host(url):
+    host = urlsplit(url).netloc
+    with _hosts_lock:
+        if host not in _hosts:
+            _hosts[host] = _Host(host)
+        return _hosts[host]
+
+
+def _backoff(attempt):
+    """Full-jitter exponential backoff before retry number attempt (from 1)."""
+    return random.uniform(0, settings["backoff"] * 2 ** (attempt - 1))
+
+
+def request(method, url, read_timeout=None, **kwargs):
+    """
+    Send a request through the host's pooled session and return the
+    requests.Response. Connection errors, timeouts and RETRY_STATUSES are
+    retried; the last error is raised, or the last response returned. A
+    retry the circuit breaker no longer admits raises CircuitOpenError.
+    """
+    host = _host(url)
+    probe = host.admit()
+    kwargs.setdefault("timeout", (settings["connect_timeout"], read_timeout or settings["read_timeout"]))
+    try:
+        with host.semaphore:
+            for attempt in range(settings["retries"] + 1):
+                if attempt:
+                    with host.lock:
+                        host.retries += 1
+                    time.sleep(_backoff(attempt))
+                    # The attempts so far, or other requests', may have
+                    # opened the breaker since
+                    probe = host.admit() or probe
+                start = time.perf_counter()
+                try:
+                    response = host.session.request(method, url, **kwargs)
+                except requests.RequestException:
+                    host.record(time.perf_counter() - start, failed=True)
+                    if attempt == settings["retries"]:
+                        raise
+                    continue
+                failed = response.status_code in RETRY_STATUSES
+                host.record(time.perf_counter() - start, failed=failed)
+                if not failed or attempt == settings["retries"]:
+                    return response
+                response.close()
+    finally:
+        if probe:
+            host.end_probe()
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def _async_session(host):
+    loop = asyncio.get_running_loop()
+    sessions = _async_sessions.setdefault(loop, {})
+    if host.host not in sessions:
+        connector = aiohttp.TCPConnector(
+            limit=settings["max_per_host"], limit_per_host=settings["max_per_host"], keepalive_timeout=30
+        )
+        sessions[host.host] = (
+            aiohttp.ClientSession(connector=connector),
+            asyncio.Semaphore(settings["max_per_host"]),
+        )
+    return sessions[host.host]
+
+
+async def request_json_async(method, url, read_timeout=None, **kwargs):
+    """
+    Async counterpart of request() sharing its breaker, retries and
+    counters. Returns (status, parsed JSON body or None).
+    """
+    host = _host(url)
+    probe = host.admit()
+    timeout = aiohttp.ClientTimeout(
+        sock_connect=settings["connect_timeout"], sock_read=read_timeout or settings["read_timeout"]
+    )
+    try:
+        session, semaphore = _async_session(host)
+        async with semaphore:
+            for attempt in range(settings["retries"] + 1):
+                if attempt:
+                    with host.lock:
+                        host.retries += 1
+                    await asyncio.sleep(_backoff(attempt))
+                    probe = host.admit() or probe
+                start = time.perf_counter()
+                try:
+                    async with session.request(method, url, timeout=timeout, **kwargs) as response:
+                        status = response.status
+                        data = await response.json(content_type=None) if status == 200 else None
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                    host.record(time.perf_counter() - start, failed=True)
+                    if attempt == settings["retries"]:
+                        raise
+                    continue
+                failed = status in RETRY_STATUSES
+                host.record(time.perf_counter() - start, failed=failed)
+                if not failed or attempt == settings["retries"]:
+                    return status, data
+    finally:
+        # A cancelled trial (e.g. a client that hung up) records nothing
+        if probe:
+            host.end_probe()
+
+
+async def close_async_sessions():
+    """Close the aiohttp sessions opened on the running event loop."""
+    for session, _ in _async_sessions.pop(asyncio.get_running_loop(), {}).values():
+        await session.close()
+
+
+def attach_loop(loop):
+    """Make an already running event loop (an ASGI server's) the shared one."""
+    with _loop_lock:
+        _shared_loop.update(loop=loop, pid=os.getpid())
+
+
+def shared_loop():
+    """
+    The process's long-lived event loop, which every async upstream call
+    and its aiohttp sessions live on. Started on a daemon thread the first
+    time it is needed, and again in a forked worker.
+    """
+    with _loop_lock:
+        loop = _shared_loop["loop"]
+        if loop is None or loop.is_closed() or _shared_loop["pid"] != os.getpid():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="transport-loop", daemon=True).start()
+            _shared_loop.update(loop=loop, pid=os.getpid())
+        return loop
+
+
+def submit(coroutine):
+    """Schedule a coroutine on the shared loop and return its concurrent.futures.Future."""
+    return asyncio.run_coroutine_threadsafe(coroutine, shared_loop())
+
+
+def run_async(coroutine):
+    """Run a coroutine on the shared loop from synchronous code and wait for its result."""
+    return submit(coroutine).result()
+
+
+def stats():
+    """Per-host request, retry, error and latency counters and breaker state."""
+    with _hosts_lock:
+        hosts = list(_hosts.values())
+    return {host.host: host.stats() for host in hosts}
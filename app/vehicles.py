@@ -0,0 +1,138 @@
+import queue
+import threading
+import time
+
+from .services import fetch_vehicles
+
+# Events a subscriber may fall behind by before it is sent a fresh snapshot
+SUBSCRIBER_QUEUE_SIZE = 20
+# Fields of a NexTrip vehicle that count as it having moved
+POSITION_FIELDS = ("latitude", "longitude", "bearing", "location_time")
+
+
+def _vehicle_key(vehicle):
+    return vehicle.get("trip_id") or f"{vehicle.get('latitude')},{vehicle.get('longitude')}"
+
+
+class Subscription:
+    """One client's feed of vehicle events for a route."""
+
+    def __init__(self, route_id):
+        self.route_id = route_id
+        self.events = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def get(self, timeout):
+        """Return the next (event, data), or None after timeout seconds without one."""
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class VehicleHub:
+    """
+    Polls NexTrip for the vehicles of every route someone is watching, once
+    per interval per route however many clients watch it, and pushes the
+    vehicles that moved to each route's subscribers.
+
+    A new subscriber first gets a "snapshot" event with every known vehicle
+    of its route, then "update" events ({"vehicles": [moved or new],
+    "removed": [trip ids]}).
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._subscribers = {}  # route_id: set of Subscription
+        self._vehicles = {}  # route_id: {trip id: vehicle}
+        self._thread = None
+        self.polls = 0
+        self.errors = 0
+
+    def subscribe(self, route_id):
+        subscription = Subscription(route_id)
+        with self._lock:
+            self._subscribers.setdefault(route_id, set()).add(subscription)
+            vehicles = self._vehicles.get(route_id)
+            if vehicles is not None:
+                subscription.events.put_nowait(("snapshot", list(vehicles.values())))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._poll_loop, name="vehicle-poller", daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.route_id, set())
+            subscribers.discard(subscription)
+            if not subscribers:
+                # Nobody watches the route any more; stop polling it
+                self._subscribers.pop(subscription.route_id, None)
+                self._vehicles.pop(subscription.route_id, None)
+
+    def _publish(self, route_id, event, data):
+        with self._lock:
+            subscribers = list(self._subscribers.get(route_id, ()))
+            vehicles = list(self._vehicles.get(route_id, {}).values())
+        for subscription in subscribers:
+            try:
+                subscription.events.put_nowait((event, data))
+            except queue.Full:
+                # A client too slow to keep up starts over from the current state
+                while True:
+                    try:
+                        subscription.events.get_nowait()
+                    except queue.Empty:
+                        break
+                subscription.events.put_nowait(("snapshot", vehicles))
+
+    def poll_route(self, route_id):
+        """Fetch a route's vehicles once and publish what changed."""
+        vehicles = {_vehicle_key(vehicle): vehicle for vehicle in fetch_vehicles(route_id)}
+        with self._lock:
+            if route_id not in self._subscribers:
+                return
+            previous = self._vehicles.get(route_id)
+            self._vehicles[route_id] = vehicles
+        if previous is None:
+            self._publish(route_id, "snapshot", list(vehicles.values()))
+            return
+        moved = [
+            vehicle for key, vehicle in vehicles.items()
+            if key not in previous
+            or any(vehicle.get(field) != previous[key].get(field) for field in POSITION_FIELDS)
+        ]
+        removed = [key for key in previous if key not in vehicles]
+        if moved or removed:
+            self._publish(route_id, "update", {"vehicles": moved, "removed": removed})
+
+    def _poll_loop(self):
+        while True:
+            started = time.monotonic()
+            with self._lock:
+                route_ids = list(self._subscribers)
+            if not route_ids:
+                # Idle until someone subscribes again, which starts a new poller
+                with self._lock:
+                    if not self._subscribers:
+                        self._thread = None
+                        return
+                continue
+            for route_id in route_ids:
+                try:
+                    self.poll_route(route_id)
+                    self.polls += 1
+                except Exception as e:
+                    self.errors += 1
+                    print(f"Error polling vehicles for route {route_id}: {e}")
+            time.sleep(max(self.interval - (time.monotonic() - started), 0))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "routes": len(self._subscribers),
+                "subscribers": sum(len(subscribers) for subscribers in self._subscribers.values()),
+                "polls": self.polls,
+                "errors": self.errors,
+                "interval_seconds": self.interval,
+            }
@@ -0,0 +1,221 @@
+import json
+import sqlite3
+
+import requests
+
+from . import transport
+from .spatial import haversine_distance
+
+# Coordinates are rounded to this many decimals (about a meter) for caching
+COORDINATE_DECIMALS = 5
+
+
+def _key(point):
+    lat, lon = point
+    return f"{round(lat, COORDINATE_DECIMALS)},{round(lon, COORDINATE_DECIMALS)}"
+
+
+def _chunks(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+class WalkingDistances:
+    """
+    Walking distances in meters from OSRM's /table service, many pairs per
+    request, cached in SQLite by rounded coordinates so every worker pointing
+    at the same file shares them.
+
+    When the router cannot be reached, or finds no path, the straight-line
+    distance times detour_factor is used instead. Those estimates are not
+    cached, so the router is asked again next time.
+    """
+
+    def __init__(self, osrm_url, profile, cache_path, timeout, detour_factor, max_table_size):
+        self.osrm_url = osrm_url.rstrip("/")
+        self.profile = profile
+        self.cache_path = cache_path
+        self.timeout = timeout
+        self.detour_factor = detour_factor
+        self.max_table_size = max_table_size
+        self.requests = 0
+        self.estimates = 0
+        self._init_db()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.cache_path, timeout=30)
+        conn.execute("PRAGMA journal_mode = WAL")
+        return conn
+
+    def _init_db(self):
+        conn = self._connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS walking_distances (
+                    origin TEXT,
+                    destination TEXT,
+                    meters REAL,
+                    PRIMARY KEY (origin, destination)
+                )
+            """)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _fetch_table(self, origins, destinations):
+        """Ask OSRM for the distances from every origin to every destination, in one request."""
+        points = origins + destinations
+        coordinates = ";".join(f"{lon},{lat}" for lat, lon in points)
+        sources = ";".join(str(index) for index in range(len(origins)))
+        targets = ";".join(str(index) for index in range(len(origins), len(points)))
+        # OSRM wants the ";" separators as they are, not percent-encoded
+        self.requests += 1
+        response = transport.get(
+            f"{self.osrm_url}/table/v1/{self.profile}/{coordinates}"
+            f"?sources={sources}&destinations={targets}&annotations=distance",
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        data = response.json()
+        if data.get("code") != "Ok":
+            raise ValueError(f"OSRM table request failed: {data.get('code')} {data.get('message', '')}")
+        return data["distances"]
+
+    def _read_cache(self, conn, origin_keys, destination_keys):
+        rows = conn.execute(
+            "SELECT origin, destination, meters FROM walking_distances "
+            "WHERE origin IN (SELECT value FROM json_each(?)) AND destination IN (SELECT value FROM json_each(?))",
+            (json.dumps(sorted(set(origin_keys))), json.dumps(sorted(set(destination_keys)))),
+        ).fetchall()
+        return {(origin, destination): meters for origin, destination, meters in rows}
+
+    def _fetch_tables(self, conn, tables, points, known):
+        """
+        Fetch each (origin keys, destination keys) table from the router into
+        known and cache the results. A failing router leaves the rest unknown.
+        """
+        fetched = []
+        try:
+            for origin_keys, destination_keys in tables:
+                table = self._fetch_table(
+                    [points[key] for key in origin_keys], [points[key] for key in destination_keys]
+                )
+                for origin, row in zip(origin_keys, table):
+                    for destination, meters in zip(destination_keys, row):
+                        if meters is not None:
+                            known[origin, destination] = meters
+                            fetched.append((origin, destination, meters))
+        except (requests.RequestException, ValueError, KeyError) as e:
+            print(f"Walking distances unavailable from OSRM ({e}); estimating the rest.")
+        conn.executemany("INSERT OR REPLACE INTO walking_distances VALUES (?, ?, ?)", fetched)
+        conn.commit()
+
+    def _meters(self, known, origin, origin_key, destination, destination_key):
+        meters = known.get((origin_key, destination_key))
+        if meters is None:
+            self.estimates += 1
+            meters = haversine_distance(*origin, *destination) * self.detour_factor
+        return meters
+
+    def distances(self, origins, destinations):
+        """
+        Return the matrix of walking distances in meters from every (lat, lon)
+        origin to every (lat, lon) destination.
+        """
+        origin_keys = [_key(point) for point in origins]
+        destination_keys = [_key(point) for point in destinations]
+        conn = self._connect()
+        try:
+            known = self._read_cache(conn, origin_keys, destination_keys)
+
+            # Only the origins and destinations with an uncached pair go to the router
+            points = dict(zip(origin_keys + destination_keys, list(origins) + list(destinations)))
+            missing = [(o, d) for o in origin_keys for d in destination_keys if (o, d) not in known]
+            missing_origins = list(dict.fromkeys(o for o, _ in missing))
+            missing_destinations = list(dict.fromkeys(d for _, d in missing))
+
+            if missing:
+                # OSRM caps the coordinates of one table request at max_table_size
+                half = max(self.max_table_size // 2, 1)
+                origin_size = min(len(missing_origins), max(self.max_table_size - len(missing_destinations), half))
+                destination_size = max(self.max_table_size - origin_size, 1)
+                tables = [
+                    (origin_chunk, destination_chunk)
+                    for origin_chunk in _chunks(missing_origins, origin_size)
+                    for destination_chunk in _chunks(missing_destinations, destination_size)
+                ]
+                self._fetch_tables(conn, tables, points, known)
+        finally:
+            conn.close()
+
+        return [
+            [
+                self._meters(known, origin, origin_key, destination, destination_key)
+                for destination, destination_key in zip(destinations, destination_keys)
+            ]
+            for origin, origin_key in zip(origins, origin_keys)
+        ]
+
+    def pair_distances(self, pairs):
+        """
+        Return the walking distance in meters of every ((lat, lon) origin,
+        (lat, lon) destination) pair, in order.
+
+        Unlike distances, only the listed pairs are needed: each table
+        request packs origins with just their own destinations, so many
+        origins that each have a few nearby destinations share requests.
+        """
+        keys = [(_key(origin), _key(destination)) for origin, destination in pairs]
+        conn = self._connect()
+        try:
+            known = self._read_cache(conn, [o for o, _ in keys], [d for _, d in keys])
+
+            points = {}
+            by_origin = {}
+            for (origin, destination), (origin_key, destination_key) in zip(pairs, keys):
+                if (origin_key, destination_key) not in known:
+                    points[origin_key], points[destination_key] = origin, destination
+                    destinations = by_origin.setdefault(origin_key, [])
+                    if destination_key not in destinations:
+                        destinations.append(destination_key)
+
+            # Fill each request with whole origins while they fit under
+            # max_table_size; an origin with more destinations than that
+            # gets requests of its own
+            tables, origin_keys, destination_keys = [], [], []
+            for origin_key, destinations in by_origin.items():
+                merged = list(dict.fromkeys(destination_keys + destinations))
+                if origin_keys and len(origin_keys) + 1 + len(merged) > self.max_table_size:
+                    tables.append((origin_keys, destination_keys))
+                    origin_keys, merged = [], destinations
+                if 1 + len(merged) > self.max_table_size:
+                    tables.extend(
+                        ([origin_key], chunk) for chunk in _chunks(merged, max(self.max_table_size - 1, 1))
+                    )
+                    origin_keys, destination_keys = [], []
+                    continue
+                origin_keys.append(origin_key)
+                destination_keys = merged
+            if origin_keys:
+                tables.append((origin_keys, destination_keys))
+
+            if tables:
+                self._fetch_tables(conn, tables, points, known)
+        finally:
+            conn.close()
+
+        return [
+            self._meters(known, origin, origin_key, destination, destination_key)
+            for (origin, destination), (origin_key, destination_key) in zip(pairs, keys)
+        ]
+
+    def distance(self, lat1, lon1, lat2, lon2):
+        """Walking distance in meters between two points."""
+        return self.distances([(lat1, lon1)], [(lat2, lon2)])[0][0]
+
+    def stats(self):
+        conn = self._connect()
+        try:
+            pairs = conn.execute("SELECT COUNT(*) FROM walking_distances").fetchone()[0]
+        finally:
+            conn.close()
+        return {"cached_pairs": pairs, "osrm_requests": self.requests, "estimates": self.estimates}
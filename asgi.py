@@ -0,0 +1,9 @@
+from asgiref.wsgi import WsgiToAsgi
+
+from app import create_app
+from app.asgi import AsyncApp
+
+flask_app = create_app()
+
+# Serve with an ASGI server, e.g. `uvicorn asgi:app`
+app = AsyncApp(flask_app, WsgiToAsgi(flask_app))
@@ -0,0 +1,276 @@
+"""
+Compare ways of serving /api/routes, whose departures fan-out dominates it,
+under many concurrent requests, against a local NexTrip stand-in with a
+fixed response latency:
+
+- previous: a thread per request through the Flask view, which runs
+  asyncio.run() with its own aiohttp.ClientSession (how /api/routes used
+  to fetch departures)
+- shared-loop: a thread per request through the Flask view, handing the
+  fan-out to the transport's long-lived event loop and its pooled sessions
+- asgi: a coroutine per request through app/asgi.py's AsyncApp on one
+  event loop, as an ASGI server runs it
+
+    python benchmarks/bench_fanout.py [--requests 400] [--concurrency 200] [--stops 20] [--latency 50]
+
+Every request is made at its own cluster of stops in a generated feed, and
+the departures cache is disabled, so the upstream work is the same in
+every mode.
+"""
+import argparse
+import asyncio
+import csv
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from math import cos, pi, sin
+from types import SimpleNamespace
+from unittest import mock
+
+import aiohttp
+from aiohttp import web
+from asgiref.wsgi import WsgiToAsgi
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app, routes, services, transport  # noqa: E402
+from app.asgi import AsyncApp  # noqa: E402
+from app.gtfs_feed import install_feed  # noqa: E402
+from app.stop_index import stop_index  # noqa: E402
+from config import Config  # noqa: E402
+
+ROUTE_ID = "2"
+CENTER_LAT = 44.9778
+CENTER_LON = -93.2650
+# Clusters are this many degrees apart, well beyond RADIUS of each other
+CLUSTER_SPACING = 0.02
+CLUSTER_RADIUS_DEGREES = 0.001
+RADIUS = 300
+
+
+def _csv(header, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+
+def make_cluster_feed(path, clusters, stops_per_cluster):
+    """
+    Write a GTFS zip with one trip of route ROUTE_ID per cluster, visiting
+    stops_per_cluster stops on a small circle. Returns the path and each
+    cluster's center.
+    """
+    columns = int(clusters ** 0.5) + 1
+    centers, stops, trips, stop_times = [], [], [], []
+    for cluster in range(clusters):
+        lat = CENTER_LAT + cluster // columns * CLUSTER_SPACING
+        lon = CENTER_LON + cluster % columns * CLUSTER_SPACING
+        centers.append((lat, lon))
+        trip_id = f"trip-{cluster}"
+        trips.append([ROUTE_ID, "Weekday", trip_id])
+        for i in range(stops_per_cluster):
+            angle = 2 * pi * i / stops_per_cluster
+            stop_id = f"{cluster}-{i}"
+            stops.append([stop_id, f"Stop {stop_id}", f"{lat + CLUSTER_RADIUS_DEGREES * sin(angle):.6f}",
+                          f"{lon + CLUSTER_RADIUS_DEGREES * cos(angle):.6f}"])
+            departure = f"08:{i % 60:02d}:00"
+            stop_times.append([trip_id, departure, departure, stop_id, i + 1])
+
+    files = {
+        "agency.txt": _csv(["agency_id", "agency_name", "agency_url", "agency_timezone"],
+                           [["MET", "Metro Transit", "https://www.metrotransit.org", "America/Chicago"]]),
+        "stops.txt": _csv(["stop_id", "stop_name", "stop_lat", "stop_lon"], stops),
+        "routes.txt": _csv(["route_id", "agency_id", "route_short_name", "route_type"], [[ROUTE_ID, "MET", ROUTE_ID, 3]]),
+        "calendar.txt": _csv(
+            ["service_id", "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday",
+             "start_date", "end_date"],
+            [["Weekday", 1, 1, 1, 1, 1, 0, 0, "20260101", "20261231"]]),
+        "trips.txt": _csv(["route_id", "service_id", "trip_id"], trips),
+        "stop_times.txt": _csv(["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence"], stop_times),
+    }
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        for name, contents in files.items():
+            zip_ref.writestr(name, contents)
+    return path, centers
+
+
+def start_nextrip_standin(latency):
+    """Serve canned NexTrip departures after latency seconds; return its base URL."""
+    async def departures(request):
+        await asyncio.sleep(latency)
+        return web.json_response({
+            "stops": [{"description": f"Stop {request.match_info['stop_id']}"}],
+            "departures": [{"route_id": ROUTE_ID, "departure_time": 1700000000 + 600 * i} for i in range(4)],
+        })
+
+    loop = asyncio.new_event_loop()
+    app = web.Application()
+    app.router.add_get("/nextrip/{stop_id}", departures)
+    runner = web.AppRunner(app, access_log=None)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0, backlog=4096)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return f"http://127.0.0.1:{port}/nextrip"
+
+
+async def previous_fan_out(stop_ids):
+    async with aiohttp.ClientSession() as session:
+        async def fetch(stop_id):
+            async with session.get(f"{services.METRO_TRANSIT_API_URL}/{stop_id}") as response:
+                return await response.json() if response.status == 200 else None
+
+        return await asyncio.gather(*[fetch(stop_id) for stop_id in stop_ids])
+
+
+def answered(status, results):
+    """Whether a response listed the route with all of its departures."""
+    return status == 200 and any(result["num_departures"] == 4 for result in results)
+
+
+def run_threaded(flask_app, urls, concurrency):
+    latencies = []
+
+    def serve(url):
+        start = time.perf_counter()
+        response = flask_app.test_client().get(url)
+        latencies.append(time.perf_counter() - start)
+        return answered(response.status_code, response.get_json())
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        count = sum(executor.map(serve, urls))
+    return latencies, count
+
+
+def run_previous(flask_app, urls, concurrency):
+    # The view as it was: a fresh event loop and session per request
+    with mock.patch.object(routes, "transport", SimpleNamespace(run_async=asyncio.run)), \
+            mock.patch.object(routes, "fetch_all_departures", previous_fan_out):
+        return run_threaded(flask_app, urls, concurrency)
+
+
+def run_shared_loop(flask_app, urls, concurrency):
+    try:
+        return run_threaded(flask_app, urls, concurrency)
+    finally:
+        transport.run_async(transport.close_async_sessions())
+
+
+async def asgi_get(app, url):
+    """Send one GET through an ASGI app; return (status, body bytes)."""
+    path, _, query = url.partition("?")
+    scope = {"type": "http", "method": "GET", "path": path, "query_string": query.encode(), "headers": []}
+    response = {"body": []}
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        else:
+            response["body"].append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return response["status"], b"".join(response["body"])
+
+
+def run_asgi(flask_app, urls, concurrency):
+    app = AsyncApp(flask_app, WsgiToAsgi(flask_app))
+    latencies = []
+
+    async def serve(url, semaphore):
+        async with semaphore:
+            start = time.perf_counter()
+            status, body = await asgi_get(app, url)
+            latencies.append(time.perf_counter() - start)
+            return answered(status, json.loads(body))
+
+    async def main():
+        # Start and stop the app as an ASGI server would
+        lifespan, events = asyncio.Queue(), asyncio.Queue()
+        server = asyncio.create_task(app({"type": "lifespan"}, lifespan.get, events.put))
+        await lifespan.put({"type": "lifespan.startup"})
+        await events.get()
+        semaphore = asyncio.Semaphore(concurrency)
+        try:
+            return sum(await asyncio.gather(*[serve(url, semaphore) for url in urls]))
+        finally:
+            await lifespan.put({"type": "lifespan.shutdown"})
+            await server
+
+    count = asyncio.run(main())
+    return latencies, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=400, help="requests per mode")
+    parser.add_argument("--concurrency", type=int, default=200, help="requests in flight at once")
+    parser.add_argument("--stops", type=int, default=20, help="stops fetched per request")
+    parser.add_argument("--latency", type=float, default=50, help="stand-in response time in ms")
+    parser.add_argument("--max-per-host", type=int, default=256, help="transport connections per host")
+    args = parser.parse_args()
+
+    services.METRO_TRANSIT_API_URL = start_nextrip_standin(args.latency / 1000)
+    modes = [("previous", run_previous), ("shared-loop", run_shared_loop), ("asgi", run_asgi)]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # One cluster of stops per request and mode, so no two requests
+        # share a stop
+        zip_path, centers = make_cluster_feed(
+            os.path.join(workdir, "download.zip"), args.requests * len(modes), args.stops
+        )
+        feed = install_feed(zip_path, workdir)
+        stop_index(feed)
+
+        Config.GTFS_CACHE_DIR = workdir
+        Config.GTFS_REFRESH_INTERVAL = 0
+        Config.DEPARTURES_CACHE_TTL = 0
+        Config.POI_CACHE_TTL = 0
+        Config.WALKING_CACHE_PATH = os.path.join(workdir, "walking_cache.db")
+        Config.HTTP_MAX_PER_HOST = args.max_per_host
+        Config.HTTP_RETRIES = 0
+        flask_app = create_app()
+
+        print(f"{args.requests} requests x {args.stops} stops, {args.concurrency} concurrent, "
+              f"{args.latency:.0f} ms upstream latency")
+        print(f"{'mode':>12} {'wall s':>8} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'answered':>9} {'threads':>8}")
+        for number, (name, run) in enumerate(modes):
+            urls = [
+                f"/api/routes?lat={lat}&lon={lon}&radius={RADIUS}&frequency=15"
+                for lat, lon in centers[number * args.requests:(number + 1) * args.requests]
+            ]
+            peak_threads = [threading.active_count()]
+            done = threading.Event()
+
+            def sample():
+                while not done.wait(0.01):
+                    peak_threads[0] = max(peak_threads[0], threading.active_count())
+
+            sampler = threading.Thread(target=sample, daemon=True)
+            sampler.start()
+            start = time.perf_counter()
+            latencies, count = run(flask_app, urls, args.concurrency)
+            wall = time.perf_counter() - start
+            done.set()
+            sampler.join()
+
+            latencies.sort()
+            print(f"{name:>12} {wall:8.2f} {args.requests / wall:8.1f} "
+                  f"{statistics.median(latencies) * 1000:8.0f} {latencies[int(len(latencies) * 0.95)] * 1000:8.0f} "
+                  f"{count:>9} {peak_threads[0]:>8}")
+
+
+if __name__ == "__main__":
+    main()
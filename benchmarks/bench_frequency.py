@@ -0,0 +1,70 @@
+"""
+Compare the /api/schedule/nearby frequency backends (sql, summary, numpy)
+across search radii on a fixture feed, and check they return identical rows.
+
+    python benchmarks/bench_frequency.py [--gtfs path/to/gtfs.zip]
+
+Without --gtfs a synthetic Metro-Transit-shaped feed is generated.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.frequency import FREQUENCY_BACKENDS  # noqa: E402
+from app.gtfs_loader import load_gtfs_to_sql  # noqa: E402
+from app.spatial import find_nearby_stops  # noqa: E402
+from benchmarks.synthetic_feed import make_synthetic_feed  # noqa: E402
+
+RADII_FEET = [500, 1320, 2640, 5280, 10560]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--gtfs", help="GTFS zip to benchmark against")
+    parser.add_argument("--points", type=int, default=30, help="query locations per radius")
+    parser.add_argument("--frequency", type=float, default=15, help="frequency limit in minutes")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        gtfs_path = args.gtfs or make_synthetic_feed(os.path.join(workdir, "gtfs.zip"))
+        db_path = os.path.join(workdir, "gtfs.db")
+        load_gtfs_to_sql(gtfs_path, db_path)
+
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        stops = conn.execute("SELECT stop_lat, stop_lon FROM stops").fetchall()
+        rnd = random.Random(0)
+        points = [rnd.choice(stops) for _ in range(args.points)]
+
+        # Map the timetable before timing so the first query doesn't pay for it
+        FREQUENCY_BACKENDS["numpy"](conn, [], args.frequency)
+
+        print(f"\n{'radius (ft)':>12} {'stops':>7} " + " ".join(f"{name + ' ms':>12}" for name in FREQUENCY_BACKENDS))
+        for radius in RADII_FEET:
+            timings = {name: [] for name in FREQUENCY_BACKENDS}
+            stop_counts = []
+            for lat, lon in points:
+                stop_ids = [stop[0] for stop in find_nearby_stops(conn, lat, lon, radius / 3.28084)]
+                stop_counts.append(len(stop_ids))
+                results = {}
+                for name, backend in FREQUENCY_BACKENDS.items():
+                    started = time.perf_counter()
+                    results[name] = backend(conn, stop_ids, args.frequency)
+                    timings[name].append((time.perf_counter() - started) * 1000)
+                if any(rows != results["sql"] for rows in results.values()):
+                    raise SystemExit(f"Backends disagree at ({lat}, {lon}) radius {radius} ft")
+
+            print(f"{radius:>12} {statistics.mean(stop_counts):>7.1f} "
+                  + " ".join(f"{statistics.median(timings[name]):>12.2f}" for name in FREQUENCY_BACKENDS))
+        conn.close()
+        print("\nAll backends returned identical rows (median times shown).")
+
+
+if __name__ == "__main__":
+    main()
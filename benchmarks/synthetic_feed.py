@@ -0,0 +1,87 @@
+"""
+Generate a synthetic GTFS zip shaped like the Metro Transit feed (routes with
+branches, weekday/Saturday/Sunday/holiday services, shapes) for benchmarks.
+"""
+import csv
+import io
+import random
+import zipfile
+
+CENTER_LAT = 44.9778
+CENTER_LON = -93.2650
+
+
+def _csv(header, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+
+def _gtfs_time(seconds):
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def make_synthetic_feed(path, routes=40, stops_per_route=40, trips_per_direction=60, seed=0, first_departure=5 * 3600):
+    """
+    Write a synthetic GTFS zip to path and return the path. Every route's
+    first trips leave at first_departure seconds into the service day.
+    """
+    rnd = random.Random(seed)
+    stops, trips, stop_times, shapes = [], [], [], []
+    next_stop_id = 10000
+
+    for route_number in range(1, routes + 1):
+        # Each route is a straight line through the city at a random angle
+        angle_lat, angle_lon = rnd.uniform(-1, 1), rnd.uniform(-1, 1)
+        offset_lat, offset_lon = rnd.uniform(-0.08, 0.08), rnd.uniform(-0.08, 0.08)
+        route_stops = []
+        for i in range(stops_per_route):
+            position = (i - stops_per_route / 2) * 0.004
+            lat = CENTER_LAT + offset_lat + angle_lat * position
+            lon = CENTER_LON + offset_lon + angle_lon * position
+            stop_id = str(next_stop_id)
+            next_stop_id += 1
+            stops.append([stop_id, f"Stop {stop_id}", f"{lat:.6f}", f"{lon:.6f}"])
+            route_stops.append((stop_id, lat, lon))
+
+        route_id = str(route_number)
+        for direction in (0, 1):
+            shape_id = f"{route_id}-{direction}"
+            ordered = route_stops if direction == 0 else route_stops[::-1]
+            for sequence, (_, lat, lon) in enumerate(ordered, start=1):
+                shapes.append([shape_id, f"{lat:.6f}", f"{lon:.6f}", sequence])
+
+            for service_id, share in (("Weekday", 1), ("Saturday", 2), ("Sunday", 3), ("Holiday", 4)):
+                for trip_number in range(trips_per_direction // share):
+                    branch_letter = "A" if trip_number % 4 == 0 else ""
+                    trip_id = f"{route_id}-{direction}-{trip_number}-{service_id}"
+                    trips.append([route_id, service_id, trip_id, direction, shape_id, branch_letter])
+                    start = first_departure + trip_number * rnd.choice([300, 600, 900, 1200]) * share
+                    for sequence, (stop_id, _, _) in enumerate(ordered, start=1):
+                        departure = _gtfs_time(start + sequence * 75)
+                        stop_times.append([trip_id, departure, departure, stop_id, sequence])
+
+    files = {
+        "agency.txt": _csv(["agency_id", "agency_name", "agency_url", "agency_timezone"],
+                           [["MET", "Metro Transit", "https://www.metrotransit.org", "America/Chicago"]]),
+        "stops.txt": _csv(["stop_id", "stop_name", "stop_lat", "stop_lon"], stops),
+        "routes.txt": _csv(["route_id", "agency_id", "route_short_name", "route_type"],
+                           [[str(n), "MET", str(n), 3] for n in range(1, routes + 1)]),
+        "calendar.txt": _csv(
+            ["service_id", "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday",
+             "start_date", "end_date"],
+            [["Weekday", 1, 1, 1, 1, 1, 0, 0, "20260101", "20261231"],
+             ["Saturday", 0, 0, 0, 0, 0, 1, 0, "20260101", "20261231"],
+             ["Sunday", 0, 0, 0, 0, 0, 0, 1, "20260101", "20261231"]]),
+        "calendar_dates.txt": _csv(["service_id", "date", "exception_type"],
+                                   [["Holiday", "20261126", 1], ["Weekday", "20261126", 2]]),
+        "trips.txt": _csv(["route_id", "service_id", "trip_id", "direction_id", "shape_id", "branch_letter"], trips),
+        "stop_times.txt": _csv(["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence"], stop_times),
+        "shapes.txt": _csv(["shape_id", "shape_pt_lat", "shape_pt_lon", "shape_pt_sequence"], shapes),
+    }
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        for name, contents in files.items():
+            zip_ref.writestr(name, contents)
+    return path
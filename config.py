@@ -10,6 +10,77 @@ class Config:
     SECRET_KEY = os.getenv('SECRET_KEY', 'default_secret_key')
     FLASK_ENV = os.environ.get('FLASK_ENV', 'production')
 
+    # GTFS feed
+    GTFS_URL = os.getenv('GTFS_URL', 'https://svc.metrotransit.org/mtgtfs/gtfs.zip')
+    GTFS_CACHE_DIR = os.getenv('GTFS_CACHE_DIR', '/tmp')
+    # Seconds between background checks for a new feed; 0 disables the refresher
+    GTFS_REFRESH_INTERVAL = int(os.getenv('GTFS_REFRESH_INTERVAL', 3600))
+
+    # Engine behind /api/schedule/nearby: "summary", "numpy" or "sql"
+    # (see benchmarks/bench_frequency.py)
+    FREQUENCY_BACKEND = os.getenv('FREQUENCY_BACKEND', 'summary')
+
+    # Response cache of /api/schedule/nearby: memory cap in bytes (0 disables
+    # it) and the size of the grid cells searches are snapped to (0 keeps the
+    # exact coordinates)
+    NEARBY_CACHE_MAX_BYTES = int(os.getenv('NEARBY_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+    NEARBY_CACHE_CELL_METERS = float(os.getenv('NEARBY_CACHE_CELL_METERS', 25))
+
+    # Cache-Control max-age (seconds) of the feed-derived API responses;
+    # browsers revalidate with If-None-Match after that
+    API_CACHE_MAX_AGE = int(os.getenv('API_CACHE_MAX_AGE', 300))
+
+    # Local store of OSM amenities (see `flask import-pois`); Overpass answers
+    # POI lookups while it is missing unless the fallback is turned off
+    POI_DB_PATH = os.getenv('POI_DB_PATH', os.path.join(GTFS_CACHE_DIR, 'pois.db'))
+    POI_OVERPASS_FALLBACK = os.getenv('POI_OVERPASS_FALLBACK', 'true').lower() in ('1', 'true', 'yes')
+    # "corridor" fetches a route's POIs from Overpass in one query along its
+    # stops; "per_stop" sends one bounding-box query per stop. With the POI
+    # cache on, both fill the cache's missing cells instead: corridor mode
+    # with a query through the cells' centers, per_stop with their boxes.
+    POI_OVERPASS_MODE = os.getenv('POI_OVERPASS_MODE', 'corridor')
+
+    # Overpass results cached on disk per 0.01 degree cell, shared by all
+    # workers. Cells are fresh for POI_CACHE_TTL seconds (0 disables the
+    # cache), then served stale for POI_CACHE_STALE_SECONDS more while they
+    # are refetched in the background.
+    POI_CACHE_PATH = os.getenv('POI_CACHE_PATH', os.path.join(GTFS_CACHE_DIR, 'poi_cache.db'))
+    POI_CACHE_TTL = int(os.getenv('POI_CACHE_TTL', 7 * 24 * 3600))
+    POI_CACHE_STALE_SECONDS = int(os.getenv('POI_CACHE_STALE_SECONDS', 30 * 24 * 3600))
+    POI_CACHE_MAX_BYTES = int(os.getenv('POI_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+    # Upstream HTTP calls (app/transport.py): timeouts in seconds, concurrent
+    # requests per host, retries with jittered backoff from HTTP_RETRY_BACKOFF
+    # seconds, and a circuit breaker that stops calling a host for
+    # HTTP_BREAKER_RESET_SECONDS after HTTP_BREAKER_FAILURES failures in a row
+    HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 3.05))
+    HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 30))
+    HTTP_MAX_PER_HOST = int(os.getenv('HTTP_MAX_PER_HOST', 10))
+    HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 2))
+    HTTP_RETRY_BACKOFF = float(os.getenv('HTTP_RETRY_BACKOFF', 0.5))
+    HTTP_BREAKER_FAILURES = int(os.getenv('HTTP_BREAKER_FAILURES', 5))
+    HTTP_BREAKER_RESET_SECONDS = float(os.getenv('HTTP_BREAKER_RESET_SECONDS', 30))
+
+    # Seconds NexTrip departures of a stop are reused; concurrent requests for
+    # a stop share one upstream call either way
+    DEPARTURES_CACHE_TTL = float(os.getenv('DEPARTURES_CACHE_TTL', 20))
+
+    # Seconds between NexTrip polls of each watched route's vehicles, and
+    # between keep-alive comments on idle vehicle streams
+    VEHICLE_POLL_INTERVAL = float(os.getenv('VEHICLE_POLL_INTERVAL', 10))
+    VEHICLE_STREAM_KEEPALIVE = float(os.getenv('VEHICLE_STREAM_KEEPALIVE', 15))
+
+    # OSRM router behind walking distances, queried through its /table
+    # service at most OSRM_MAX_TABLE_SIZE coordinates at a time. Results are
+    # cached in WALKING_CACHE_PATH; without the router, walking distance is
+    # the straight-line distance times WALKING_DETOUR_FACTOR.
+    OSRM_URL = os.getenv('OSRM_URL', 'http://router.project-osrm.org')
+    OSRM_PROFILE = os.getenv('OSRM_PROFILE', 'walking')
+    OSRM_TIMEOUT = float(os.getenv('OSRM_TIMEOUT', 5))
+    OSRM_MAX_TABLE_SIZE = int(os.getenv('OSRM_MAX_TABLE_SIZE', 100))
+    WALKING_CACHE_PATH = os.getenv('WALKING_CACHE_PATH', os.path.join(GTFS_CACHE_DIR, 'walking_cache.db'))
+    WALKING_DETOUR_FACTOR = float(os.getenv('WALKING_DETOUR_FACTOR', 1.3))
+
 class DevelopmentConfig(Config):
     DEBUG = True
     FLASK_ENV = 'development'
@@ -17,6 +88,7 @@ class DevelopmentConfig(Config):
 class TestingConfig(Config):
     TESTING = True
     DEBUG = True
+    GTFS_REFRESH_INTERVAL = 0
 
 class ProductionConfig(Config):
     pass
@@ -0,0 +1,66 @@
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.spatial import haversine_distance  # noqa: E402
+
+# Walks the OSRM stand-in reports are this much longer than the straight line
+OSRM_DETOUR = 1.1
+
+
+class OsrmStandIn(BaseHTTPRequestHandler):
+    """Answers /table requests with straight-line distances times OSRM_DETOUR, counting requests."""
+
+    requests = []
+    fail = False
+    lock = threading.Lock()
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        coordinates = url.path.rsplit("/", 1)[1].split(";")
+        points = [tuple(reversed([float(value) for value in pair.split(",")])) for pair in coordinates]
+        query = parse_qs(url.query)
+        sources = [points[int(index)] for index in query["sources"][0].split(";")]
+        destinations = [points[int(index)] for index in query["destinations"][0].split(";")]
+        with OsrmStandIn.lock:
+            OsrmStandIn.requests.append(len(points))
+
+        if self.fail:
+            self.send_response(503)
+            self.end_headers()
+            return
+        payload = {
+            "code": "Ok",
+            "distances": [
+                [haversine_distance(*source, *destination) * OSRM_DETOUR for destination in destinations]
+                for source in sources
+            ],
+        }
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def osrm(monkeypatch):
+    """A local OSRM router; yields (base URL, stand-in class)."""
+    monkeypatch.setattr(OsrmStandIn, "requests", [])
+    monkeypatch.setattr(OsrmStandIn, "fail", False)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), OsrmStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}", OsrmStandIn
+    server.shutdown()
+    server.server_close()
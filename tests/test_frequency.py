@@ -0,0 +1,125 @@
+"""
+Every frequency backend must return identical rows: the sql, summary (and its
+hourly cube for time windows) and numpy backends are compared on synthetic
+feeds across radii, service dates and time windows, including windows that
+run past midnight.
+"""
+import random
+import sqlite3
+
+import pytest
+
+from app import create_app
+from app.frequency import FREQUENCY_BACKENDS
+from app.gtfs_feed import install_feed
+from app.service_calendar import services_on
+from app.spatial import find_nearby_stops
+from benchmarks.synthetic_feed import make_synthetic_feed
+from config import Config
+
+RADII_METERS = [150, 400, 800, 1600, 3200]
+# Any day, Thanksgiving (holiday service only), a Monday and a Saturday
+DATES = [None, "20261126", "20260302", "20260307"]
+# One feed runs from 16:00 to past 24:00:00, the other from 00:30:00 to the
+# morning; each is asked about windows it has departures in
+FEEDS = {
+    "late-night": (16 * 3600, [None, (17, 20), (22, 2), (23, 23)]),
+    "early-morning": (1800, [None, (1, 3), (6, 9), (22, 2), (23, 23)]),
+}
+FREQUENCY_LIMIT = 15
+FIRST_TRIP = -5
+
+
+def hour_window(start_hour, end_hour):
+    """The window /api/schedule/nearby builds from start_hour and end_hour."""
+    if end_hour <= start_hour:
+        end_hour += 24
+    return start_hour * 3600, end_hour * 3600
+
+
+@pytest.fixture(scope="module")
+def feeds(tmp_path_factory):
+    installed = {}
+    for name, (first_departure, _) in FEEDS.items():
+        cache_dir = tmp_path_factory.mktemp(name)
+        zip_path = make_synthetic_feed(
+            str(cache_dir / "download.zip"), routes=6, stops_per_route=12, trips_per_direction=30,
+            first_departure=first_departure,
+        )
+        installed[name] = (str(cache_dir), install_feed(zip_path, str(cache_dir)))
+    return installed
+
+
+@pytest.fixture
+def connect(feeds):
+    connections = []
+
+    def connect(name):
+        conn = sqlite3.connect(f"file:{feeds[name][1]['db_path']}?mode=ro", uri=True)
+        connections.append(conn)
+        return conn
+
+    yield connect
+    for conn in connections:
+        conn.close()
+
+
+def stop_sets(conn):
+    """Stops around a few points of the feed, at every radius."""
+    stops = conn.execute("SELECT stop_lat, stop_lon FROM stops ORDER BY stop_id").fetchall()
+    return [
+        [stop[0] for stop in find_nearby_stops(conn, lat, lon, radius)]
+        for radius in RADII_METERS for lat, lon in random.Random(0).sample(stops, 4)
+    ]
+
+
+@pytest.mark.parametrize("service_date", DATES)
+@pytest.mark.parametrize("name,hours", [(name, hours) for name, (_, windows) in FEEDS.items() for hours in windows])
+def test_backends_return_identical_rows(connect, name, hours, service_date):
+    conn = connect(name)
+    service_ids = services_on(conn, service_date) if service_date else None
+    window = hour_window(*hours) if hours else None
+
+    answered = 0
+    for stop_ids in stop_sets(conn):
+        expected = FREQUENCY_BACKENDS["sql"](conn, stop_ids, FREQUENCY_LIMIT, service_ids, window)
+        for backend, frequency_rows in FREQUENCY_BACKENDS.items():
+            assert frequency_rows(conn, stop_ids, FREQUENCY_LIMIT, service_ids, window) == expected, backend
+        answered += bool(expected)
+    assert answered
+
+
+@pytest.mark.parametrize("backend", FREQUENCY_BACKENDS)
+def test_window_past_midnight_takes_either_way_of_writing_it(connect, backend):
+    late, early = connect("late-night"), connect("early-morning")
+    frequency_rows = FREQUENCY_BACKENDS[backend]
+    stop_ids = stop_sets(late)[-1]
+
+    # 24:30:00 and 00:30:00 both fall inside 22:00-02:00
+    assert frequency_rows(late, stop_ids, FREQUENCY_LIMIT, None, hour_window(22, 2)) == \
+        frequency_rows(late, stop_ids, FREQUENCY_LIMIT, None, (22 * 3600, 26 * 3600))
+    night = frequency_rows(early, stop_ids, FREQUENCY_LIMIT, None, hour_window(22, 2))
+    assert night
+    # and the early-morning departures count as the end of the night
+    assert all(row[FIRST_TRIP] >= 24 * 3600 for row in night)
+
+
+def test_endpoint_wraps_hours_past_midnight(feeds, tmp_path, monkeypatch):
+    cache_dir, feed = feeds["early-morning"]
+    monkeypatch.setattr(Config, "GTFS_CACHE_DIR", cache_dir)
+    monkeypatch.setattr(Config, "GTFS_REFRESH_INTERVAL", 0)
+    monkeypatch.setattr(Config, "WALKING_CACHE_PATH", str(tmp_path / "walking.db"))
+    with sqlite3.connect(feed["db_path"]) as conn:
+        lat, lon = conn.execute("SELECT stop_lat, stop_lon FROM stops ORDER BY stop_id").fetchone()
+
+    results = {}
+    for backend in FREQUENCY_BACKENDS:
+        monkeypatch.setattr(Config, "FREQUENCY_BACKEND", backend)
+        response = create_app().test_client().get(
+            f"/api/schedule/nearby?lat={lat}&lon={lon}&distance=5000&frequency=15&start_hour=22&end_hour=2"
+        )
+        assert response.status_code == 200
+        results[backend] = response.get_json()
+
+    assert results["sql"]
+    assert all(result == results["sql"] for result in results.values())
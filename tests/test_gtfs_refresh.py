@@ -0,0 +1,103 @@
+"""
+`flask refresh-gtfs` against a local HTTP server serving a fixture zip: the
+feed gets installed, unchanged feeds are answered with 304, and the command
+waits for a refresh already in progress instead of giving up.
+"""
+import fcntl
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app import create_app
+from app.gtfs_feed import LOCK_FILENAME, current_feed
+from benchmarks.synthetic_feed import make_synthetic_feed
+from config import Config
+
+ETAG = '"fixture-1"'
+
+
+class GtfsServer(BaseHTTPRequestHandler):
+    """Serves one zip with an ETag and honours If-None-Match, counting full downloads."""
+
+    payload = b""
+    downloads = 0
+
+    def do_GET(self):
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        GtfsServer.downloads += 1
+        self.send_response(200)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Length", str(len(self.payload)))
+        self.send_header("ETag", ETAG)
+        self.end_headers()
+        self.wfile.write(self.payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def gtfs_server(tmp_path, monkeypatch):
+    zip_path = make_synthetic_feed(str(tmp_path / "fixture.zip"), routes=2, stops_per_route=6, trips_per_direction=4)
+    with open(zip_path, "rb") as f:
+        monkeypatch.setattr(GtfsServer, "payload", f.read())
+    monkeypatch.setattr(GtfsServer, "downloads", 0)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GtfsServer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/gtfs.zip"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def app(gtfs_server, tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setattr(Config, "GTFS_URL", gtfs_server)
+    monkeypatch.setattr(Config, "GTFS_CACHE_DIR", str(cache_dir))
+    monkeypatch.setattr(Config, "GTFS_REFRESH_INTERVAL", 3600)
+    return create_app()
+
+
+def test_refresh_installs_the_feed_then_gets_not_modified(app):
+    runner = app.test_cli_runner()
+    cache_dir = app.config["GTFS_CACHE_DIR"]
+
+    first = runner.invoke(args=["refresh-gtfs"])
+    feed = current_feed(cache_dir)
+    second = runner.invoke(args=["refresh-gtfs"])
+
+    assert first.exit_code == 0, first.output
+    assert feed is not None and os.path.exists(feed["db_path"])
+    assert f"Current GTFS version: {feed['version']}" in first.output
+    assert second.exit_code == 0, second.output
+    assert current_feed(cache_dir)["version"] == feed["version"]
+    assert GtfsServer.downloads == 1
+    # Building the app for a CLI command must not start the refresher
+    assert "gtfs_refresher" not in app.extensions
+
+
+def test_refresh_waits_for_a_refresh_in_progress(app):
+    cache_dir = app.config["GTFS_CACHE_DIR"]
+    os.makedirs(cache_dir, exist_ok=True)
+    lock_file = open(os.path.join(cache_dir, LOCK_FILENAME), "w")
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+    def release():
+        time.sleep(0.3)
+        lock_file.close()
+
+    releaser = threading.Thread(target=release)
+    releaser.start()
+    result = app.test_cli_runner().invoke(args=["refresh-gtfs"])
+    releaser.join()
+
+    assert result.exit_code == 0, result.output
+    assert current_feed(cache_dir) is not None
+    assert GtfsServer.downloads == 1
@@ -0,0 +1,107 @@
+"""
+import_pois on small .osm XML and Overpass JSON extracts, read back through
+amenities_in_box the way /api/pois_along_route reads the local store.
+"""
+import gzip
+import json
+
+import pytest
+
+from app import create_app
+from app.poi_store import amenities_in_box, import_pois, open_poi_store
+from config import Config
+
+# (id, lat, lon, tags); node 4 is not an amenity and must be skipped
+NODES = [
+    (1, 44.9780, -93.2650, {"amenity": "cafe", "name": "Corner Cafe"}),
+    (2, 44.9790, -93.2640, {"amenity": "library", "name": "Central Library", "wheelchair": "yes"}),
+    (3, 44.9900, -93.2500, {"amenity": "pharmacy"}),
+    (4, 44.9785, -93.2645, {"highway": "bus_stop", "name": "5th St"}),
+    (5, 44.9770, -93.2660, {"amenity": "bench"}),
+]
+AMENITIES = [node for node in NODES if "amenity" in node[3]]
+# Holds nodes 1, 2 and 5 but not 3
+BOX = (44.9760, -93.2670, 44.9800, -93.2630)
+
+
+def osm_xml(nodes):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<osm version="0.6">']
+    for node_id, lat, lon, tags in nodes:
+        lines.append(f'  <node id="{node_id}" lat="{lat}" lon="{lon}">')
+        lines.extend(f'    <tag k="{key}" v="{value}"/>' for key, value in tags.items())
+        lines.append("  </node>")
+    # Ways carry amenity tags too, but have no coordinates of their own
+    lines.append('  <way id="10"><nd ref="1"/><nd ref="2"/><tag k="amenity" v="parking"/></way>')
+    lines.append("</osm>")
+    return "\n".join(lines)
+
+
+def overpass_json(nodes):
+    elements = [{"type": "node", "id": node_id, "lat": lat, "lon": lon, "tags": tags} for node_id, lat, lon, tags in nodes]
+    elements.append({"type": "way", "id": 10, "nodes": [1, 2], "tags": {"amenity": "parking"}})
+    return json.dumps({"version": 0.6, "elements": elements})
+
+
+def write_extract(tmp_path, name):
+    path = tmp_path / name
+    if name.endswith(".json"):
+        path.write_text(overpass_json(NODES))
+    elif name.endswith(".gz"):
+        with gzip.open(path, "wt") as f:
+            f.write(osm_xml(NODES))
+    else:
+        path.write_text(osm_xml(NODES))
+    return str(path)
+
+
+def expected_elements(nodes):
+    return [{"type": "node", "id": node_id, "lat": lat, "lon": lon, "tags": tags} for node_id, lat, lon, tags in nodes]
+
+
+@pytest.mark.parametrize("name", ["extract.osm", "extract.osm.gz", "overpass.json"])
+def test_import_then_query_a_box(tmp_path, name):
+    db_path = str(tmp_path / "pois.db")
+
+    count = import_pois(write_extract(tmp_path, name), db_path)
+    conn = open_poi_store(db_path)
+    found = amenities_in_box(conn, *BOX)
+    everything = amenities_in_box(conn, 44.0, -94.0, 46.0, -93.0)
+    nothing = amenities_in_box(conn, 45.5, -93.5, 45.6, -93.4)
+    conn.close()
+
+    assert count == len(AMENITIES)
+    assert found == expected_elements([node for node in AMENITIES if node[0] != 3])
+    assert everything == expected_elements(AMENITIES)
+    assert nothing == []
+
+
+def test_reimport_replaces_the_store(tmp_path):
+    db_path = str(tmp_path / "pois.db")
+    import_pois(write_extract(tmp_path, "extract.osm"), db_path)
+    reader = open_poi_store(db_path)
+
+    path = tmp_path / "smaller.json"
+    path.write_text(overpass_json(NODES[:1]))
+    import_pois(str(path), db_path)
+    conn = open_poi_store(db_path)
+
+    assert amenities_in_box(conn, *BOX) == expected_elements(NODES[:1])
+    # A reader opened before the swap keeps seeing the old store
+    assert len(amenities_in_box(reader, *BOX)) == 3
+    conn.close()
+    reader.close()
+
+
+def test_import_pois_command(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "pois.db")
+    monkeypatch.setattr(Config, "POI_DB_PATH", db_path)
+    monkeypatch.setattr(Config, "GTFS_CACHE_DIR", str(tmp_path / "gtfs"))
+    monkeypatch.setattr(Config, "GTFS_REFRESH_INTERVAL", 0)
+
+    result = create_app().test_cli_runner().invoke(args=["import-pois", write_extract(tmp_path, "extract.osm")])
+    conn = open_poi_store(db_path)
+
+    assert result.exit_code == 0, result.output
+    assert f"Imported {len(AMENITIES)} POIs" in result.output
+    assert [element["id"] for element in amenities_in_box(conn, *BOX)] == [1, 2, 5]
+    conn.close()
@@ -0,0 +1,266 @@
+"""
+/api/pois_along_route against a local Overpass stand-in: corridor mode must
+answer with one Overpass request what per_stop mode needs one per stop for,
+and both must return the same POIs, from the Flask view and from AsyncApp.
+"""
+import asyncio
+import json
+import re
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+from asgiref.wsgi import WsgiToAsgi
+
+from app import create_app, services, transport
+from app.asgi import AsyncApp
+from app.gtfs_feed import install_feed
+from app.spatial import haversine_distance
+from benchmarks.synthetic_feed import make_synthetic_feed
+from config import Config
+from conftest import OSRM_DETOUR
+
+ROUTE_ID = "1"
+WALKING_DISTANCE = 300
+
+
+def canned_amenities(stops):
+    """A lattice of amenity nodes every ~200 m around the route's stops."""
+    min_lat = min(lat for lat, _ in stops) - 0.015
+    min_lon = min(lon for _, lon in stops) - 0.015
+    rows = int((max(lat for lat, _ in stops) + 0.015 - min_lat) / 0.002)
+    cols = int((max(lon for _, lon in stops) + 0.015 - min_lon) / 0.002)
+    return [
+        {
+            "type": "node",
+            "id": row * cols + col + 1,
+            "lat": round(min_lat + row * 0.002, 6),
+            "lon": round(min_lon + col * 0.002, 6),
+            "tags": {"amenity": ("cafe", "library", "pharmacy")[(row + col) % 3], "name": f"POI {row}-{col}"},
+        }
+        for row in range(rows)
+        for col in range(cols)
+    ]
+
+
+class OverpassStandIn(BaseHTTPRequestHandler):
+    """Answers bounding-box and around queries from canned elements, counting requests."""
+
+    elements = []
+    requests = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8")
+        query = parse_qs(body)["data"][0]
+        with OverpassStandIn.lock:
+            OverpassStandIn.requests += 1
+
+        around = re.search(r"around:([\d.]+),([-\d.,]+)\)", query)
+        if around:
+            # Distance to the query's points only, which is all a corridor
+            # along a route's stops has to cover
+            radius = float(around.group(1))
+            coordinates = [float(value) for value in around.group(2).split(",")]
+            points = list(zip(coordinates[::2], coordinates[1::2]))
+            found = [
+                element for element in self.elements
+                if any(haversine_distance(lat, lon, element["lat"], element["lon"]) <= radius for lat, lon in points)
+            ]
+        else:
+            boxes = [
+                tuple(map(float, box))
+                for box in re.findall(r"\(([-\d.e]+),([-\d.e]+),([-\d.e]+),([-\d.e]+)\)", query)
+            ]
+            found = [
+                element for element in self.elements
+                if any(s <= element["lat"] <= n and w <= element["lon"] <= e for s, w, n, e in boxes)
+            ]
+
+        payload = json.dumps({"elements": found}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module", autouse=True)
+def close_upstream_sessions():
+    yield
+    transport.run_async(transport.close_async_sessions())
+
+
+@pytest.fixture
+def feed_dir(tmp_path):
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    zip_path = make_synthetic_feed(str(cache_dir / "download.zip"), routes=1, stops_per_route=12, trips_per_direction=4)
+    feed = install_feed(zip_path, str(cache_dir))
+    return cache_dir, feed
+
+
+@pytest.fixture
+def overpass(feed_dir, monkeypatch):
+    _, feed = feed_dir
+    conn = sqlite3.connect(feed["db_path"])
+    stops = conn.execute("SELECT stop_lat, stop_lon FROM stops").fetchall()
+    conn.close()
+    monkeypatch.setattr(OverpassStandIn, "elements", canned_amenities(stops))
+    monkeypatch.setattr(OverpassStandIn, "requests", 0)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), OverpassStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(services, "OSM_API_URL", f"http://127.0.0.1:{server.server_port}/api/interpreter")
+    yield OverpassStandIn
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def make_client(feed_dir, tmp_path, monkeypatch):
+    cache_dir, _ = feed_dir
+    monkeypatch.setattr(Config, "GTFS_CACHE_DIR", str(cache_dir))
+    monkeypatch.setattr(Config, "GTFS_REFRESH_INTERVAL", 0)
+    monkeypatch.setattr(Config, "POI_DB_PATH", str(tmp_path / "no-pois.db"))
+    monkeypatch.setattr(Config, "POI_OVERPASS_FALLBACK", True)
+    monkeypatch.setattr(Config, "WALKING_CACHE_PATH", str(tmp_path / "walking.db"))
+
+    def make(mode, cache_ttl=0, asgi=False):
+        monkeypatch.setattr(Config, "POI_OVERPASS_MODE", mode)
+        monkeypatch.setattr(Config, "POI_CACHE_TTL", cache_ttl)
+        monkeypatch.setattr(Config, "POI_CACHE_PATH", str(tmp_path / f"poi-cache-{mode}.db"))
+        app = create_app()
+        return AsyncApp(app, WsgiToAsgi(app)) if asgi else app.test_client()
+
+    return make
+
+
+def route_query(feed_dir):
+    _, feed = feed_dir
+    conn = sqlite3.connect(feed["db_path"])
+    lat, lon = conn.execute("SELECT stop_lat, stop_lon FROM stops ORDER BY stop_id LIMIT 1").fetchone()
+    conn.close()
+    return f"/api/pois_along_route?route_id={ROUTE_ID}&lat={lat}&lon={lon}&distance={WALKING_DISTANCE}"
+
+
+def asgi_get(app, url, headers=()):
+    """GET url from an ASGI app, inside its lifespan as a server would run it; return (status, body text)."""
+    async def main():
+        lifespan, started, response = asyncio.Queue(), asyncio.Event(), {"body": []}
+
+        async def lifespan_send(message):
+            started.set()
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            else:
+                response["body"].append(message.get("body", b""))
+
+        server = asyncio.create_task(app({"type": "lifespan"}, lifespan.get, lifespan_send))
+        await lifespan.put({"type": "lifespan.startup"})
+        await started.wait()
+        path, _, query = url.partition("?")
+        scope = {"type": "http", "method": "GET", "path": path, "query_string": query.encode(), "headers": list(headers)}
+        try:
+            await app(scope, receive, send)
+        finally:
+            await lifespan.put({"type": "lifespan.shutdown"})
+            await server
+        return response["status"], b"".join(response["body"]).decode("utf-8")
+
+    # The app's loop replaces the transport's own for good; close the
+    # sessions left on the one being replaced
+    transport.run_async(transport.close_async_sessions())
+    return asyncio.run(main())
+
+
+def fetch(client, overpass, url):
+    """Return (status, body text, Overpass requests made)."""
+    before = overpass.requests
+    if isinstance(client, AsyncApp):
+        status, body = asgi_get(client, url)
+    else:
+        response = client.get(url)
+        status, body = response.status_code, response.get_data(as_text=True)
+    return status, body, overpass.requests - before
+
+
+def test_corridor_mode_needs_one_request_where_per_stop_needs_one_per_stop(feed_dir, overpass, make_client):
+    url = route_query(feed_dir)
+
+    per_stop_status, per_stop, per_stop_requests = fetch(make_client("per_stop"), overpass, url)
+    corridor_client = make_client("corridor")
+    corridor_status, corridor, corridor_requests = fetch(corridor_client, overpass, url)
+    _, streamed, _ = fetch(corridor_client, overpass, url + "&stream=1")
+    stops = len([line for line in streamed.splitlines() if line])
+
+    assert per_stop_status == corridor_status == 200
+    assert stops > 1
+    assert per_stop_requests == stops
+    assert corridor_requests == 1
+    assert json.loads(corridor) == json.loads(per_stop)
+    assert json.loads(corridor)
+
+
+def test_corridor_mode_fills_the_poi_cache_with_one_request(feed_dir, overpass, make_client):
+    url = route_query(feed_dir)
+
+    _, per_stop, _ = fetch(make_client("per_stop"), overpass, url)
+    client = make_client("corridor", cache_ttl=3600)
+    _, cold, cold_requests = fetch(client, overpass, url)
+    _, warm, warm_requests = fetch(client, overpass, url)
+
+    assert cold_requests == 1
+    assert warm_requests == 0
+    assert json.loads(cold) == json.loads(warm) == json.loads(per_stop)
+
+
+def test_walking_metric_asks_the_router_once_for_all_stops(feed_dir, overpass, osrm, make_client, monkeypatch):
+    osrm_url, router = osrm
+    monkeypatch.setattr(Config, "OSRM_URL", osrm_url)
+    monkeypatch.setattr(Config, "OSRM_MAX_TABLE_SIZE", 1000)
+    url = route_query(feed_dir)
+    client = make_client("corridor")
+
+    _, straight, _ = fetch(client, overpass, url)
+    _, walked, _ = fetch(client, overpass, url + "&metric=walking")
+    _, cached, _ = fetch(client, overpass, url + "&metric=walking")
+
+    expected = [poi for poi in json.loads(straight) if poi["distance"] * OSRM_DETOUR <= WALKING_DISTANCE]
+    walked = json.loads(walked)
+    assert len(router.requests) == 1
+    assert expected
+    assert [dict(poi, distance=None) for poi in walked] == [dict(poi, distance=None) for poi in expected]
+    assert [poi["distance"] for poi in walked] == pytest.approx([poi["distance"] * OSRM_DETOUR for poi in expected])
+    assert json.loads(cached) == walked
+
+
+@pytest.mark.parametrize("mode", ["per_stop", "corridor"])
+def test_asgi_app_answers_like_the_flask_view(feed_dir, overpass, make_client, mode):
+    url = route_query(feed_dir)
+
+    _, expected, expected_requests = fetch(make_client(mode), overpass, url)
+    app = make_client(mode, asgi=True)
+    status, body, requests = fetch(app, overpass, url)
+    _, streamed, _ = fetch(app, overpass, url + "&stream=1")
+    _, deduped, _ = fetch(app, overpass, url + "&dedupe=1")
+    _, expected_deduped, _ = fetch(make_client(mode), overpass, url + "&dedupe=1")
+
+    assert status == 200
+    assert json.loads(body) == json.loads(expected)
+    assert requests == expected_requests
+    assert json.loads(deduped) == json.loads(expected_deduped)
+    lines = [json.loads(line) for line in streamed.splitlines() if line]
+    assert sorted(line["index"] for line in lines) == list(range(len(lines)))
+    streamed_pois = [poi for line in sorted(lines, key=lambda line: line["index"]) for poi in line["pois"]]
+    assert streamed_pois == json.loads(body)
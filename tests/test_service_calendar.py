@@ -0,0 +1,30 @@
+import sqlite3
+
+from app.gtfs_feed import install_feed
+from app.service_calendar import SPECIAL_DAYS_BIT, classify_service, expand_services
+from benchmarks.synthetic_feed import make_synthetic_feed
+
+
+def test_dates_only_service_is_a_holiday_one():
+    services = expand_services(
+        [("Weekday", 1, 1, 1, 1, 1, 0, 0, "20260101", "20261231")],
+        [("Holiday", "20261126", 1), ("Holiday", "20261225", 1), ("Weekday", "20261126", 2)],
+    )
+    _, _, day_mask, _ = services["Holiday"]
+
+    # Thanksgiving is a Thursday and Christmas 2026 a Friday
+    assert day_mask == SPECIAL_DAYS_BIT | 1 << 3 | 1 << 4
+    assert classify_service("Holiday", day_mask) == "Holiday"
+    assert classify_service("Weekday", services["Weekday"][2]) == "Weekday"
+
+
+def test_holiday_trips_are_classified_holiday(tmp_path):
+    zip_path = make_synthetic_feed(str(tmp_path / "download.zip"), routes=1, stops_per_route=4, trips_per_direction=4)
+    feed = install_feed(zip_path, str(tmp_path))
+    conn = sqlite3.connect(feed["db_path"])
+    schedule_types = dict(conn.execute("SELECT service_id, schedule_type FROM service_calendar"))
+    holiday_trips = conn.execute("SELECT DISTINCT schedule_type FROM trips WHERE service_id = 'Holiday'").fetchall()
+    conn.close()
+
+    assert schedule_types == {"Weekday": "Weekday", "Saturday": "Saturday", "Sunday": "Sunday", "Holiday": "Holiday"}
+    assert holiday_trips == [("Holiday",)]
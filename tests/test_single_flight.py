@@ -0,0 +1,35 @@
+import asyncio
+
+from app.single_flight import SingleFlightCache
+
+
+def test_cancelled_waiter_leaves_the_others_the_value():
+    cache = SingleFlightCache(ttl=60)
+
+    async def main():
+        release = asyncio.Event()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await release.wait()
+            return "departures"
+
+        owner = asyncio.create_task(cache.get_async("stop", fetch))
+        await asyncio.sleep(0)
+        cancelled = asyncio.create_task(cache.get_async("stop", fetch))
+        waiter = asyncio.create_task(cache.get_async("stop", fetch))
+        await asyncio.sleep(0)
+
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        release.set()
+
+        assert await owner == "departures"
+        assert await waiter == "departures"
+        assert cancelled.cancelled()
+        assert len(calls) == 1
+
+    asyncio.run(main())
+    assert cache.get("stop", lambda: "refetched") == "departures"
+    assert cache.stats()["coalesced"] == 2
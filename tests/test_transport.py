@@ -0,0 +1,70 @@
+"""The transport's circuit breaker against a local upstream that fails on demand."""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app import transport
+
+
+class Upstream(BaseHTTPRequestHandler):
+    """/fail answers 503, /slow-fail 503 after 0.4 s, /slow 200 after 1 s."""
+
+    requests = []
+
+    def do_GET(self):
+        Upstream.requests.append(self.path)
+        if self.path.startswith("/slow"):
+            time.sleep(0.4 if "fail" in self.path else 1)
+        self.send_response(503 if "fail" in self.path else 200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    monkeypatch.setattr(Upstream, "requests", [])
+    monkeypatch.setitem(transport.settings, "backoff", 0)
+    monkeypatch.setitem(transport.settings, "reset_seconds", 0.15)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Upstream)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_retries_stop_once_the_breaker_opens(upstream, monkeypatch):
+    monkeypatch.setitem(transport.settings, "retries", 5)
+    monkeypatch.setitem(transport.settings, "failure_threshold", 2)
+
+    with pytest.raises(transport.CircuitOpenError):
+        transport.get(f"{upstream}/fail")
+
+    assert Upstream.requests == ["/fail", "/fail"]
+
+
+def test_only_the_trial_request_frees_the_half_open_slot(upstream, monkeypatch):
+    monkeypatch.setitem(transport.settings, "retries", 0)
+    monkeypatch.setitem(transport.settings, "failure_threshold", 1)
+
+    # Admitted while closed, finishing (and failing) while the trial is out
+    straggler = threading.Thread(target=transport.get, args=(f"{upstream}/slow-fail",))
+    straggler.start()
+    time.sleep(0.05)
+    transport.get(f"{upstream}/fail")
+    time.sleep(0.2)
+    trial = threading.Thread(target=transport.get, args=(f"{upstream}/slow",))
+    trial.start()
+    straggler.join()
+    time.sleep(0.2)
+
+    with pytest.raises(transport.CircuitOpenError):
+        transport.get(f"{upstream}/fail")
+    trial.join()
+
+    assert Upstream.requests.count("/slow") == 1
+    assert "/fail" not in Upstream.requests[2:]
@@ -0,0 +1,131 @@
+"""
+VehicleHub against a local NexTrip stand-in: subscribers get a snapshot,
+then updates with only the vehicles that moved and the trips that left, and
+a route is polled upstream once per interval however many clients watch it.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app import services, transport
+from app.vehicles import VehicleHub
+
+INTERVAL = 0.2
+ROUTE_ID = "2"
+
+
+def vehicle(trip_id, latitude, longitude=-93.265):
+    return {"trip_id": trip_id, "route_id": ROUTE_ID, "latitude": latitude, "longitude": longitude,
+            "bearing": 90, "location_time": 1700000000}
+
+
+class NexTripStandIn(BaseHTTPRequestHandler):
+    """Serves /vehicles/<route_id> from `vehicles`, counting requests per route."""
+
+    vehicles = {}
+    requests = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        route_id = self.path.rsplit("/", 1)[1]
+        with NexTripStandIn.lock:
+            NexTripStandIn.requests[route_id] = NexTripStandIn.requests.get(route_id, 0) + 1
+            body = json.dumps(NexTripStandIn.vehicles.get(route_id, [])).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def nextrip(monkeypatch):
+    monkeypatch.setattr(NexTripStandIn, "vehicles", {ROUTE_ID: [vehicle("t1", 44.97), vehicle("t2", 44.98)]})
+    monkeypatch.setattr(NexTripStandIn, "requests", {})
+    monkeypatch.setitem(transport.settings, "retries", 0)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), NexTripStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(services, "METRO_TRANSIT_API_URL", f"http://127.0.0.1:{server.server_port}/nextrip")
+    yield NexTripStandIn
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def hub():
+    hub = VehicleHub(INTERVAL)
+    yield hub
+    # Let the poller see there is nobody left and stop
+    for route_id in list(hub._subscribers):
+        for subscription in list(hub._subscribers.get(route_id, ())):
+            hub.unsubscribe(subscription)
+
+
+def next_event(subscription):
+    message = subscription.get(timeout=INTERVAL * 10)
+    assert message is not None, "no event from the hub"
+    return message
+
+
+def set_vehicles(standin, vehicles):
+    with standin.lock:
+        standin.vehicles[ROUTE_ID] = vehicles
+
+
+def test_snapshot_then_only_changes(nextrip, hub):
+    subscription = hub.subscribe(ROUTE_ID)
+
+    event, snapshot = next_event(subscription)
+    assert event == "snapshot"
+    assert sorted(v["trip_id"] for v in snapshot) == ["t1", "t2"]
+
+    # t1 moves, t2 stays put and t3 starts
+    set_vehicles(nextrip, [vehicle("t1", 44.975), vehicle("t2", 44.98), vehicle("t3", 44.99)])
+    event, update = next_event(subscription)
+    assert event == "update"
+    assert sorted(v["trip_id"] for v in update["vehicles"]) == ["t1", "t3"]
+    assert update["removed"] == []
+
+    # t2 finishes its trip
+    set_vehicles(nextrip, [vehicle("t1", 44.975), vehicle("t3", 44.99)])
+    event, update = next_event(subscription)
+    assert event == "update"
+    assert update == {"vehicles": [], "removed": ["t2"]}
+
+    # Nothing changes, so nothing is sent
+    assert subscription.get(timeout=INTERVAL * 3) is None
+
+    # A client joining later starts from the current vehicles
+    late = hub.subscribe(ROUTE_ID)
+    event, snapshot = next_event(late)
+    assert event == "snapshot"
+    assert sorted(v["trip_id"] for v in snapshot) == ["t1", "t3"]
+
+
+def test_route_is_polled_once_per_interval_for_all_subscribers(nextrip, hub):
+    started = time.monotonic()
+    subscriptions = [hub.subscribe(ROUTE_ID) for _ in range(5)]
+    for subscription in subscriptions:
+        assert next_event(subscription)[0] == "snapshot"
+
+    time.sleep(INTERVAL * 5)
+    with nextrip.lock:
+        polls = nextrip.requests[ROUTE_ID]
+    elapsed = time.monotonic() - started
+
+    # One request per interval in all, not one per subscriber
+    assert 5 <= polls <= elapsed / INTERVAL + 1
+    assert hub.stats()["subscribers"] == 5
+
+    for subscription in subscriptions:
+        hub.unsubscribe(subscription)
+    assert hub.stats()["routes"] == 0
+    time.sleep(INTERVAL * 2)
+    with nextrip.lock:
+        assert nextrip.requests[ROUTE_ID] <= polls + 1
@@ -0,0 +1,81 @@
+"""
+WalkingDistances against a local OSRM stand-in: batching, the shared SQLite
+cache, and the straight-line-times-detour fallback when the router fails.
+"""
+import pytest
+
+from app import transport
+from app.spatial import haversine_distance
+from app.walking import WalkingDistances
+from conftest import OSRM_DETOUR
+
+DETOUR_FACTOR = 1.3
+STOPS = [(44.9778 + i * 0.004, -93.2650 + i * 0.004) for i in range(6)]
+# Three POIs a couple of hundred meters around every stop
+PAIRS = [((lat, lon), (lat + dlat, lon + dlon)) for lat, lon in STOPS for dlat, dlon in ((0.001, 0), (0, 0.002), (-0.002, -0.001))]
+
+
+@pytest.fixture
+def make_walking(osrm, tmp_path, monkeypatch):
+    url, _ = osrm
+    monkeypatch.setitem(transport.settings, "retries", 0)
+
+    def make(max_table_size=100):
+        return WalkingDistances(url, "walking", str(tmp_path / "walking.db"), 5, DETOUR_FACTOR, max_table_size)
+
+    return make
+
+
+def straight(pair):
+    return haversine_distance(*pair[0], *pair[1])
+
+
+def test_pairs_are_fetched_in_one_request_then_served_from_the_cache(osrm, make_walking):
+    _, standin = osrm
+
+    first = make_walking().pair_distances(PAIRS)
+    # A new instance on the same file, as another worker would have
+    second = make_walking().pair_distances(PAIRS)
+
+    assert standin.requests == [len(STOPS) + len(PAIRS)]
+    assert first == pytest.approx([straight(pair) * OSRM_DETOUR for pair in PAIRS])
+    assert second == pytest.approx(first)
+
+
+def test_requests_stay_under_the_table_size(osrm, make_walking):
+    _, standin = osrm
+
+    distances = make_walking(max_table_size=10).pair_distances(PAIRS)
+
+    assert distances == pytest.approx([straight(pair) * OSRM_DETOUR for pair in PAIRS])
+    assert standin.requests and max(standin.requests) <= 10
+    assert sum(standin.requests) == len(STOPS) + len(PAIRS)
+
+
+def test_router_failure_falls_back_to_the_detour_estimate_uncached(osrm, make_walking):
+    _, standin = osrm
+    standin.fail = True
+    walking = make_walking()
+
+    estimated = walking.pair_distances(PAIRS)
+    standin.fail = False
+    routed = walking.pair_distances(PAIRS)
+
+    assert estimated == pytest.approx([straight(pair) * DETOUR_FACTOR for pair in PAIRS])
+    assert walking.estimates == len(PAIRS)
+    # Estimates are not cached, so the router is asked again once it is back
+    assert routed == pytest.approx([straight(pair) * OSRM_DETOUR for pair in PAIRS])
+    assert len(standin.requests) == 2
+
+
+def test_matrix_distances_share_the_cache(osrm, make_walking):
+    _, standin = osrm
+    walking = make_walking()
+    origins, destinations = STOPS[:2], [destination for _, destination in PAIRS[:6]]
+
+    matrix = walking.distances(origins, destinations)
+    requests = len(standin.requests)
+    walking.pair_distances([(origin, destination) for origin in origins for destination in destinations])
+
+    assert matrix[1][0] == pytest.approx(haversine_distance(*origins[1], *destinations[0]) * OSRM_DETOUR)
+    assert len(standin.requests) == requests == 1